@@ -11,5 +11,14 @@ class ApiBaseboneConfig(AppConfig):
         from api_basebone.bsm.api import exposed
         import api_basebone.bsm.functions  # 注册所有云函数
         from api_basebone import db
+        from api_basebone.settings import settings as basebone_settings
+        from api_basebone.utils import meta
 
         register_api(self.name, exposed)
+
+        # 管理后台的模块在启动时加载一次，请求中不再查找
+        meta.load_custom_admin_module()
+        if basebone_settings.WARMUP_ON_READY:
+            from api_basebone.services.warmup import warmup
+
+            warmup()
@@ -21,6 +21,7 @@ def register_annotated_field(
         'type': field_type,
         'annotation': annotation,
     }
+    _bump_registry_version()
 
 
 def register_computed_field(model, field_name, field_type, prop, display_name=None, deps=None):
@@ -46,3 +47,11 @@ def register_computed_field(model, field_name, field_type, prop, display_name=No
         cfg['deps'] = deps
 
     model.GMeta.computed_fields.append(cfg)
+    _bump_registry_version()
+
+
+def _bump_registry_version():
+    """模型的计算字段变更后，依赖这些配置构建的缓存需要失效"""
+    from api_basebone.core.admin import BSMAdminModule
+
+    BSMAdminModule.version += 1
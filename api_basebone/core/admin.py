@@ -70,6 +70,12 @@ BSM_STATISTICS = 'statistics'
 # 允许排序的字段
 BSM_SORTABLE = 'sortable'
 
+# 列表的分页方式，page 页码分页，cursor 游标分页
+BSM_PAGINATION = 'pagination'
+
+# 列表分页时总数的计算方式，exact 查询总数，none 不计算总数，cached 缓存总数，estimate 估算总数
+BSM_PAGINATION_COUNT = 'pagination_count'
+
 # 合法的前端管理端的设置
 VALID_MANAGE_ATTRS = [
     BSM_AUTH_FILTER_FIELD,
@@ -96,6 +102,8 @@ VALID_MANAGE_ATTRS = [
     BSM_SORTABLE,
     BSM_DISPLAY_IN_SORT,
     BSM_SORT_KEY,
+    BSM_PAGINATION,
+    BSM_PAGINATION_COUNT,
     'detail',  # 详情页临时配置
 ]
 
@@ -123,9 +131,14 @@ for key, value in ATTRS_DICT.items():
 
 
 class BSMAdminModule:
-    """管理项目的 admin 的所有的 BSM 类"""
+    """管理项目的 admin 的所有的 BSM 类
+
+    version 为注册表的版本号，每次注册 admin 类时递增，依赖 admin 配置构建的
+    缓存可以通过比对版本号判断是否需要失效
+    """
 
     modules = {}
+    version = 0
 
 
 def register(admin_class):
@@ -133,4 +146,5 @@ def register(admin_class):
     key = f'{_meta.app_label}__{_meta.model_name}'
     # if key not in BSMAdminModule.modules:
     BSMAdminModule.modules[key] = admin_class
+    BSMAdminModule.version += 1
     return admin_class
@@ -66,6 +66,22 @@ ORDER_BY_FIELDS = 'order_by'
 """
 DATA_WITH_TREE = 'data_with_tree'
 
+"""树形数据加载的最大深度，根节点的子节点深度为 1，不传时加载所有的层级
+
+支持的方法：POST, GET 当前适用于列表方法
+
+数据格式 Int
+"""
+TREE_MAX_DEPTH = 'tree_max_depth'
+
+"""树形数据中是否输出每个节点的子节点数量，数量的键为子节点的键加上 _count
+
+支持的方法：POST, GET 当前适用于列表方法
+
+数据格式 Bool：true 或者 false
+"""
+TREE_CHILD_COUNT = 'tree_child_count'
+
 """在序列化时，指定排除的字段，数据格式为列表或者元组"""
 GMETA_SERIALIZER_EXCLUDE_FIELDS = 'exclude_fields'
 
@@ -38,15 +38,24 @@ def action(model, verbose_name='', manage=True):
     return middle
 
 
-def basebone_admin_property(model, display_name, field_type=None):
+def basebone_admin_property(model, display_name, field_type=None, batch=False):
     """
     管理端计算属性字段，管理端配置时，输出对应的数据
 
     FIXME: 暂时在 bsm admin 类中使用
 
+    批量模式下，被装饰的方法接收一页（或导出时的一批）数据的实例列表，
+    返回以主键为键的字典，每页数据只调用一次，例如：
+
+        @basebone_admin_property(Article, '评论数', batch=True)
+        def comment_count(self, instances):
+            ...
+            return {instance.pk: value}
+
     Params:
         display str 字段的可读名称
         field_type str 字段的类型
+        batch bool 是否是批量模式
     """
     # 如果没有指定字段类型，则默认是字符串
     if not field_type:
@@ -66,6 +75,7 @@ def basebone_admin_property(model, display_name, field_type=None):
             model.bsm_admin_computed_fields_map[name] = {
                 'display_name': display_name,
                 'field_type': field_type,
+                'batch': batch,
             }
         return wrapper
 
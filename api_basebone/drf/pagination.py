@@ -1,17 +1,194 @@
+import base64
+import binascii
+import datetime
+import decimal
+import json
+import uuid
+from collections import OrderedDict
+from functools import partial
+
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models import F, Q
 from rest_framework.pagination import (
     _positive_int,
     PageNumberPagination as OriginPageNumberPagination,
 )
 from rest_framework.response import Response
 
+from api_basebone.core import admin, exceptions
+from api_basebone.settings import settings as basebone_settings
+from api_basebone.utils.cache import get_model_cache_key
+
+# 请求中指定分页方式的参数
+PAGINATION_QUERY_PARAM = 'pagination'
+# 分页方式
+PAGINATION_PAGE = 'page'
+PAGINATION_CURSOR = 'cursor'
+
+# 结果集中保存游标位置的注解字段的前缀
+CURSOR_ANNOTATION_PREFIX = '_basebone_cursor_'
+
+# 请求中指定总数计算方式的参数
+COUNT_QUERY_PARAM = 'count'
+# 总数的计算方式，exact 查询总数，none 不计算总数，cached 缓存总数，estimate 估算总数
+COUNT_EXACT = 'exact'
+COUNT_NONE = 'none'
+COUNT_CACHED = 'cached'
+COUNT_ESTIMATE = 'estimate'
+COUNT_MODES = (COUNT_EXACT, COUNT_NONE, COUNT_CACHED, COUNT_ESTIMATE)
+# 返回的总数的类型，exact, none, cached 和计算方式相同
+COUNT_ESTIMATED = 'estimated'
+
+# 总数的缓存的键的前缀
+COUNT_CACHE_PREFIX = 'basebone_count'
+
+
+def get_count_cache_key(queryset):
+    """总数缓存的键
+
+    过滤条件、角色的过滤条件、当前用户的过滤最终都体现在 SQL 中，所以使用去掉排序
+    和输出字段之后的 SQL 作为标识
+    """
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    return get_model_cache_key(
+        COUNT_CACHE_PREFIX, queryset.model, queryset.db, sql, params
+    )
+
+
+def get_cached_count(queryset):
+    """获取缓存的总数，返回 (总数, 是否命中缓存)"""
+    key = get_count_cache_key(queryset)
+    count = cache.get(key)
+    if count is not None:
+        return count, True
+    count = queryset.count()
+    cache.set(key, count, basebone_settings.PAGINATION_COUNT_CACHE_TIMEOUT)
+    return count, False
+
+
+def estimate_count(queryset):
+    """使用数据库的统计信息估算总数
+
+    只适用于没有过滤条件的结果集，数据库不支持或者估算的数量较小时返回 None
+    """
+    query = queryset.query
+    if (
+        query.where.children
+        or query.distinct
+        or query.combinator
+        or query.low_mark
+        or query.high_mark is not None
+    ):
+        return None
+
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE oid = %s::regclass'
+        params = [connection.ops.quote_name(table)]
+    elif connection.vendor == 'mysql':
+        sql = (
+            'SELECT table_rows FROM information_schema.tables '
+            'WHERE table_schema = DATABASE() AND table_name = %s'
+        )
+        params = [table]
+    else:
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    if not row or row[0] is None:
+        return None
+    count = int(row[0])
+    if count < basebone_settings.PAGINATION_ESTIMATE_THRESHOLD:
+        return None
+    return count
+
+
+class CountedPaginator(Paginator):
+    """使用已知的总数的分页器，不再查询总数"""
+
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        if count is not None:
+            self.count = count
+
+
+class UncountedPaginator(Paginator):
+    """不计算总数的分页器，多取一条数据判断是否有下一页"""
+
+    count = None
+    # 总页数未知，获取数据之后为当前页，还有数据时为下一页
+    num_pages = 1
+
+    def validate_number(self, number):
+        """只校验页码的格式，不校验页码的范围"""
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('页码不是整数')
+        if number < 1:
+            raise EmptyPage('页码小于 1')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom : bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage('该页没有数据')
+        self.num_pages = number + 1 if len(rows) > self.per_page else number
+        return self._get_page(rows[: self.per_page], number, self)
+
 
 class PageNumberPagination(OriginPageNumberPagination):
+    """页码分页
+
+    总数的计算方式由 count 参数或者 admin 的配置指定，大表可以不计算总数、缓存总数
+    或者估算总数，返回的 count_type 为总数的类型
+    """
 
     max_page_size = 1000
     page_size = 100
     page_query_param = 'page'
     page_size_query_param = 'size'
 
+    def get_count_mode(self, request, view=None):
+        """总数的计算方式，请求参数的优先级高于 admin 的配置"""
+        mode = request.query_params.get(COUNT_QUERY_PARAM)
+        if not mode and view is not None and hasattr(view, 'get_bsm_model_admin'):
+            admin_class = view.get_bsm_model_admin()
+            mode = getattr(admin_class, admin.BSM_PAGINATION_COUNT, None)
+        return mode if mode in COUNT_MODES else COUNT_EXACT
+
+    def get_count(self, queryset, mode):
+        """获取总数，返回 (总数, 总数的类型)"""
+        if mode == COUNT_ESTIMATE:
+            count = estimate_count(queryset)
+            if count is not None:
+                return count, COUNT_ESTIMATED
+        count, hit = get_cached_count(queryset)
+        return count, COUNT_CACHED if hit else COUNT_EXACT
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count_type = mode = self.get_count_mode(request, view)
+        self.django_paginator_class = Paginator
+        if mode == COUNT_NONE:
+            self.django_paginator_class = UncountedPaginator
+        elif mode != COUNT_EXACT and self.get_page_size(request):
+            count, self.count_type = self.get_count(queryset, mode)
+            self.django_paginator_class = partial(CountedPaginator, count=count)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        response.data['count_type'] = self.count_type
+        return response
+
     def get_page_size(self, request):
         """重写此方法是为了支持以下场景
 
@@ -28,3 +205,238 @@ class PageNumberPagination(OriginPageNumberPagination):
             except (KeyError, ValueError):
                 return
         return self.page_size
+
+
+def encode_cursor_value(value):
+    """游标中的值转换为 json 可以表示的值，时间保留完整的精度"""
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    return value
+
+
+class KeysetOrdering:
+    """游标分页使用的排序
+
+    排序字段的值组成游标的位置，主键作为最后的排序字段保证位置唯一。可以为空的
+    字段，空值总是作为最小的值排序，升序时排在最前，降序时排在最后
+
+    Params:
+        fields list 排序字段，元素为 (字段, 是否降序, 是否可以为空)
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    @classmethod
+    def resolve_field(cls, model, name):
+        """解析排序字段，返回字段是否可以为空，不支持的字段返回 None"""
+        field, nullable = None, False
+        for part in name.split('__'):
+            if field is not None:
+                if not field.is_relation:
+                    return None
+                model = field.related_model
+            try:
+                field = model._meta.pk if part == 'pk' else model._meta.get_field(part)
+            except FieldDoesNotExist:
+                return None
+            # 多值的关系和反向的关系可能没有关联的数据
+            nullable = nullable or getattr(field, 'null', False) or not field.concrete
+        if field.is_relation and field.related_model._meta.ordering:
+            # 关系字段使用关联模型的默认排序，无法作为游标的位置
+            return None
+        return nullable
+
+    @classmethod
+    def from_queryset(cls, queryset):
+        """从结果集中获取生效的排序，无法使用游标分页的排序返回 None"""
+        query = queryset.query
+        if query.extra_order_by:
+            return None
+        ordering = query.order_by
+        if not ordering and query.default_ordering:
+            ordering = query.get_meta().ordering
+
+        model, fields, has_pk = queryset.model, [], False
+        pk_names = {'pk', model._meta.pk.name, model._meta.pk.attname}
+        for item in ordering:
+            if not isinstance(item, str) or item == '?':
+                return None
+            descending, name = item.startswith('-'), item.lstrip('-')
+            if name in query.annotations:
+                nullable = True
+            else:
+                nullable = cls.resolve_field(model, name)
+                if nullable is None:
+                    return None
+            has_pk = has_pk or name in pk_names
+            fields.append((name, descending, nullable))
+
+        if not has_pk:
+            fields.append(('pk', fields[-1][1] if fields else False, False))
+        return cls(fields)
+
+    def order_by(self, reverse=False):
+        """排序的表达式，reverse 为 True 时反向排序"""
+        result = []
+        for name, descending, nullable in self.fields:
+            descending = descending != reverse
+            if not nullable:
+                result.append(f'-{name}' if descending else name)
+            elif descending:
+                result.append(F(name).desc(nulls_last=True))
+            else:
+                result.append(F(name).asc(nulls_first=True))
+        return result
+
+    def after(self, position, reverse=False):
+        """位置之后的数据的过滤条件
+
+        Params:
+            position list 排序字段的值
+            reverse bool 为 True 时获取位置之前的数据
+        """
+        result, equal = [], Q()
+        for (name, descending, nullable), value in zip(self.fields, position):
+            greater = descending == reverse
+            if value is None:
+                strict = Q(**{f'{name}__isnull': False}) if greater else None
+            elif greater:
+                strict = Q(**{f'{name}__gt': value})
+            else:
+                strict = Q(**{f'{name}__lt': value})
+                if nullable:
+                    strict |= Q(**{f'{name}__isnull': True})
+            if strict is not None:
+                result.append(equal & strict)
+            if value is None:
+                equal &= Q(**{f'{name}__isnull': True})
+            else:
+                equal &= Q(**{name: value})
+
+        if not result:
+            return Q(pk__in=[])
+        condition = result[0]
+        for item in result[1:]:
+            condition |= item
+        return condition
+
+    def annotations(self):
+        """保存游标位置的注解字段"""
+        return {
+            f'{CURSOR_ANNOTATION_PREFIX}{index}': F(name)
+            for index, (name, _, _) in enumerate(self.fields)
+        }
+
+    def get_position(self, row):
+        """获取数据的位置，数据为模型实例或者 values 的字典"""
+        names = [
+            f'{CURSOR_ANNOTATION_PREFIX}{index}' for index in range(len(self.fields))
+        ]
+        if isinstance(row, dict):
+            return [encode_cursor_value(row[name]) for name in names]
+        return [encode_cursor_value(getattr(row, name)) for name in names]
+
+
+class CursorPagination(PageNumberPagination):
+    """游标分页
+
+    使用排序字段和主键作为游标的位置，查询的耗时和翻页的深度无关，不计算总数。
+    返回的 next 和 previous 为不透明的游标，客户端通过 cursor 参数传回。排序无法
+    作为游标的位置时，例如使用了表达式或者随机排序，退化为页码分页
+    """
+
+    cursor_query_param = 'cursor'
+
+    def decode_cursor(self, request):
+        """解析游标，返回 (位置, 是否反向)，没有游标时返回 (None, False)"""
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            return list(data['p']), bool(data.get('r'))
+        except (TypeError, ValueError, KeyError, binascii.Error):
+            raise exceptions.BusinessException(
+                error_code=exceptions.PARAMETER_FORMAT_ERROR,
+                error_data=f'{self.cursor_query_param} 不合法',
+            )
+
+    def encode_cursor(self, position, reverse=False):
+        data = {'p': position}
+        if reverse:
+            data['r'] = 1
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode('ascii')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.fallback = None
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        ordering = KeysetOrdering.from_queryset(queryset)
+        if ordering is None:
+            self.fallback = PageNumberPagination()
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        position, reverse = self.decode_cursor(request)
+        if position is not None and len(position) != len(ordering.fields):
+            raise exceptions.BusinessException(
+                error_code=exceptions.PARAMETER_FORMAT_ERROR,
+                error_data=f'{self.cursor_query_param} 不合法',
+            )
+
+        queryset = queryset.annotate(**ordering.annotations()).order_by(
+            *ordering.order_by(reverse)
+        )
+        if position is not None:
+            queryset = queryset.filter(ordering.after(position, reverse))
+
+        # 多取一条数据，判断是否还有下一页
+        rows = list(queryset[: page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+
+        self.next_cursor = self.previous_cursor = None
+        if rows:
+            first, last = ordering.get_position(rows[0]), ordering.get_position(rows[-1])
+            if reverse:
+                # 向前翻页时，当前页之后一定还有数据
+                self.next_cursor = self.encode_cursor(last)
+                if has_more:
+                    self.previous_cursor = self.encode_cursor(first, reverse=True)
+            else:
+                if has_more:
+                    self.next_cursor = self.encode_cursor(last)
+                if position is not None:
+                    self.previous_cursor = self.encode_cursor(first, reverse=True)
+        return rows
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        return Response(
+            OrderedDict(
+                [
+                    ('next', self.next_cursor),
+                    ('previous', self.previous_cursor),
+                    ('results', data),
+                ]
+            )
+        )
+
+
+# 分页方式和分页类的映射
+PAGINATION_CLASSES = {
+    PAGINATION_PAGE: PageNumberPagination,
+    PAGINATION_CURSOR: CursorPagination,
+}
+
+
+def get_pagination_class(mode, default=PageNumberPagination):
+    """根据分页方式获取分页类，不合法的分页方式使用默认的分页类"""
+    return PAGINATION_CLASSES.get(mode, default)
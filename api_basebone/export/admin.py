@@ -62,9 +62,6 @@ def get_app_admin_config():
         config[admin.model]['_id'] = admin.id
         config[admin.model]['field_permissions'] = get_field_permissions(None, admin.model)
 
-    # 动态加载 amdin 模块
-    meta.load_custom_admin_module()
-
     for key, cls in BSMAdminModule.modules.items():
         config[key] = bsm_admin_config.admin_model_config(cls)
     return config
@@ -0,0 +1,245 @@
+import time
+from types import SimpleNamespace
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from api_basebone.restful.const import MANAGE_END_SLUG
+from api_basebone.services.expresstion import (
+    expression_cache,
+    interpret_expression,
+    resolve_expression,
+)
+from api_basebone.restful.serializers import (
+    RowEncoder,
+    multiple_create_serializer_class,
+    sort_expand_fields,
+)
+from api_basebone.utils import guardian
+from api_basebone.utils.queryset import queryset_prefetch, translate_expand_fields
+
+
+class Command(BaseCommand):
+    """性能基准测试
+
+    对框架中的热点路径做微基准测试，输出每秒处理的数据量，用于对比优化前后的效果
+
+    示例：python manage.py bsm_benchmark serializer --model auth__user --rows 1000
+    """
+
+    SCENARIOS = ['serializer', 'row_encoder', 'expression', 'guardian', 'endpoint']
+    # 不需要模型的场景
+    MODEL_FREE_SCENARIOS = ['expression']
+    # 输出的单位，默认为 rows/s
+    UNITS = {'expression': 'calls/s', 'endpoint': 'requests/s'}
+    # 表达式场景默认使用的表达式
+    EXPRESSIONS = [
+        'user.id',
+        '"published"',
+        'add(user.id, mul(2, 3))',
+        'if(gt(user.id, 0), user.username, "anonymous")',
+        'contains(user.roles, "admin")',
+        'Concat(F("name"), Value("-"), F("code"))',
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'scenario', type=str, choices=self.SCENARIOS, help='基准测试的场景'
+        )
+        parser.add_argument(
+            '--model', type=str, help='模型, 格式为 app_label__model_name'
+        )
+        parser.add_argument('--rows', type=int, default=1000, help='每轮处理的数据量')
+        parser.add_argument('--repeat', type=int, default=5, help='重复的轮数，取最好的一轮')
+        parser.add_argument(
+            '--expand-fields', type=str, default='', help='展开字段，多个使用逗号分隔'
+        )
+        parser.add_argument(
+            '--end-slug', type=str, default=MANAGE_END_SLUG, help='端，默认为管理端'
+        )
+        parser.add_argument(
+            '--expression', type=str, action='append', help='表达式场景使用的表达式，可以指定多个'
+        )
+        parser.add_argument('--user', type=str, help='对象权限场景和接口场景使用的用户名')
+
+    def get_model(self, value):
+        if not value:
+            raise CommandError('需要指定模型')
+        try:
+            app_label, model_name = value.split('__', maxsplit=1)
+            return apps.get_model(app_label, model_name)
+        except (ValueError, LookupError):
+            raise CommandError(f'模型 {value} 不存在')
+
+    def run_rounds(self, func, rows, repeat):
+        """执行多轮测试，返回最好一轮的每秒处理数据量"""
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            cost = time.perf_counter() - start
+            best = cost if best is None else min(best, cost)
+        return rows / best if best else 0
+
+    def load_rows(self, queryset, rows):
+        """加载测试数据，数据不足时循环填充到指定的数量"""
+        instances = list(queryset[:rows])
+        if not instances:
+            raise CommandError('模型没有数据，无法进行测试')
+        while len(instances) < rows:
+            instances.extend(instances[: rows - len(instances)])
+        return instances
+
+    def get_serializer_class_and_queryset(self, model, options):
+        """根据展开字段构建序列化类和结果集"""
+        expand_fields = [item for item in options['expand_fields'].split(',') if item]
+        if expand_fields:
+            expand_fields = translate_expand_fields(model, expand_fields)
+        serializer_class = multiple_create_serializer_class(
+            model, expand_fields, end_slug=options['end_slug'], action='list'
+        )
+        queryset = queryset_prefetch(
+            model.objects.all(), sort_expand_fields(expand_fields)
+        )
+        return serializer_class, queryset
+
+    def benchmark_serializer(self, model, options):
+        """序列化输出，数据预先加载到内存中，只计算序列化的耗时"""
+        serializer_class, queryset = self.get_serializer_class_and_queryset(
+            model, options
+        )
+        instances = self.load_rows(queryset, options['rows'])
+        return self.run_rounds(
+            lambda: serializer_class(instances, many=True).data,
+            options['rows'],
+            options['repeat'],
+        )
+
+    def benchmark_row_encoder(self, model, options):
+        """只读接口的完整输出，包含查询，对比序列化类和行编码器
+
+        Returns:
+            dict 键为输出的方式，值为每秒处理的数据量
+        """
+        serializer_class, queryset = self.get_serializer_class_and_queryset(
+            model, options
+        )
+        encoder = RowEncoder.compile(serializer_class(many=True))
+        if encoder is None or not encoder.supports(queryset):
+            raise CommandError('序列化类不支持行编码器')
+
+        rows, repeat = options['rows'], options['repeat']
+        queryset = queryset[:rows]
+        return {
+            'serializer': self.run_rounds(
+                lambda: serializer_class(queryset.all(), many=True).data, rows, repeat
+            ),
+            'row_encoder': self.run_rounds(
+                lambda: encoder.encode(encoder.values_queryset(queryset), queryset),
+                rows,
+                repeat,
+            ),
+        }
+
+    def benchmark_expression(self, model, options):
+        """表达式求值，对比每次解析和编译后求值
+
+        Returns:
+            dict 键为求值的方式，值为每秒求值的次数
+        """
+        expressions = options['expression'] or self.EXPRESSIONS
+        variables = SimpleNamespace(
+            user=SimpleNamespace(id=1, username='admin', roles=['admin', 'staff'])
+        )
+        rows, repeat = options['rows'], options['repeat']
+        total = rows * len(expressions)
+
+        def run(resolve):
+            for _ in range(rows):
+                for expression in expressions:
+                    resolve(expression, variables)
+
+        expression_cache.clear()
+        return {
+            'interpret': self.run_rounds(lambda: run(interpret_expression), total, repeat),
+            'compiled': self.run_rounds(lambda: run(resolve_expression), total, repeat),
+        }
+
+    def get_user(self, options):
+        try:
+            return get_user_model().objects.get_by_natural_key(options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f'用户 {options["user"]} 不存在')
+
+    def benchmark_guardian(self, model, options):
+        """对象权限的筛选，对比把授权数据的主键加载到内存和使用子查询
+
+        Returns:
+            dict 键为筛选的方式，值为每秒处理的数据量
+        """
+        from guardian.models import GroupObjectPermission, UserObjectPermission
+
+        user = self.get_user(options)
+
+        permission_id = guardian.get_view_permission_id(model)
+        if permission_id is None:
+            raise CommandError('模型没有查看权限')
+        rows, repeat = options['rows'], options['repeat']
+        queryset = model.objects.order_by('pk')
+
+        def in_memory():
+            pks = set(
+                UserObjectPermission.objects.filter(
+                    user=user, permission_id=permission_id
+                ).values_list('object_pk', flat=True)
+            )
+            pks.update(
+                GroupObjectPermission.objects.filter(
+                    group__user=user, permission_id=permission_id
+                ).values_list('object_pk', flat=True)
+            )
+            return list(queryset.filter(pk__in=pks)[:rows]) if pks else []
+
+        return {
+            'in_memory': self.run_rounds(in_memory, rows, repeat),
+            'subquery': self.run_rounds(
+                lambda: list(guardian.filter_granted_objects(queryset, user)[:rows]),
+                rows,
+                repeat,
+            ),
+        }
+
+    def benchmark_endpoint(self, model, options):
+        """管理端列表接口每个请求的框架开销
+
+        模型使用空表时，数据的查询和序列化的耗时可以忽略，--rows 为请求的次数
+        """
+        from rest_framework.test import APIRequestFactory, force_authenticate
+
+        from api_basebone.restful.manage.views import CommonManageViewSet
+
+        user = self.get_user(options)
+        view = CommonManageViewSet.as_view({'post': 'list'})
+        factory = APIRequestFactory()
+        app_label, model_slug = model._meta.app_label, model._meta.model_name
+        rows, repeat = options['rows'], options['repeat']
+
+        def run():
+            for _ in range(rows):
+                request = factory.post('/', {}, format='json')
+                force_authenticate(request, user)
+                view(request, app=app_label, model=model_slug)
+
+        return self.run_rounds(run, rows, repeat)
+
+    def handle(self, *args, **options):
+        scenario = options['scenario']
+        model = None
+        if scenario not in self.MODEL_FREE_SCENARIOS:
+            model = self.get_model(options['model'])
+        result = getattr(self, f'benchmark_{scenario}')(model, options)
+        if not isinstance(result, dict):
+            result = {scenario: result}
+        for key, value in result.items():
+            self.stdout.write(f'{key}: {value:.0f} {self.UNITS.get(scenario, "rows/s")}')
@@ -0,0 +1,40 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from api_basebone.services.rollup import get_rollups
+
+
+class Command(BaseCommand):
+    """重建汇总表
+
+    接口写入的数据会实时刷新汇总表，批量删除、直接修改数据库等接口以外的写入需要定期
+    执行此命令校正，汇总的声明变更后也需要执行此命令，重建前汇总表不会被使用
+
+    示例：python manage.py bsm_rollup --model shop__order
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model', type=str, action='append', help='模型, 格式为 app_label__model_name，默认为所有模型'
+        )
+        parser.add_argument('--name', type=str, help='汇总的名称，默认为模型的所有汇总')
+
+    def get_models(self, values):
+        if not values:
+            return apps.get_models()
+        models = []
+        for value in values:
+            try:
+                app_label, model_name = value.split('__', maxsplit=1)
+                models.append(apps.get_model(app_label, model_name))
+            except (ValueError, LookupError):
+                raise CommandError(f'模型 {value} 不存在')
+        return models
+
+    def handle(self, *args, **options):
+        for model in self.get_models(options['model']):
+            for rollup in get_rollups(model):
+                if options['name'] and not rollup.label.endswith(f':{options["name"]}'):
+                    continue
+                count = rollup.rebuild()
+                self.stdout.write(f'{rollup.label}: {count} rows')
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:19
+
+import api_basebone.core.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_basebone', '0017_auto_20191101_1829'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, unique=True, verbose_name='汇总')),
+                ('signature', models.CharField(max_length=32, verbose_name='声明的签名')),
+                ('built_at', models.DateTimeField(auto_now=True, verbose_name='重建时间')),
+            ],
+            options={
+                'verbose_name': '汇总表重建记录',
+                'verbose_name_plural': '汇总表重建记录',
+            },
+        ),
+        migrations.CreateModel(
+            name='RollupBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rollup', models.CharField(max_length=200, verbose_name='汇总')),
+                ('key', models.CharField(max_length=32, verbose_name='维度标识')),
+                ('dimensions', api_basebone.core.fields.JSONField(default={}, verbose_name='维度')),
+                ('metrics', api_basebone.core.fields.JSONField(default={}, verbose_name='指标')),
+            ],
+            options={
+                'verbose_name': '汇总数据',
+                'verbose_name_plural': '汇总数据',
+                'unique_together': {('rollup', 'key')},
+            },
+        ),
+    ]
@@ -5,6 +5,7 @@ from django.conf import settings
 from django.db import models
 
 from api_basebone.core.fields import JSONField
+from api_basebone.utils.cache import bump_model_version
 from api_basebone.signals import post_bsm_create, post_bsm_delete
 from api_basebone.settings import settings as basebone_settings
 
@@ -28,6 +29,32 @@ class AdminLog(models.Model):
         verbose_name_plural = '动作日志记录'
 
 
+class RollupState(models.Model):
+    """汇总表的重建记录，声明变更后需要重新重建"""
+
+    name = models.CharField('汇总', max_length=200, unique=True)
+    signature = models.CharField('声明的签名', max_length=32)
+    built_at = models.DateTimeField('重建时间', auto_now=True)
+
+    class Meta:
+        verbose_name = '汇总表重建记录'
+        verbose_name_plural = '汇总表重建记录'
+
+
+class RollupBucket(models.Model):
+    """汇总表中的一行，对应一组维度的值"""
+
+    rollup = models.CharField('汇总', max_length=200)
+    key = models.CharField('维度标识', max_length=32)
+    dimensions = JSONField('维度', default={})
+    metrics = JSONField('指标', default={})
+
+    class Meta:
+        verbose_name = '汇总数据'
+        verbose_name_plural = '汇总数据'
+        unique_together = ('rollup', 'key')
+
+
 @receiver(post_bsm_create, dispatch_uid='__append_create_log')
 def append_create_log(sender, instance, create, request, old_instance, scope, **kwargs):
     if sender == AdminLog or not basebone_settings.MANAGE_USE_ACTION_LOG or scope != 'admin':
@@ -50,6 +77,39 @@ def append_create_log(sender, instance, create, request, old_instance, scope, **
         logger.error('append create log fail', exc_info=True)
     
 
+def append_bulk_log(sender, items, request, scope='admin'):
+    """批量写入的动作日志，批量写入不发送保存的信号，日志一次写入
+
+    请求的数据包含所有行，数据量可能很大，不记录在每条日志中
+
+    Params:
+        items list 元素为 (数据对象, 是否新建)，数据库不能返回主键时新建的数据没有主键
+    """
+    if sender == AdminLog or not basebone_settings.MANAGE_USE_ACTION_LOG or scope != 'admin':
+        return
+    gmeta = getattr(sender, 'GMeta', None)
+    title_field = getattr(gmeta, 'title_field', None) if gmeta else None
+    try:
+        AdminLog.objects.bulk_create(
+            [
+                AdminLog(
+                    user=request.user,
+                    action='add' if create else 'update',
+                    app_label=sender._meta.app_label,
+                    model_slug=sender._meta.model_name,
+                    object_id='' if instance.pk is None else instance.pk,
+                    params={},
+                    message=str(
+                        getattr(instance, title_field) if title_field else repr(instance)
+                    )[:50],
+                )
+                for instance, create in items
+            ]
+        )
+    except Exception:
+        logger.error('append bulk log fail', exc_info=True)
+
+
 @receiver(post_bsm_delete, dispatch_uid='__append_delete_log')
 def append_delete_log(sender, instance, request, scope, **kwargs):
     print('增加删除的Log')
@@ -69,4 +129,30 @@ def append_delete_log(sender, instance, request, scope, **kwargs):
             message=getattr(instance, title_field) if title_field else repr(instance)
         )
     except:
-        logger.error('append delete log fail', exc_info=True)
\ No newline at end of file
+        logger.error('append delete log fail', exc_info=True)
+
+
+@receiver(post_bsm_create, dispatch_uid='__bump_model_version_by_save')
+def bump_model_version_by_save(sender, **kwargs):
+    """数据变更后，依赖模型数据的缓存（分页的总数、统计的结果）失效"""
+    bump_model_version(sender)
+
+
+@receiver(post_bsm_delete, dispatch_uid='__bump_model_version_by_delete')
+def bump_model_version_by_delete(sender, **kwargs):
+    bump_model_version(sender)
+
+
+@receiver(post_bsm_create, dispatch_uid='__refresh_rollups_by_save')
+def refresh_rollups_by_save(sender, instance, old_instance=None, **kwargs):
+    """数据变更后刷新所在的汇总行，修改时原来所在的汇总行也需要刷新"""
+    from api_basebone.services.rollup import refresh_instances
+
+    refresh_instances(sender, [old_instance, instance])
+
+
+@receiver(post_bsm_delete, dispatch_uid='__refresh_rollups_by_delete')
+def refresh_rollups_by_delete(sender, instance, **kwargs):
+    from api_basebone.services.rollup import refresh_instances
+
+    refresh_instances(sender, [instance])
@@ -1,22 +1,22 @@
-import copy
 import json
 import logging
 
-from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
 
 from rest_framework import permissions
 from rest_framework.decorators import action
 
-from api_basebone.core import admin, exceptions, const, gmeta
+from api_basebone.core import exceptions, const, gmeta
 
 from api_basebone.drf.response import success_response
 from api_basebone.drf.pagination import PageNumberPagination
 
 from api_basebone.restful import batch_actions
 from api_basebone.restful.const import CLIENT_END_SLUG
+from api_basebone.restful.context import get_endpoint_context
 from api_basebone.restful.mixins import FormMixin
+from api_basebone.settings import settings as basebone_settings
 from api_basebone.restful.serializers import (
     create_serializer_class,
     multiple_create_serializer_class,
@@ -25,7 +25,10 @@ from api_basebone.restful.serializers import (
 from api_basebone.utils import meta
 from api_basebone.utils import queryset as queryset_utils
 from api_basebone.utils.gmeta import get_gmeta_config_by_key
-from api_basebone.utils.operators import build_filter_conditions2
+from api_basebone.utils.operators import (
+    build_filter_conditions2,
+    compile_filter_conditions,
+)
 
 from api_basebone.restful.viewsets import BSMModelViewSet
 from api_basebone.services import rest_services
@@ -53,19 +56,11 @@ class QuerySetMixin:
         if user and user.is_staff and user.is_superuser:
             return queryset
 
-        # 检测模型中是否有字段引用了用户模型
-        has_user_field = meta.get_related_model_field(self.model, get_user_model())
-        if has_user_field:
-            # 如果有，则读取模型中 GMeta 中的配置
-            # FIXME: 注意，这里和管理端的处理逻辑暂时是不同的
-            user_field_name = get_gmeta_config_by_key(
-                self.model, gmeta.GMETA_CLIENT_USER_FIELD
-            )
-            filter_by_login_user = get_gmeta_config_by_key(
-                self.model, gmeta.GMETA_CLIENT_FILTER_BY_LOGIN_USER
-            )
-            if user_field_name and filter_by_login_user:
-                return queryset.filter(**{user_field_name: user})
+        # 模型中有字段引用了用户模型，并且 GMeta 中配置了按登录用户筛选
+        # FIXME: 注意，这里和管理端的处理逻辑暂时是不同的
+        user_field_name = self.endpoint.user_filter_field
+        if user_field_name:
+            return queryset.filter(**{user_field_name: user})
         return queryset
 
     def get_queryset_by_order_by(self, queryset):
@@ -95,7 +90,11 @@ class QuerySetMixin:
 
         filter_conditions = self.request.data.get(const.FILTER_CONDITIONS)
         if filter_conditions:
-            cons = build_filter_conditions2(filter_conditions)
+            compiled, items = compile_filter_conditions(filter_conditions, self.model)
+            join_fields = list(compiled.join_fields)
+            cons = compiled.bind(items, join_fields=join_fields)
+            # 多值关系上使用连接查询的条件会导致数据重复，需要去重
+            self.basebone_distinct_queryset = bool(join_fields)
             if cons:
                 queryset = queryset.filter(cons)
         return queryset
@@ -134,7 +133,12 @@ class QuerySetMixin:
         methods = ['filter_user', 'filter_conditions', 'order_by', 'with_tree']
         for item in methods:
             queryset = getattr(self, f'get_queryset_by_{item}')(queryset)
-        return queryset.distinct()
+        # 多值关系上的条件不使用子查询时，保持原来的行为，总是对结果集去重
+        if not basebone_settings.FILTER_TO_MANY_SUBQUERY or getattr(
+            self, 'basebone_distinct_queryset', False
+        ):
+            return queryset.distinct()
+        return queryset
 
 
 class GenericViewMixin:
@@ -167,12 +171,8 @@ class GenericViewMixin:
         self.app_label, self.model_slug = self.kwargs.get('app'), self.kwargs.get('model')
 
         # 检测模型是否合法
-        try:
-            self.model = apps.get_model(self.app_label, self.model_slug)
-        except LookupError:
-            raise exceptions.BusinessException(
-                error_code=exceptions.MODEL_SLUG_IS_INVALID
-            )
+        self.endpoint = get_endpoint_context(self.app_label, self.model_slug, self.end_slug)
+        self.model = self.endpoint.model
 
         # 检测方法是否允许访问
         model_str = f'{self.app_label}__{self.model_slug}'
@@ -189,7 +189,6 @@ class GenericViewMixin:
                 error_code=exceptions.THIS_ACTION_IS_NOT_AUTHENTICATE
             )
 
-        meta.load_custom_admin_module()
         self.get_expand_fields()
         self._get_data_with_tree(request)
 
@@ -213,46 +212,40 @@ class GenericViewMixin:
             # 详情的展开字段和列表的展开字段分开处理
             if not self.expand_fields and self.action == 'retrieve':
                 # 对于详情的展开，直接读取 admin 中的配置
-                admin_class = self.get_bsm_model_admin()
-                if admin_class:
-                    try:
-                        detail_expand_fields = getattr(
-                            admin_class, admin.BSM_DETAIL_EXPAND_FIELDS, None
-                        )
-                        if detail_expand_fields:
-                            self.expand_fields = copy.deepcopy(detail_expand_fields)
-                    except Exception:
-                        pass
+                detail_expand_fields = self.endpoint.get_detail_expand_fields()
+                if detail_expand_fields:
+                    self.expand_fields = detail_expand_fields
         elif self.action in ['create', 'update', 'custom_patch', 'partial_update']:
             self.expand_fields = self.request.data.get('__expand_fields')
 
     def _get_data_with_tree(self, request):
         """检测是否可以设置树形结构"""
         self.tree_data = None
+        self.tree_max_depth = None
+        self.tree_child_count = False
 
-        data_with_tree = False
         # 检测客户端传进来的树形数据结构的参数
         if request.method.upper() == 'GET':
-            data_with_tree = request.query_params.get(const.DATA_WITH_TREE, False)
+            params = request.query_params
         elif request.method.upper() == 'POST':
-            data_with_tree = request.data.get(const.DATA_WITH_TREE, False)
+            params = request.data
+        else:
+            params = {}
+        data_with_tree = params.get(const.DATA_WITH_TREE, False)
 
         # 如果客户端传进来的参数为真，则通过 admin 配置校验，即 admin 中有没有配置
+        # 父亲字段数据，包含字段名，related_name 和 默认值，这些数据在其他地方会用到
         if data_with_tree:
-            admin_class = self.get_bsm_model_admin()
-            if admin_class:
-                try:
-                    parent_field = getattr(admin_class, admin.BSM_PARENT_FIELD, None)
-                    if parent_field:
-                        # 获取父亲字段数据，包含字段名，related_name 和 默认值
-                        # 这些数据在其他地方会用到
-                        parent_field_data = meta.tree_parent_field(
-                            self.model, parent_field
-                        )
-                        if parent_field_data:
-                            self.tree_data = parent_field_data
-                except Exception:
-                    pass
+            self.tree_data = self.endpoint.tree_parent_field
+
+        if self.tree_data:
+            try:
+                self.tree_max_depth = int(params[const.TREE_MAX_DEPTH])
+            except (KeyError, TypeError, ValueError):
+                pass
+            self.tree_child_count = params.get(const.TREE_CHILD_COUNT) in (
+                True, 'true', '1',
+            )
 
     def translate_expand_fields(self, expand_fields):
         """转换展开字段"""
@@ -262,11 +255,11 @@ class GenericViewMixin:
             for index, value in enumerate(field_list):
                 field = model._meta.get_field(value)
                 if meta.check_field_is_reverse(field):
-                    result = meta.get_relation_field_related_name(
-                        field.related_model, field.remote_field.name
+                    related_name = meta.get_model_index(model).accessor_names.get(
+                        field.name
                     )
-                    if result:
-                        field_list[index] = result[0]
+                    if related_name:
+                        field_list[index] = related_name
                 if field.is_relation:
                     model = field.related_model
             expand_fields[out_index] = '.'.join(field_list)
@@ -280,7 +273,7 @@ class GenericViewMixin:
 
         - 如果是展开字段，这里做好是否关联查询
         """
-        managers = get_gmeta_config_by_key(self.model, gmeta.GMETA_MANAGERS)
+        managers = self.endpoint.managers
         if managers and 'client_api' in managers:
             objects = getattr(self.model, managers['client_api'], self.model.objects)
         else:
@@ -294,18 +287,15 @@ class GenericViewMixin:
             field_list = [item.replace('.', '__') for item in expand_fields]
             queryset = queryset.prefetch_related(*field_list)
 
-        filter_fields = set()
-
-        def add_filter_fields(cons):
-            for con in cons:
-                if 'field' in con:
-                    filter_fields.add(con['field'])
-                if 'children' in con:
-                    add_filter_fields(con['children'])
-
-        add_filter_fields(self.request.data.get(const.FILTER_CONDITIONS, []))
+        # 客户端只使用过滤条件和排序中的注解字段
+        annotated_fields = queryset_utils.get_used_annotated_fields(
+            self.model,
+            display_fields=[],
+            conditions=self.request.data.get(const.FILTER_CONDITIONS),
+            order_by=self.request.data.get(const.ORDER_BY_FIELDS),
+        )
         queryset = queryset_utils.annotate(
-            queryset, filter_fields, context={'user': self.request.user}
+            queryset, annotated_fields, context={'user': self.request.user}
         )
 
         return self._get_queryset(queryset)
@@ -0,0 +1,136 @@
+"""
+模型接口的上下文
+
+每个请求都要解析模型、读取 admin 类、角色配置、GMeta 配置，检测模型是否引用了用户
+模型等，这些数据只和代码中的配置有关。按 (应用, 模型, 端) 计算一次后在管理端和客户端
+的视图中共享，请求中只处理和当前用户相关的部分
+"""
+
+import copy
+from collections import namedtuple
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+
+from api_basebone.core import admin, exceptions, gmeta
+from api_basebone.core.admin import BSMAdminModule
+from api_basebone.restful.const import MANAGE_END_SLUG
+from api_basebone.settings import settings as basebone_settings
+from api_basebone.utils import meta, module
+from api_basebone.utils.cache import LRUCache
+from api_basebone.utils.gmeta import get_gmeta_config_by_key
+
+# 模型接口上下文的缓存，admin 模块重新注册后整体失效
+endpoint_context_cache = LRUCache(
+    maxsize=basebone_settings.ENDPOINT_CONTEXT_CACHE_SIZE, name='endpoint_context'
+)
+endpoint_context_cache.version = BSMAdminModule.version
+
+
+class ModelEndpointContext(
+    namedtuple(
+        'ModelEndpointContext',
+        [
+            'app_label',
+            'model_slug',
+            'end_slug',
+            'model',
+            'admin_class',
+            'role_config',
+            'user_filter_field',
+            'default_filter',
+            'detail_expand_fields',
+            'tree_parent_field',
+            'managers',
+        ],
+    )
+):
+    """模型接口的上下文，创建后不可修改
+
+    Params:
+        admin_class class admin 类，在请求间共享，需要 admin 实例时每个请求单独创建
+        role_config dict 角色配置中模型的配置，只用于管理端
+        user_filter_field str 按当前登录用户筛选数据时使用的字段，不筛选时为 None
+        default_filter tuple admin 中声明的默认过滤条件
+        detail_expand_fields list admin 中声明的详情的展开字段
+        tree_parent_field tuple 树形结构的父亲字段的数据 (字段名，related_name, 默认值)
+        managers dict GMeta 中声明的不同场景使用的 manager
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, app_label, model_slug, end_slug):
+        try:
+            model = apps.get_model(app_label, model_slug)
+        except LookupError:
+            raise exceptions.BusinessException(
+                error_code=exceptions.MODEL_SLUG_IS_INVALID
+            )
+
+        admin_class = meta.get_bsm_model_admin(model)
+
+        role_config = None
+        if end_slug == MANAGE_END_SLUG:
+            roles = getattr(
+                module.get_bsm_global_module(module.BSM_GLOBAL_MODULE_ROLES),
+                module.BSM_GLOBAL_ROLES,
+                None,
+            )
+            if isinstance(roles, dict):
+                role_config = roles.get(f'{app_label}__{model_slug}')
+
+        tree_parent_field = None
+        parent_field = getattr(admin_class, admin.BSM_PARENT_FIELD, None)
+        if parent_field:
+            try:
+                tree_parent_field = meta.tree_parent_field(model, parent_field)
+            except Exception:
+                pass
+
+        return cls(
+            app_label=app_label,
+            model_slug=model_slug,
+            end_slug=end_slug,
+            model=model,
+            admin_class=admin_class,
+            role_config=role_config,
+            user_filter_field=cls.get_user_filter_field(model, admin_class, end_slug),
+            default_filter=tuple(getattr(admin_class, admin.BSM_DEFAULT_FILTER, None) or ()),
+            detail_expand_fields=getattr(admin_class, admin.BSM_DETAIL_EXPAND_FIELDS, None),
+            tree_parent_field=tree_parent_field,
+            managers=get_gmeta_config_by_key(model, gmeta.GMETA_MANAGERS),
+        )
+
+    @staticmethod
+    def get_user_filter_field(model, admin_class, end_slug):
+        """按当前登录用户筛选数据时使用的字段
+
+        模型中有字段引用了用户模型时，管理端读取 admin 中的配置，客户端读取 GMeta 中的配置
+        """
+        if not meta.get_related_model_field(model, get_user_model()):
+            return None
+        if end_slug == MANAGE_END_SLUG:
+            field_name = getattr(admin_class, admin.BSM_AUTH_FILTER_FIELD, None)
+            enabled = getattr(admin_class, admin.BSM_FILTER_BY_LOGIN_USER, False)
+        else:
+            field_name = get_gmeta_config_by_key(model, gmeta.GMETA_CLIENT_USER_FIELD)
+            enabled = get_gmeta_config_by_key(
+                model, gmeta.GMETA_CLIENT_FILTER_BY_LOGIN_USER
+            )
+        return field_name if field_name and enabled else None
+
+    def get_detail_expand_fields(self):
+        """详情的展开字段，请求中会修改展开字段，所以返回副本"""
+        return copy.deepcopy(self.detail_expand_fields)
+
+
+def get_endpoint_context(app_label, model_slug, end_slug):
+    """获取模型接口的上下文"""
+    if endpoint_context_cache.version != BSMAdminModule.version:
+        endpoint_context_cache.clear()
+        endpoint_context_cache.version = BSMAdminModule.version
+    return endpoint_context_cache.get_or_set(
+        (app_label, model_slug, end_slug),
+        lambda: ModelEndpointContext.build(app_label, model_slug, end_slug),
+    )
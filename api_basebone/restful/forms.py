@@ -1,8 +1,10 @@
 import functools
-from django.db import IntegrityError
+from django.db import DatabaseError, IntegrityError, connections, models, router, transaction
+from django.db.models import signals
 from django.core.exceptions import ValidationError
 
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 from rest_framework.utils.model_meta import get_field_info
 from rest_framework.serializers import raise_errors_on_nested_writes
 from rest_framework.utils import model_meta
@@ -12,6 +14,7 @@ from api_basebone.core.fields import JSONField
 from jsonfield import JSONField as OriginJSONField
 from rest_framework.fields import JSONField as DrfJSONField
 from api_basebone.restful.const import CLIENT_END_SLUG, MANAGE_END_SLUG
+from api_basebone.settings import settings as basebone_settings
 from api_basebone.utils import module
 from api_basebone.utils.gmeta import get_gmeta_config_by_key
 from werkzeug import Local
@@ -28,13 +31,155 @@ compare_funcs = {
     'include': lambda a, b: b in a,
 }
 
+def can_return_bulk_pks(model):
+    """数据库批量插入后是否能返回主键"""
+    features = connections[router.db_for_write(model)].features
+    return getattr(
+        features,
+        'can_return_rows_from_bulk_insert',
+        getattr(features, 'can_return_ids_from_bulk_insert', False),
+    )
+
+
+def has_nested_writes(attrs):
+    """校验后的数据中是否包含嵌套的对象数据"""
+    for value in attrs.values():
+        if isinstance(value, dict):
+            return True
+        if isinstance(value, (list, tuple)) and any(isinstance(item, dict) for item in value):
+            return True
+    return False
+
+
+def support_bulk_write(model, form_class, action='create'):
+    """是否可以不经过表单的 create、update 和模型的 save 批量写入数据
+
+    表单自定义了 create、update，模型自定义了 save、多表继承或者监听了保存信号时，需要逐行保存
+    """
+    if action == 'create' and form_class.create is not serializers.ModelSerializer.create:
+        return False
+    if action == 'update' and form_class.update not in (
+        serializers.ModelSerializer.update,
+        form_update,
+    ):
+        return False
+    if model._meta.parents or model.save is not models.Model.save:
+        return False
+    return not (
+        signals.pre_save.has_listeners(model) or signals.post_save.has_listeners(model)
+    )
+
+
 class BulkCreateListSerializer(serializers.ListSerializer):
+    """批量创建
+
+    不包含嵌套数据的行使用 bulk_create 分批插入，多对多的中间表数据也批量插入；包含嵌套数据的
+    行，以及不支持批量写入时，逐行创建
+
+    数据库写入失败时，按行号返回错误，和表单校验的错误格式一致
+    """
+
     def create(self, validated_data):
-        result = [self.child.create(attrs) for attrs in validated_data]        
-        # self.child.Meta.model.objects.bulk_create(result, ignore_conflicts=False)
-        
+        model = self.child.Meta.model
+        info = model_meta.get_field_info(model)
+        bulk = support_bulk_write(model, type(self.child))
+        return_pks = can_return_bulk_pks(model)
+        forward_many = {field.name for field in model._meta.many_to_many}
+
+        result = [None] * len(validated_data)
+        errors = [{} for _ in validated_data]
+        bulk_rows, save_rows, many_to_many = [], [], []
+
+        with transaction.atomic():
+            for index, attrs in enumerate(validated_data):
+                many_keys = [
+                    key for key in attrs if key in info.relations and info.relations[key].to_many
+                ]
+                if not bulk or has_nested_writes(attrs) or not forward_many.issuperset(many_keys):
+                    result[index] = self.save_row(errors, index, lambda: self.child.create(attrs))
+                    continue
+
+                attrs = dict(attrs)
+                many = {key: attrs.pop(key) for key in many_keys}
+                result[index] = model(**attrs)
+                if many:
+                    many_to_many.append((index, many))
+                # 数据库不能返回主键时，有多对多数据的行需要单独插入以获得主键
+                if any(many.values()) and result[index].pk is None and not return_pks:
+                    save_rows.append(index)
+                else:
+                    bulk_rows.append(index)
+
+            batch_size = basebone_settings.BULK_CREATE_BATCH_SIZE
+            for rows, bulk_insert in ((bulk_rows, True), (save_rows, False)):
+                for start in range(0, len(rows), batch_size):
+                    self.create_batch(model, result, errors, rows[start:start + batch_size], bulk_insert)
+
+            many_to_many = [(result[index], many) for index, many in many_to_many if not errors[index]]
+            if many_to_many:
+                self.bulk_set_many_to_many(model, many_to_many)
+
+            if any(errors):
+                raise serializers.ValidationError(errors)
         return result
 
+    def save_row(self, errors, index, func):
+        """在保存点中写入一行，失败时记录错误"""
+        try:
+            with transaction.atomic():
+                return func()
+        except DatabaseError as e:
+            errors[index] = {api_settings.NON_FIELD_ERRORS_KEY: [str(e)]}
+
+    def create_batch(self, model, result, errors, indexes, bulk_insert=True):
+        """在一个保存点中写入一批数据，失败时逐行写入以找出出错的行"""
+        pks = [result[index].pk for index in indexes]
+        try:
+            with transaction.atomic():
+                if bulk_insert:
+                    model._default_manager.bulk_create([result[index] for index in indexes])
+                else:
+                    for index in indexes:
+                        result[index].save(force_insert=True)
+        except DatabaseError:
+            for index, pk in zip(indexes, pks):
+                result[index].pk = pk
+                self.save_row(errors, index, functools.partial(result[index].save, force_insert=True))
+
+    def bulk_set_many_to_many(self, model, rows):
+        """批量写入多对多的中间表数据
+
+        Params:
+            rows list 元素为 (数据对象, {字段名: 关联的数据列表})
+        """
+        batch_size = basebone_settings.BULK_CREATE_BATCH_SIZE
+        for field in model._meta.many_to_many:
+            through = field.remote_field.through
+            if signals.m2m_changed.has_listeners(through):
+                for instance, many in rows:
+                    if field.name in many:
+                        getattr(instance, field.name).set(many[field.name])
+                continue
+
+            source = through._meta.get_field(field.m2m_field_name())
+            target = through._meta.get_field(field.m2m_reverse_field_name())
+            links = []
+            for instance, many in rows:
+                source_value = getattr(instance, source.target_field.attname)
+                values = []
+                for value in many.get(field.name) or []:
+                    if isinstance(value, models.Model):
+                        value = getattr(value, target.target_field.attname)
+                    if value not in values:
+                        values.append(value)
+                links += [
+                    through(**{source.attname: source_value, target.attname: value})
+                    for value in values
+                ]
+            if links:
+                through._default_manager.bulk_create(links, batch_size=batch_size)
+
+
 def validate_condition_required(
     data, field=[], condition_field=None, operator=None, value=None
 ):
@@ -145,6 +290,25 @@ def simple_support_m2m_field_specify_through_model(func):
     return wrapper
 
 
+def form_update(self, instance, validated_data):
+    """默认表单的更新，多对多字段在 rfum_append 中时添加关联而不是重置"""
+    raise_errors_on_nested_writes('update', self, validated_data)
+    info = model_meta.get_field_info(instance)
+
+    for attr, value in validated_data.items():
+        if attr in info.relations and info.relations[attr].to_many:
+            field = getattr(instance, attr)
+            if rfu_modes.append and attr in rfu_modes.append:
+                field.add(value)
+            else:
+                field.set(value)
+        else:
+            setattr(instance, attr, value)
+    instance.save()
+
+    return instance
+
+
 @simple_support_m2m_field_specify_through_model
 def create_form_class(model, exclude_fields=None, **kwargs):
     """构建序列化类"""
@@ -157,27 +321,10 @@ def create_form_class(model, exclude_fields=None, **kwargs):
         self.serializer_field_mapping[OriginJSONField] = DrfJSONField
         super(serializers.ModelSerializer, self).__init__(*args, **kwargs)
 
-    def update(self, instance, validated_data):
-        raise_errors_on_nested_writes('update', self, validated_data)
-        info = model_meta.get_field_info(instance)
-
-        for attr, value in validated_data.items():
-            if attr in info.relations and info.relations[attr].to_many:
-                field = getattr(instance, attr)
-                if rfu_modes.append and attr in rfu_modes.append:
-                    field.add(value)
-                else:
-                    field.set(value)
-            else:
-                setattr(instance, attr, value)
-        instance.save()
-
-        return instance
-
     attrs = {
         'Meta': create_meta_class(model, exclude_fields=None), 
         '__init__': __init__,
-        'update': update
+        'update': form_update
     }
     attrs.update(kwargs)
 
@@ -17,7 +17,7 @@ from api_basebone.export.admin import get_app_admin_config, get_json_field_admin
 from api_basebone.export.fields import get_app_field_schema, get_app_json_field_schema
 from api_basebone.export.setting import get_settins, get_setting_config
 from api_basebone.utils import module
-from api_basebone.utils.meta import load_custom_admin_module, get_export_apps
+from api_basebone.utils.meta import get_export_apps
 from bsm_config.models import Menu, Admin
 from api_basebone.utils import queryset as queryset_utils
 from api_basebone.drf.permissions import IsAdminUser
@@ -26,20 +26,14 @@ from api_basebone.drf.permissions import IsAdminUser
 class ConfigViewSet(viewsets.GenericViewSet):
     """读取配置接口"""
 
-    def _load_bsm_admin_module(self):
-        """加载 bsm admin 模块"""
-        load_custom_admin_module()
-
     @action(detail=False, url_path='schema', permission_classes = (IsAdminUser,))
     def get_schema(self, request, *args, **kwargs):
         """获取 schema 配置"""
-        self._load_bsm_admin_module()
         data = get_app_field_schema()
         return success_response(data)
 
     @action(detail=False, url_path='admin', permission_classes = (IsAdminUser,))
     def get_admin(self, request, *args, **kwargs):
-        self._load_bsm_admin_module()
         """获取 admin 配置"""
         data = get_app_admin_config()
         return success_response(data)
@@ -59,7 +53,6 @@ class ConfigViewSet(viewsets.GenericViewSet):
     def get_all(self, request, *args, **kargs):
         """获取所有的客户端配置，包括schema, admin
         """
-        self._load_bsm_admin_module()
         data = {
             'schemas': get_app_field_schema(),
             'admins': get_app_admin_config()
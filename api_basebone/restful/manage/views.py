@@ -16,6 +16,7 @@ from api_basebone.drf.response import success_response
 # from api_basebone.export.fields import get_attr_in_gmeta_class
 from api_basebone.restful import batch_actions, renderers, renderers_v2
 from api_basebone.restful.const import MANAGE_END_SLUG
+from api_basebone.restful.context import get_endpoint_context
 from api_basebone.restful.mixins import (
     CheckValidateMixin,
     GroupStatisticsMixin,
@@ -30,11 +31,12 @@ from api_basebone.restful.serializers import (
 
 from api_basebone.utils import meta, module as basebone_module
 from api_basebone.utils.data import get_prefetch_fields_from_export_fields
-from api_basebone.utils.operators import build_filter_conditions2
+from api_basebone.utils.operators import compile_filter_conditions
 from api_basebone.restful.mixins import FormMixin
 from api_basebone.restful.viewsets import BSMModelViewSet
 
 from api_basebone.services import rest_services
+from api_basebone.utils import guardian
 from api_basebone.utils import queryset as queryset_utils
 
 from .user_pip import add_login_user_data
@@ -51,21 +53,7 @@ class QuerySetMixin:
 
     def basebone_get_model_role_config(self):
         """获取角色配置"""
-        if self.model_role_config is not None:
-            return self.model_role_config
-
-        role_config = getattr(
-            basebone_module.get_bsm_global_module(
-                basebone_module.BSM_GLOBAL_MODULE_ROLES
-            ),
-            basebone_module.BSM_GLOBAL_ROLES,
-            None,
-        )
-
-        key_prefix = f'{self.app_label}__{self.model_slug}'
-        if isinstance(role_config, dict):
-            self.model_role_config = role_config.get(key_prefix)
-        return self.model_role_config
+        return self.endpoint.role_config
 
     def get_queryset_by_filter_user(self, queryset):
         """通过用户过滤对应的数据集
@@ -88,22 +76,10 @@ class QuerySetMixin:
             if role_config.get(config_key):
                 return queryset
 
-        # 检测模型中是否有字段引用了用户模型
-        has_user_field = meta.get_related_model_field(self.model, get_user_model())
-        if has_user_field:
-            admin_class = self.get_bsm_model_admin()
-            if admin_class:
-                # 检测 admin 配置中是否指定了 auth_filter_field 属性
-                try:
-                    field_name = getattr(admin_class, admin.BSM_AUTH_FILTER_FIELD, None)
-                    filter_by_login_user = getattr(
-                        admin_class, admin.BSM_FILTER_BY_LOGIN_USER, False
-                    )
-
-                    if field_name and filter_by_login_user:
-                        return queryset.filter(**{field_name: user})
-                except Exception:
-                    pass
+        # 模型中有字段引用了用户模型，并且 admin 配置中指定了 auth_filter_field 属性
+        field_name = self.endpoint.user_filter_field
+        if field_name:
+            return queryset.filter(**{field_name: user})
         return queryset
 
     def get_queryset_by_order_by(self, queryset):
@@ -124,6 +100,15 @@ class QuerySetMixin:
         if role_config and isinstance(role_config, dict):
             return role_config.get('filters')
 
+    def get_filter_context(self):
+        """过滤条件中表达式求值的上下文
+
+        同一个请求中使用同一个上下文，结果集类型的表达式的查询结果会保存在其中
+        """
+        if not hasattr(self, '_basebone_filter_context'):
+            self._basebone_filter_context = {'user': self.request.user}
+        return self._basebone_filter_context
+
     def get_queryset_by_filter_conditions(self, queryset):
         """
         用于检测客户端传入的过滤条件
@@ -156,12 +141,7 @@ class QuerySetMixin:
         if self.action in ['update', 'partial_update', 'custom_patch']:
             filter_conditions = []
 
-        admin_class = self.get_bsm_model_admin()
-        if admin_class:
-            default_filter = getattr(admin_class, admin.BSM_DEFAULT_FILTER, None)
-            default_filter = default_filter
-            if default_filter:
-                filter_conditions += default_filter
+        filter_conditions += self.endpoint.default_filter
 
         if role_filters:
             filter_conditions += role_filters
@@ -169,20 +149,12 @@ class QuerySetMixin:
         # 这里做个动作 1 校验过滤条件中的字段，是否需要对结果集去重 2 组装过滤条件
         if filter_conditions:
             # TODO: 这里没有做任何的检测，需要加上检测
-            fields = set()
-
-            def tree_check(cond):
-                for c in cond:
-                    if 'children' in c:
-                        tree_check(c['children'])
-                    else:
-                        fields.add(c['field'])
-
-            tree_check(filter_conditions)
-            self.basebone_check_distinct_queryset(list(fields))
-            cons = build_filter_conditions2(
-                filter_conditions, context={'user': self.request.user}
+            compiled, items = compile_filter_conditions(filter_conditions, self.model)
+            join_fields = list(compiled.join_fields)
+            cons = compiled.bind(
+                items, context=self.get_filter_context(), join_fields=join_fields
             )
+            self.basebone_check_distinct_queryset(join_fields)
 
             if cons:
                 queryset = queryset.filter(cons)
@@ -226,20 +198,9 @@ class GenericViewMixin:
         # 是否对结果集进行去重
         self.basebone_distinct_queryset = False
 
-        # 模型角色配置
-        self.model_role_config = None
-
         self.app_label, self.model_slug = self.kwargs.get('app'), self.kwargs.get('model')
-
-        try:
-            self.model = apps.get_model(self.app_label, self.model_slug)
-        except LookupError:
-            raise exceptions.BusinessException(
-                error_code=exceptions.MODEL_SLUG_IS_INVALID
-            )
-
-        # 加载 admin 配置
-        meta.load_custom_admin_module()
+        self.endpoint = get_endpoint_context(self.app_label, self.model_slug, self.end_slug)
+        self.model = self.endpoint.model
 
         if self.action == 'export_file':
             admin_class = self.get_bsm_model_admin()
@@ -285,12 +246,10 @@ class GenericViewMixin:
                         self.model_slug = self._export_type_config['model_slug']
 
                         # 检测模型是否合法
-                        try:
-                            self.model = apps.get_model(self.app_label, self.model_slug)
-                        except LookupError:
-                            raise exceptions.BusinessException(
-                                error_code=exceptions.MODEL_SLUG_IS_INVALID
-                            )
+                        self.endpoint = get_endpoint_context(
+                            self.app_label, self.model_slug, self.end_slug
+                        )
+                        self.model = self.endpoint.model
                 else:
                     if request.method.lower() == 'get':
                         if 'basebone_export_config' in list(dict(request.query_params)):
@@ -404,6 +363,7 @@ class GenericViewMixin:
             'update': ['view', 'change'],
             'partial_update': ['view', 'change'],
             'destroy': ['view', 'delete'],
+            'upsert': ['view', 'add', 'change'],
         }
         perm_list = [
             f'{item}_{self.model_slug}' for item in perm_map.get(self.action, [])
@@ -433,17 +393,9 @@ class GenericViewMixin:
             # 详情的展开字段和列表的展开字段分开处理
             if self.expand_fields is None and self.action == 'retrieve':
                 # 对于详情的展开，直接读取 admin 中的配置
-                admin_class = self.get_bsm_model_admin()
-                if admin_class:
-                    try:
-                        detail_expand_fields = getattr(
-                            admin_class, admin.BSM_DETAIL_EXPAND_FIELDS, None
-                        )
-                        detail_expand_fields = copy.deepcopy(detail_expand_fields)
-                        if detail_expand_fields:
-                            self.expand_fields = detail_expand_fields
-                    except Exception:
-                        pass
+                detail_expand_fields = self.endpoint.get_detail_expand_fields()
+                if detail_expand_fields:
+                    self.expand_fields = detail_expand_fields
         elif self.action == 'export_file':
             # FIXME: 如果不是新版导出，则直接从导出配置中识别出扩展字段
             if self._export_type_config.get('version') != 'v2':
@@ -465,30 +417,31 @@ class GenericViewMixin:
         if isinstance(request.data, list):
             return
         self.tree_data = None
+        self.tree_max_depth = None
+        self.tree_child_count = False
 
-        data_with_tree = False
         # 检测客户端传进来的树形数据结构的参数
         if request.method.upper() == 'GET':
-            data_with_tree = request.query_params.get(const.DATA_WITH_TREE, False)
+            params = request.query_params
         elif request.method.upper() == 'POST':
-            data_with_tree = request.data.get(const.DATA_WITH_TREE, False)
+            params = request.data
+        else:
+            params = {}
+        data_with_tree = params.get(const.DATA_WITH_TREE, False)
 
         # 如果客户端传进来的参数为真，则通过 admin 配置校验，即 admin 中有没有配置
+        # 父亲字段数据，包含字段名，related_name 和 默认值，这些数据在其他地方会用到
         if data_with_tree:
-            admin_class = self.get_bsm_model_admin()
-            if admin_class:
-                try:
-                    parent_field = getattr(admin_class, admin.BSM_PARENT_FIELD, None)
-                    if parent_field:
-                        # 获取父亲字段数据，包含字段名，related_name 和 默认值
-                        # 这些数据在其他地方会用到
-                        parent_field_data = meta.tree_parent_field(
-                            self.model, parent_field
-                        )
-                        if parent_field_data:
-                            self.tree_data = parent_field_data
-                except Exception:
-                    pass
+            self.tree_data = self.endpoint.tree_parent_field
+
+        if self.tree_data:
+            try:
+                self.tree_max_depth = int(params[const.TREE_MAX_DEPTH])
+            except (KeyError, TypeError, ValueError):
+                pass
+            self.tree_child_count = params.get(const.TREE_CHILD_COUNT) in (
+                True, 'true', '1',
+            )
 
     def translate_expand_fields(self, expand_fields):
         """转换展开字段"""
@@ -498,11 +451,11 @@ class GenericViewMixin:
             for index, value in enumerate(field_list):
                 field = model._meta.get_field(value)
                 if meta.check_field_is_reverse(field):
-                    result = meta.get_relation_field_related_name(
-                        field.related_model, field.remote_field.name
+                    related_name = meta.get_model_index(model).accessor_names.get(
+                        field.name
                     )
-                    if result:
-                        field_list[index] = result[0]
+                    if related_name:
+                        field_list[index] = related_name
                 if field.is_relation:
                     model = field.related_model
             expand_fields[out_index] = '.'.join(field_list)
@@ -511,14 +464,42 @@ class GenericViewMixin:
     def get_display_fields(self):
         return self.request.data.get(const.DISPLAY_FIELDS)
 
+    def get_used_annotated_fields(self):
+        """获取请求中用到的注解字段
+
+        显示字段、过滤条件、排序字段和统计字段中用到的注解字段才会加到结果集中
+        """
+        conditions = list(self.request.data.get(const.FILTER_CONDITIONS) or [])
+        conditions += self.endpoint.default_filter
+        conditions += self.get_user_role_filters() or []
+
+        fields = []
+        display_fields = self.get_display_fields() or None
+        if self.action == 'statistics':
+            # 统计只用到统计的字段
+            display_fields = []
+            configs = self.request.data.get('fields') or self.basebone_get_statistics_config()
+            for key, value in (configs or {}).items():
+                if isinstance(value, dict):
+                    fields.append(value.get('field') or key)
+
+        return queryset_utils.get_used_annotated_fields(
+            self.model,
+            display_fields=display_fields,
+            conditions=conditions,
+            order_by=self.request.data.get(const.ORDER_BY_FIELDS),
+            fields=fields,
+        )
+
     def get_queryset(self):
         """动态的计算结果集
 
         - 如果是展开字段，这里做好是否关联查询
         - 如果 bsm admin 定义了 get_queryset 方法，贼继续使用 get_queryset 进行处理
         """
+        # admin 实例每个请求单独创建，get_queryset 中保存的状态不会在请求、线程间共享
+        admin_class = self.endpoint.admin_class
         admin_get_queryset = None
-        admin_class = self.get_bsm_model_admin()
         if admin_class:
             admin_get_queryset = getattr(admin_class(), 'get_queryset', None)
 
@@ -533,7 +514,9 @@ class GenericViewMixin:
             display_fields = self.get_display_fields()
             queryset = queryset_utils.queryset_prefetch(queryset, expand_dict, context, display_fields=display_fields)
         if self.action not in ['get_chart', 'group_statistics']:
-            queryset = queryset_utils.annotate(queryset, context=context)
+            queryset = queryset_utils.annotate(
+                queryset, fields=self.get_used_annotated_fields(), context=context
+            )
         queryset = self._get_queryset(queryset)
 
         if admin_get_queryset:
@@ -552,35 +535,7 @@ class GenericViewMixin:
             check_action = self.action in ['retrieve', 'list', 'set']
 
             if check_not_is_superuser and check_action and check_model:
-                from guardian.ctypes import get_content_type
-                from guardian.models import UserObjectPermission, GroupObjectPermission
-                from django.contrib.auth.models import Permission
-
-                content_type = get_content_type(self.model)
-                permission = Permission.objects.filter(
-                    codename=f'view_{self.model_slug}', content_type=content_type
-                ).first()
-
-                content_object_set = set()
-
-                # 如果存在对应的权限
-                if permission:
-                    permission_object_list = UserObjectPermission.objects.filter(
-                        user=self.request.user, permission=permission
-                    ).values('object_pk')
-                    for item in permission_object_list:
-                        content_object_set.add(item['object_pk'])
-
-                user_groups = self.request.user.groups.all()
-                if user_groups:
-                    group_object_list = GroupObjectPermission.objects.filter(
-                        permission=permission, group__in=user_groups
-                    ).values('object_pk')
-                    for item in group_object_list:
-                        content_object_set.add(item['object_pk'])
-
-                if content_object_set:
-                    queryset = queryset.filter(id__in=content_object_set)
+                queryset = guardian.filter_granted_objects(queryset, self.request.user)
         return queryset
 
     def get_serializer_class(self, expand_fields=None):
@@ -682,6 +637,24 @@ class CommonManageViewSet(
         serializer.handle()
         return success_response()
 
+    @action(methods=['POST'], detail=False, url_path='upsert')
+    def upsert(self, request, app, model, **kwargs):
+        """
+        ## 按冲突字段批量新增或者更新
+
+        ```python
+        {
+            conflict_fields: 冲突字段的列表，需要是模型中的一个唯一约束,
+            data: 数据的列表,
+        }
+        ```
+
+        冲突字段的值已经存在的数据使用更新表单部分更新，其他的数据使用创建表单新增，
+
+        返回新增、更新和没有变化的数据量 {created, updated, unchanged}
+        """
+        return rest_services.manage_upsert(self, request, request.data)
+
     @action(methods=['get', 'post'], detail=False, url_path='export/file')
     def export_file(self, request, *args, **kwargs):
         """输出 excel 和 excel 文件
@@ -1,8 +1,20 @@
 from functools import partial
+import json
 import logging
 
 import pytz
-from django.db.models import Sum, Count, Value, F, Avg, Max, Min
+from django.core.cache import cache
+from django.db.models import (
+    Sum,
+    Count,
+    Value,
+    F,
+    Avg,
+    Max,
+    Min,
+    IntegerField,
+    Subquery,
+)
 from django.db.models.fields.related import (
     ManyToManyField,
     ManyToManyRel,
@@ -23,12 +35,19 @@ from api_basebone.utils.meta import get_all_relation_fields
 from api_basebone.utils.meta import get_bsm_model_admin
 from api_basebone.models import AdminLog
 from api_basebone.settings import settings as basebone_settings
+from api_basebone.services import rollup
 from api_basebone.services.expresstion import resolve_expression
 from .forms import get_form_class
 from api_basebone.utils.operators import build_filter_conditions2
+from api_basebone.utils.cache import get_model_cache_key, get_or_refresh
 
 log = logging.getLogger(__name__)
 
+# 统计结果的缓存的键的前缀
+STATISTICS_CACHE_PREFIX = 'basebone_statistics'
+# 图表数据的缓存的键的前缀
+CHART_CACHE_PREFIX = 'basebone_chart'
+
 
 class CheckValidateMixin:
     """检测校验"""
@@ -160,14 +179,68 @@ class StatisticsMixin:
         if not aggregates and not relation_aggregates:
             return success_response({})
 
-        result = queryset.aggregate(**aggregates)
-        self.basebone_origin_queryset.query.annotations.clear()
-        relation_result = self.basebone_origin_queryset.aggregate(
-            **relation_aggregates)
+        origin_queryset = self.basebone_origin_queryset.all()
+        origin_queryset.query.annotations.clear()
+
+        timeout = basebone_settings.STATISTICS_CACHE_TIMEOUT
+        if not timeout:
+            return success_response(
+                self.basebone_aggregate_statistics(
+                    queryset, origin_queryset, aggregates, relation_aggregates
+                )
+            )
 
-        result.update(relation_result)
+        # 过滤条件、角色的过滤条件最终都体现在 SQL 中，和统计的配置一起作为缓存的标识
+        key = get_model_cache_key(
+            STATISTICS_CACHE_PREFIX,
+            self.model,
+            queryset.db,
+            queryset.query.sql_with_params(),
+            origin_queryset.query.sql_with_params(),
+            json.dumps(configs, sort_keys=True, default=str),
+        )
+        result = cache.get(key)
+        if result is None:
+            result = self.basebone_aggregate_statistics(
+                queryset, origin_queryset, aggregates, relation_aggregates
+            )
+            cache.set(key, result, timeout)
         return success_response(result)
 
+    def basebone_aggregate_statistics(
+        self, queryset, origin_queryset, aggregates, relation_aggregates
+    ):
+        """在一条 SQL 中计算统计数据
+
+        关系字段的统计在原始的结果集上计算，避免去重后的子查询影响结果，作为标量子查询
+        合并到主查询中。去重的结果集上 Django 无法在聚合中使用子查询，分两条 SQL 计算
+
+        Params:
+            queryset QuerySet 用于统计非关系字段的结果集
+            origin_queryset QuerySet 用于统计关系字段的结果集，已去掉注解
+            aggregates dict 非关系字段的统计
+            relation_aggregates dict 关系字段的统计
+        """
+        if not relation_aggregates:
+            return queryset.aggregate(**aggregates)
+        if not aggregates:
+            return origin_queryset.aggregate(**relation_aggregates)
+        if queryset.query.distinct:
+            result = queryset.aggregate(**aggregates)
+            result.update(origin_queryset.aggregate(**relation_aggregates))
+            return result
+
+        # 使用常量分组，子查询只有一行，结果集为空时也会返回统计的结果
+        origin_queryset = origin_queryset.order_by().annotate(
+            _basebone_one=Value(1, IntegerField())
+        ).values('_basebone_one')
+        for key, condition in relation_aggregates.items():
+            subquery = origin_queryset.annotate(**{key: condition}).values(key)
+            aggregates[key] = Coalesce(
+                Max(Subquery(subquery, output_field=condition.output_field)), Value(0)
+            )
+        return queryset.aggregate(**aggregates)
+
 
 class GroupStatisticsMixin:
     """获取统计数据"""
@@ -209,9 +282,12 @@ class GroupStatisticsMixin:
 
         return data
 
-    def group_statistics_data(self, fields, group_kwargs, *args, **kwargs):
+    def group_statistics_data(self, fields, group_kwargs, *args, queryset=None, **kwargs):
         """
         分组统计
+
+        Params:
+            queryset queryset 统计的结果集，不指定时使用接口的结果集
         """
         methods = {
             'sum': Sum,
@@ -225,9 +301,22 @@ class GroupStatisticsMixin:
         }
         log.debug(
             f'static parameters, fields: {fields}, groups: {group_kwargs}')
-        queryset = (
-            self.get_queryset().annotate(**group_kwargs).values(*group_kwargs.keys())
-        )
+        # 排除exclude_fields
+        exclude_fields = get_model_exclude_fields(self.model, None)
+        fields = {
+            key: value
+            for key, value in fields.items()
+            if value['field'] not in exclude_fields
+        }
+        if queryset is None:
+            queryset = self.get_queryset()
+
+        # 模型声明了可以使用的汇总时，直接读取汇总表
+        data = rollup.read_group_statistics(queryset, fields, group_kwargs, **kwargs)
+        if data is not None:
+            return data
+
+        queryset = queryset.annotate(**group_kwargs).values(*group_kwargs.keys())
         result = queryset.annotate(
             **{
                 key: methods[value.get('method', None)](
@@ -235,8 +324,6 @@ class GroupStatisticsMixin:
                     distinct=value.get('distinct', False),
                 )
                 for key, value in fields.items()
-                # 排除exclude_fields
-                if value['field'] not in get_model_exclude_fields(self.model, None)
             }
         ).order_by(*group_kwargs.keys())
         # 支持排序
@@ -276,7 +363,6 @@ class GroupStatisticsMixin:
     def get_chart(self, request, *args, **kwargs):
         log.debug(f'get_chart action: {self.action}')
         from chart.models import Chart
-        from django.core.cache import cache
 
         id = request.data['id']
         chart = cache.get(f'chart_config:{id}', None)
@@ -317,12 +403,45 @@ class GroupStatisticsMixin:
             {'field': ft.field, 'operator': ft.operator, 'value': ft.value}
             for ft in chart.chart_filters.all()
         ]
-        data = self.group_statistics_data(
-            fields,
-            group_kwargs,
-            sort_keys=chart.sort_keys,
-            top_max=chart.top_max,
-            filters=filters,
+        queryset = self.get_queryset()
+
+        def get_data():
+            return list(
+                self.group_statistics_data(
+                    fields,
+                    group_kwargs,
+                    queryset=queryset,
+                    sort_keys=chart.sort_keys,
+                    top_max=chart.top_max,
+                    filters=filters,
+                )
+            )
+
+        timeout = getattr(chart, 'cache_timeout', None)
+        if timeout is None:
+            timeout = basebone_settings.CHART_CACHE_TIMEOUT
+        if not timeout:
+            return success_response(get_data())
+
+        # 角色的过滤条件、当前用户的过滤条件最终都体现在 SQL 中，和图表的配置一起作为标识，
+        # 键中包含模型数据的版本号，数据变更后失效
+        key = get_model_cache_key(
+            CHART_CACHE_PREFIX,
+            self.model,
+            id,
+            queryset.db,
+            queryset.query.sql_with_params(),
+            json.dumps(
+                [group, fields, filters, chart.sort_keys, chart.top_max],
+                sort_keys=True,
+                default=str,
+            ),
+        )
+        data = get_or_refresh(
+            key,
+            get_data,
+            timeout,
+            basebone_settings.CHART_CACHE_STALE_TIMEOUT,
         )
         return success_response(data)
 
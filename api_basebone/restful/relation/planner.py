@@ -0,0 +1,213 @@
+"""
+嵌套数据的批量写入
+
+嵌套的关系数据逐条处理时，每条数据都要按主键查询一次、校验时关系字段的每个值查询一次，
+再单独保存，数据量大时查询数量和数据量成正比。这里分为两步：
+
+- 先遍历数据，按模型收集主键，每个模型使用一次 pk__in 查询
+- 再用共享的表单逐条校验，校验通过后分组执行 bulk_create、bulk_update
+
+包含多对多、反向关系数据的行，以及表单、模型不支持批量写入时，仍然逐条保存。校验失败或者
+批量写入违反数据库约束时，回滚后按原来的方式逐条校验和保存，保证结果和错误信息和原来一致
+"""
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from rest_framework import serializers
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField
+
+from api_basebone.restful.forms import can_return_bulk_pks, support_bulk_write
+from api_basebone.settings import settings as basebone_settings
+from api_basebone.utils import meta
+
+
+def to_pk(model, value):
+    """转换为主键的值，不合法时返回 None"""
+    try:
+        return model._meta.pk.to_python(value)
+    except (ValidationError, TypeError, ValueError):
+        return None
+
+
+def get_instances(queryset, values):
+    """一次查询多个主键对应的数据
+
+    Params:
+        queryset 模型类的查询集
+        values list 主键的值，不合法的值会被忽略
+
+    Returns:
+        dict 主键和数据对象的映射
+    """
+    pks = {pk for pk in (to_pk(queryset.model, value) for value in values) if pk is not None}
+    if not pks:
+        return {}
+    return queryset.in_bulk(list(pks))
+
+
+def get_instance(model, instances, value):
+    """从查询的结果中获取主键对应的数据，没有时单独查询"""
+    pk = to_pk(model, value)
+    if pk in instances:
+        return instances[pk]
+    return model.objects.filter(**{model._meta.pk.name: value}).first()
+
+
+def get_relation_fields(serializer):
+    """表单中可写的主键关系字段，元素为 (字段名, 主键关系字段)"""
+    for name, field in serializer.fields.items():
+        if field.read_only:
+            continue
+        relation = field.child_relation if isinstance(field, ManyRelatedField) else field
+        if isinstance(relation, PrimaryKeyRelatedField) and relation.pk_field is None:
+            yield name, relation
+
+
+def prefetch_relation_values(forms, rows):
+    """一次查询表单中关系字段在所有行中引用的数据
+
+    关系字段校验每个值时都会查询一次，这里按字段收集所有行中的值一次查询出来，查询不到的
+    值仍然由字段自己校验，错误信息不变
+
+    Params:
+        forms list 同一个表单类的表单实例
+        rows list 数据的列表
+    """
+    relations = {}
+    for form in forms:
+        for name, relation in get_relation_fields(form):
+            relations.setdefault(name, []).append(relation)
+
+    for name, fields in relations.items():
+        values = []
+        for row in rows:
+            value = row.get(name)
+            values += value if isinstance(value, list) else [value]
+        values = [value for value in values if isinstance(value, (int, str))]
+        if not values:
+            continue
+
+        queryset = fields[0].get_queryset()
+        instances = get_instances(queryset, values)
+        if not instances:
+            continue
+        for relation in fields:
+            relation.to_internal_value = get_cached_lookup(
+                queryset.model, instances, relation.to_internal_value
+            )
+
+
+def get_cached_lookup(model, instances, to_internal_value):
+    def lookup(data):
+        if isinstance(data, (int, str)):
+            pk = to_pk(model, data)
+            if pk in instances:
+                return instances[pk]
+        return to_internal_value(data)
+
+    return lookup
+
+
+def has_reverse_data(model, data):
+    return any(field.name in data for field in meta.get_reverse_fields(model))
+
+
+def save_items(model, serializer_class, items, instances=None, require_pk=False, callback=None):
+    """校验并保存多条数据
+
+    Params:
+        model class 模型类
+        serializer_class class 表单类
+        items list 数据的列表
+        instances list 和数据对应的已有的数据对象，新建的数据为 None
+        require_pk bool 新建的数据保存后是否需要主键
+        callback function 逐条保存的数据保存后的处理，参数为 (数据, 数据对象)
+
+    Returns:
+        list 保存后的数据对象，不需要主键时批量新建的数据对象可能没有主键
+    """
+    if instances is None:
+        instances = [None] * len(items)
+    try:
+        with transaction.atomic():
+            return BatchWriter(model, serializer_class, require_pk, callback).save(items, instances)
+    except (IntegrityError, serializers.ValidationError):
+        # 批量写入违反约束，或者校验依赖前面的数据写入后的结果时，按原来的方式逐条校验和保存，
+        # 由表单或者数据库给出和原来一致的错误
+        result = []
+        for item, instance in zip(items, instances):
+            serializer = serializer_class(instance=instance, data=item, partial=instance is not None)
+            serializer.is_valid(raise_exception=True)
+            obj = serializer.save()
+            if callback:
+                callback(item, obj)
+            result.append(obj)
+        return result
+
+
+class BatchWriter:
+    """使用共享的表单校验多条数据，分组批量新建和更新"""
+
+    def __init__(self, model, serializer_class, require_pk=False, callback=None):
+        self.model = model
+        self.create_form = serializer_class()
+        self.update_form = serializer_class(partial=True)
+        self.bulk_create = support_bulk_write(model, serializer_class)
+        self.bulk_update = support_bulk_write(model, serializer_class, 'update')
+        self.require_pk = require_pk and not can_return_bulk_pks(model)
+        self.callback = callback
+        self.many_to_many = {field.name for field in model._meta.many_to_many}
+
+    def validate(self, items, instances):
+        forms = [self.create_form, self.update_form]
+        prefetch_relation_values(forms, [item for item in items if isinstance(item, dict)])
+
+        result = []
+        for item, instance in zip(items, instances):
+            form = self.create_form if instance is None else self.update_form
+            form.instance = instance
+            result.append(form.run_validation(item))
+        return result
+
+    def can_bulk_write(self, item, instance, attrs):
+        if self.many_to_many.intersection(attrs) or has_reverse_data(self.model, item):
+            return False
+        if instance is not None:
+            return self.bulk_update
+        return self.bulk_create and not self.require_pk
+
+    def save(self, items, instances):
+        validated_data = self.validate(items, instances)
+
+        result, creates, updates = [], [], []
+        for item, instance, attrs in zip(items, instances, validated_data):
+            if not self.can_bulk_write(item, instance, attrs):
+                if instance is None:
+                    obj = self.create_form.create(attrs)
+                else:
+                    obj = self.update_form.update(instance, attrs)
+                if self.callback:
+                    self.callback(item, obj)
+            elif instance is None:
+                obj = self.model(**attrs)
+                creates.append(obj)
+            else:
+                for name, value in attrs.items():
+                    setattr(instance, name, value)
+                obj = instance
+                updates.append(obj)
+            result.append(obj)
+
+        batch_size = basebone_settings.BULK_CREATE_BATCH_SIZE
+        if creates:
+            self.model.objects.bulk_create(creates, batch_size=batch_size)
+        if updates:
+            # 和 save 一样更新所有的字段，自动更新的时间等字段由 pre_save 计算
+            fields = [field for field in self.model._meta.concrete_fields if not field.primary_key]
+            for obj in updates:
+                for field in fields:
+                    setattr(obj, field.attname, field.pre_save(obj, False))
+            self.model.objects.bulk_update(
+                updates, [field.name for field in fields], batch_size=batch_size
+            )
+        return result
@@ -43,6 +43,7 @@ AModel 请求数据时，字段中包含 bmodel 对象如下数据格式：
 from api_basebone.core import exceptions
 from api_basebone.utils import meta
 from api_basebone.restful.serializers import create_serializer_class
+from api_basebone.restful.relation import planner
 
 
 def reverse_many_to_many(instance, field, data):
@@ -80,34 +81,39 @@ def reverse_many_to_many(instance, field, data):
 
     # 传入数据不为空的情况下
     pk_field_name = model._meta.pk.name
+    # 更新的数据一次查询出来
+    objs = planner.get_instances(
+        model.objects,
+        [item[pk_field_name] for item in data if isinstance(item, dict) and pk_field_name in item],
+    )
+
     # 迭代处理反向数据，这个时候还没有处理数据和对象的关系
     reverse_object_list = set()
+    items, instances = [], []
     for item_value in data:
         if  isinstance(item_value, dict):
-            if  pk_field_name not in item_value:
-                # 创建反向模型的数据
-                serializer = create_serializer_class(model)(data=item_value)
-                serializer.is_valid(raise_exception=True)
-                item_instance = serializer.save()
-            else:
+            if  pk_field_name in item_value:
                 # 更新反向模型的数据
-                item_instance = model.objects.filter(
-                    **{pk_field_name: item_value[pk_field_name]}
-                ).first()
+                item_instance = objs.get(planner.to_pk(model, item_value[pk_field_name]))
                 if not item_instance:
                     raise exceptions.BusinessException(
                         error_code=exceptions.OBJECT_NOT_FOUND,
                         error_data=f'{pk_field_name}: {item_value} 指定的主键找不到对应的数据',
                     )
-                serializer = create_serializer_class(model)(
-                    instance=item_instance, data=item_value, partial=True
-                )
-                serializer.is_valid(raise_exception=True)
-                serializer.save()
-            reverse_object_list.add(item_instance.pk)
+                instances.append(item_instance)
+            else:
+                # 创建反向模型的数据
+                instances.append(None)
+            items.append(item_value)
         else:
             reverse_object_list.add(item_value)
 
+    if items:
+        objs = planner.save_items(
+            model, create_serializer_class(model), items, instances, require_pk=True
+        )
+        reverse_object_list.update(obj.pk for obj in objs)
+
     # 处理数据和 instance 之间的关系
     if reverse_manager:
         reverse_manager.set(list(reverse_object_list))
@@ -4,7 +4,7 @@ from api_basebone.restful.serializers import (
     create_serializer_class,
     multiple_create_serializer_class,
 )
-from api_basebone.restful.relation import reverse_many_to_many
+from api_basebone.restful.relation import planner, reverse_many_to_many
 
 
 def forward_many_to_many(field, value, update_data):
@@ -35,51 +35,45 @@ def forward_many_to_many(field, value, update_data):
     for item in object_data:
         update_list.append(item) if pk_field_name in item else create_list.append(item)
 
+    Serializer = create_serializer_class(model, allow_one_to_one=True)
     if create_list:
-        create_ids = []
-        for item_data in create_list:
-
-            # FIXME: 嵌套处理
-            forward_relation_hand(model, item_data)
-
-            serializer = create_serializer_class(model, allow_one_to_one=True)(data=item_data)
-            serializer.is_valid(raise_exception=True)
-            create_ids.append(serializer.save().pk)
+        # FIXME: 嵌套处理
+        forward_relation_hand(model, create_list)
+        create_ids = [
+            obj.pk for obj in planner.save_items(model, Serializer, create_list, require_pk=True)
+        ]
         pure_data += create_ids
 
     if update_list:
         update_data_map = {item[pk_field_name]: item for item in update_list}
         filter_params = {f'{pk_field_name}__in': update_data_map.keys()}
-        queryset = model.objects.filter(**filter_params)
+        instances = list(model.objects.filter(**filter_params))
 
         # 检查查询出的数据是否和传入的 id 长度一致
-        if queryset.count() != len(update_list):
+        if len(instances) != len(update_list):
             raise exceptions.BusinessException(
                 error_code=exceptions.OBJECT_NOT_FOUND,
                 error_data=f'{key}: {update_list} 存在不合法的数据',
             )
 
-        for instance in queryset.iterator():
-            item_data = update_data_map.get(getattr(instance, pk_field_name, None))
-
-            # FIXME: 嵌套处理
-            forward_relation_hand(model, item_data)
-            serializer = create_serializer_class(model, allow_one_to_one=True)(
-                instance=instance, data=item_data, partial=True
-            )
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
+        items = [update_data_map.get(getattr(instance, pk_field_name, None)) for instance in instances]
+        # FIXME: 嵌套处理
+        forward_relation_hand(model, items)
+        planner.save_items(model, Serializer, items, instances)
         pure_data += update_data_map.keys()
     update_data[key] = pure_data
     return update_data
 
 
-def forward_one_to_many(field, value, update_data):
+def forward_one_to_many(field, value, update_data, instances=None):
     """处理正向的一对多关系
 
     - 如果数据不是一个字典，则直接返回
     - 如果数据是字典，字典中没有包含主键，则对字典中的数据进行创建
     - 如果数据是字典，字典中包含主键，则对主键指定的数据进行更新
+
+    Params:
+        instances dict 已经查询出的关联数据，主键和数据对象的映射
     """
     if not isinstance(value, dict):
         return
@@ -100,7 +94,7 @@ def forward_one_to_many(field, value, update_data):
         return update_data
 
     # 如果传进来的数据包含主键，则代表是更新数据
-    instance = model.objects.filter(**{pk_field_name: value[pk_field_name]}).first()
+    instance = planner.get_instance(model, instances or {}, value[pk_field_name])
     if not instance:
         raise exceptions.BusinessException(
             error_code=exceptions.OBJECT_NOT_FOUND,
@@ -198,6 +192,14 @@ def reverse_one_to_many(field, value, instance, detail=True):
         else:
             pure_id_list.append(item)
 
+    relation = meta.get_relation_field_related_name(model, field.remote_field.name)
+    linked_pks = []
+    if detail and relation:
+        # 更新时只删除原有的数据中没有传入的数据，新建的数据不需要加入主键列表，可以批量新建
+        linked_pks = list(
+            getattr(instance, relation[0]).order_by().values_list('pk', flat=True)
+        )
+
     if object_data_list:
         # TODO: 创建时，不能传入包含主键的数据
         for item in object_data_list:
@@ -207,60 +209,52 @@ def reverse_one_to_many(field, value, instance, detail=True):
                     error_data=f'{key}: {value} 当前为 create 操作，不能传入包含主键的数据',
                 )
 
+        # 更新的数据一次查询出来
+        objs = planner.get_instances(
+            model.objects,
+            [item[pk_field_name] for item in object_data_list if pk_field_name in item],
+        )
+        instances = []
         for item_value in object_data_list:
+            obj = None
             if pk_field_name in item_value:
                 # 此时说明是更新的数据
-                pk_value = model._meta.pk.to_python(item_value[pk_field_name])
-
-                filter_params = {
-                    pk_field_name: pk_value,
-                }
-                obj = model.objects.filter(**filter_params).first()
+                obj = objs.get(planner.to_pk(model, item_value[pk_field_name]))
                 if not obj:
                     raise exceptions.BusinessException(
                         error_code=exceptions.OBJECT_NOT_FOUND,
                         error_data=f'{key}: {value} 指定的主键找不到对应的数据',
                     )
-
-                item_value[field.remote_field.name] = instance.pk
-                serializer = create_serializer_class(model, allow_one_to_one=True)(
-                    instance=obj, data=item_value, partial=True
-                )
-                serializer.is_valid(raise_exception=True)
-                serializer.save()
-            else:
-                # 如果传进来的数据不包含主键，则代表是创建数据
-                item_value[field.remote_field.name] = instance.pk
-                serializer = create_serializer_class(model, allow_one_to_one=True)(data=item_value)
-                serializer.is_valid(raise_exception=True)
-                obj = serializer.save()
-                if detail:
-                    pure_id_list.append(getattr(obj, pk_field_name))
-
-            reverse_relation(field.related_model, item_value, obj)
+            item_value[field.remote_field.name] = instance.pk
+            instances.append(obj)
+
+        planner.save_items(
+            model,
+            create_serializer_class(model, allow_one_to_one=True),
+            object_data_list,
+            instances,
+            callback=lambda item_value, obj: reverse_relation(field.related_model, item_value, obj),
+        )
 
     # 如果是更新，则删除掉对应的数据
-    if detail and pure_id_list:
-        pure_id_list = [model._meta.pk.to_python(item) for item in pure_id_list]
-        relation = meta.get_relation_field_related_name(model, field.remote_field.name)
-
+    if detail:
         if relation:
+            pure_id_list = [model._meta.pk.to_python(item) for item in pure_id_list]
             model.objects.filter(pk__in=pure_id_list).update(
                 **{relation[1].name: instance}
             )
-            getattr(instance, relation[0]).exclude(
+            getattr(instance, relation[0]).filter(pk__in=linked_pks).exclude(
                 **{f'{pk_field_name}__in': pure_id_list}
             ).delete()
     elif pure_id_list:
         # 如果是创建，则需要创建对应的数据
         pure_id_list = [model._meta.pk.to_python(item) for item in pure_id_list]
-        relation = meta.get_relation_field_related_name(model, field.remote_field.name)
         getattr(instance, relation[0]).add(
             *model.objects.filter(**{f'{pk_field_name}__in': pure_id_list})
         )
 
 
-def forward_relation_hand(model, data):
+def forward_relation_hand(model, data, instances=None):
     """正向的关系字段预处理
 
     例如文章和图片存在多对多，在新建文章时，对于图片，前端有可能会 push 以下数据
@@ -276,6 +270,9 @@ def forward_relation_hand(model, data):
     这里面包含两种关系
     - 正向的一对多
     - 正向的多不多
+
+    Params:
+        instances dict 字段名和已经查询出的关联数据的映射
     """
     # 这里的 data 是原始数据，这里可能会存在递归处理，第一次是从客户端传进来的数据
     if not (data and isinstance(data, (dict, list))):
@@ -292,12 +289,32 @@ def forward_relation_hand(model, data):
                 if field.many_to_many:
                     forward_many_to_many(field, value, update_data)
                 else:
-                    forward_one_to_many(field, value, update_data)
+                    forward_one_to_many(
+                        field, value, update_data, (instances or {}).get(field.name)
+                    )
         data.update(update_data)
         return data
     else:
+        # 列表中更新的正向一对多的数据，每个字段一次查询出来
+        instances = {}
+        for field in meta.get_all_relation_fields(model):
+            if not field.concrete or field.many_to_many:
+                continue
+            pk_field_name = field.related_model._meta.pk.name
+            values = [
+                item[field.name][pk_field_name]
+                for item in data
+                if isinstance(item, dict)
+                and isinstance(item.get(field.name), dict)
+                and pk_field_name in item[field.name]
+            ]
+            if len(values) > 1:
+                instances[field.name] = planner.get_instances(
+                    field.related_model.objects, values
+                )
+
         for value in data:
-            forward_relation_hand(model, value)
+            forward_relation_hand(model, value, instances)
         return data
 
 
@@ -2,6 +2,7 @@ import codecs
 import csv
 from collections import OrderedDict
 
+from django.db.models import QuerySet
 from django.http import HttpResponse
 from openpyxl import Workbook
 from openpyxl.writer.excel import save_virtual_workbook
@@ -9,7 +10,10 @@ from pydash import objects
 
 from api_basebone.core import gmeta
 from api_basebone.core.decorators import BSM_ADMIN_COMPUTED_FIELDS_MAP
+from api_basebone.restful.serializers import RowEncoder
+from api_basebone.settings import settings as basebone_settings
 from api_basebone.utils.gmeta import get_attr_in_gmeta_class, get_gmeta_config_by_key
+from api_basebone.utils.queryset import iter_chunks
 from api_basebone.utils.timezone import local_timestamp
 
 
@@ -60,6 +64,40 @@ def get_fields(model, serializer_class, export_config):
     return fields
 
 
+def get_row_encoder(queryset, serializer_class):
+    """获取导出使用的行编码器，不支持时返回 None"""
+    if not basebone_settings.ROW_ENCODER_ENABLE or not isinstance(queryset, QuerySet):
+        return None
+    encoder = RowEncoder.compile(serializer_class(many=True))
+    if encoder is None or not encoder.supports(queryset):
+        return None
+    return encoder
+
+
+def iter_serialized_rows(queryset, serializer_class, chunk_size=None, with_instance=False):
+    """分批序列化结果集
+
+    每批数据使用 many=True 序列化，批量的计算属性字段每批只计算一次。
+    不需要实例时，如果可以，使用行编码器输出数据
+
+    Params:
+        queryset queryset|list 结果集
+        serializer_class class 序列化类
+        chunk_size int 每批的数据量
+        with_instance bool 是否需要返回实例
+
+    Returns:
+        generator 元素为 (实例, 序列化后的数据)，使用行编码器时实例为 None
+    """
+    encoder = None if with_instance else get_row_encoder(queryset, serializer_class)
+    if encoder is not None:
+        for chunk in iter_chunks(encoder.values_queryset(queryset), chunk_size):
+            yield from zip([None] * len(chunk), encoder.encode(chunk, queryset))
+    else:
+        for chunk in iter_chunks(queryset, chunk_size):
+            yield from zip(chunk, serializer_class(chunk, many=True).data)
+
+
 def row_data(fields, data):
     """获取每行的数据"""
     return [objects.get(data, key) for key in fields.keys()]
@@ -102,8 +140,9 @@ def csv_render(model, queryset, serializer_class, export_config=None):
     )
 
     queryset_iter = queryset if isinstance(queryset, list) else queryset.all()
-    for instance in queryset_iter:
-        instance_data = serializer_class(instance).data
+    for instance, instance_data in iter_serialized_rows(
+        queryset_iter, serializer_class, with_instance=bool(reverse_field)
+    ):
         if reverse_field:
             reverse_relation = getattr(instance, reverse_field, None)
             if not reverse_relation or not reverse_relation.count():
@@ -161,7 +200,8 @@ class ExcelResponse(HttpResponse):
         worksheet.append(headers)
 
         serializer_class = self.serializer_class
-        for instance in self.queryset.iterator():
-            instance_data = serializer_class(instance).data
+        for _, instance_data in iter_serialized_rows(
+            self.queryset.iterator(), serializer_class
+        ):
             worksheet.append(row_data(fields, instance_data))
         return workbook
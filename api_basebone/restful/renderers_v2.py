@@ -7,6 +7,7 @@ from pydash import objects
 
 from api_basebone.core import gmeta
 from api_basebone.core.decorators import BSM_ADMIN_COMPUTED_FIELDS_MAP
+from api_basebone.restful.renderers import iter_serialized_rows
 from api_basebone.utils.gmeta import get_attr_in_gmeta_class
 from api_basebone.utils.meta import get_all_relation_fields
 from api_basebone.utils.timezone import local_timestamp
@@ -249,9 +250,7 @@ def csv_render(model, queryset, serializer_class, export_config=None):
         # 处理结果集
         queryset_iter = queryset if isinstance(queryset, list) else queryset.all()
 
-        for instance in queryset_iter:
-            instance_data = serializer_class(instance).data
-
+        for _, instance_data in iter_serialized_rows(queryset_iter, serializer_class):
             # 写入一行数据
             writer.writerow(
                 row_data_merge(model, fields, instance_data, export_config['fields'])
@@ -265,8 +264,7 @@ def csv_render(model, queryset, serializer_class, export_config=None):
         # 处理结果集
         queryset_iter = queryset if isinstance(queryset, list) else queryset.all()
 
-        for instance in queryset_iter:
-            instance_data = serializer_class(instance).data
+        for _, instance_data in iter_serialized_rows(queryset_iter, serializer_class):
             # 写入一行数据
             row_data_no_merge(
                 model, fields, instance_data, export_config['fields'], writer,
@@ -1,23 +1,32 @@
-from collections import Mapping, OrderedDict
+from collections import ChainMap, Mapping, OrderedDict
+from types import MappingProxyType
 
 from django.db import models
-from django.db.models.fields.related import ForeignKey, OneToOneField
+from django.db.models.fields.related import OneToOneField
 from rest_framework import fields, serializers
 from rest_framework.fields import SkipField
-from rest_framework.relations import PKOnlyObject
+from rest_framework.relations import (
+    ManyRelatedField,
+    PKOnlyObject,
+    PrimaryKeyRelatedField,
+    RelatedField,
+)
 
 from api_basebone.const.field_map import (
     ComputedFieldTypeSerializerMap,
     ExportFieldTypeSerializerMap,
 )
 from api_basebone.core import drf_field, gmeta
+from api_basebone.core.admin import BSMAdminModule
 from api_basebone.core.decorators import BSM_ADMIN_COMPUTED_FIELDS_MAP
 from api_basebone.core.fields import JSONField
 from jsonfield import JSONField as OriginJSONField
 from rest_framework.fields import JSONField as DrfJSONField
 from api_basebone.drf.fields import CharIntegerField
 from api_basebone.export.fields import get_attr_in_gmeta_class
+from api_basebone.settings import settings as basebone_settings
 from api_basebone.utils import meta, module
+from api_basebone.utils.cache import LRUCache
 from api_basebone.utils.gmeta import get_gmeta_config_by_key
 from api_basebone.utils.module import import_class_from_string
 
@@ -26,6 +35,48 @@ from .const import MANAGE_END_SLUG
 # 导出文件的动作
 EXPORT_FILE_ACTION = 'export_file'
 
+# 动态构建的序列化类的注册表，进程内共享
+serializer_class_cache = LRUCache(
+    maxsize=basebone_settings.SERIALIZER_CLASS_CACHE_SIZE, name='serializer_class'
+)
+serializer_class_cache.version = BSMAdminModule.version
+
+
+def freeze_cache_key(value):
+    """把列表、字典等数据转换为可哈希的元组，用于构建缓存的键"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze_cache_key(v)) for k, v in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(freeze_cache_key(v) for v in value))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_cache_key(v) for v in value)
+    return value
+
+
+def cached_serializer_class(key, factory):
+    """从序列化类注册表中获取序列化类，没有则构建
+
+    admin 模块重新注册后，注册表会整体失效
+
+    Params:
+        key tuple 缓存的键，如果不可哈希，则不做缓存
+        factory function 构建序列化类的函数
+    """
+    try:
+        hash(key)
+    except TypeError:
+        return factory()
+
+    if serializer_class_cache.version != BSMAdminModule.version:
+        serializer_class_cache.clear()
+        serializer_class_cache.version = BSMAdminModule.version
+    return serializer_class_cache.get_or_set(key, factory)
+
+
+def clear_serializer_class_cache():
+    """清空序列化类注册表"""
+    serializer_class_cache.clear()
+
 
 class ModelSerializer(serializers.ModelSerializer):
 
@@ -43,7 +94,7 @@ def get_model_exclude_fields(model, exclude_fields):
     if gmeta_class:
         exclude = getattr(gmeta_class, gmeta.GMETA_SERIALIZER_EXCLUDE_FIELDS, None)
         if exclude and isinstance(exclude, (list, tuple)):
-            fields = [item.name for item in model._meta.get_fields()]
+            fields = meta.get_model_index(model).field_map
             field_list = [item for item in exclude if item in fields]
     key = f'{model._meta.app_label}__{model._meta.model_name}'
     if isinstance(exclude_fields, dict) and exclude_fields:
@@ -60,6 +111,74 @@ class RecursiveSerializer(serializers.Serializer):
         return serializer.data
 
 
+class RepresentationPlan:
+    """序列化类的输出计划
+
+    输出每一行数据时都需要的反向字段名称映射、admin 计算属性字段等信息，
+    对同一个序列化类来说都是相同的，所以每个序列化类只计算一次
+
+    Params:
+        serializer_class class 序列化类
+    """
+
+    def __init__(self, serializer_class):
+        self.version = BSMAdminModule.version
+        self.reverse_field_map = meta.get_model_index(
+            serializer_class.Meta.model
+        ).reverse_field_map
+        self.computed_fields = self.get_computed_fields(serializer_class)
+        self.batch_fields = [item for item in self.computed_fields if item[3]]
+
+    def get_computed_fields(self, serializer_class):
+        """获取 admin 中的计算属性字段
+
+        Returns:
+            list 元素为 (字段名称, 绑定了 admin 实例的计算方法, 字段的序列化实例, 是否批量)
+        """
+        if getattr(serializer_class, 'basebone_end_slug', None) != MANAGE_END_SLUG:
+            return []
+
+        model = serializer_class.basebone_model
+        admin_computed_fields = getattr(model, BSM_ADMIN_COMPUTED_FIELDS_MAP, {})
+        if not admin_computed_fields:
+            return []
+        admin_class = meta.get_bsm_model_admin(model)
+        if not admin_class:
+            return []
+
+        admin_instance, computed_fields = admin_class(), []
+        for name, field_value in admin_computed_fields.items():
+            field_type = field_value['field_type']
+            computed_func = getattr(admin_instance, name, None)
+            if not computed_func:
+                continue
+            serializer_field_class = ComputedFieldTypeSerializerMap[field_type]
+            # 如果是导出，则使用导出的字段序列化类
+            if (
+                getattr(serializer_class, 'action', None) == EXPORT_FILE_ACTION
+                and field_type in ExportFieldTypeSerializerMap
+            ):
+                serializer_field_class = ExportFieldTypeSerializerMap[field_type]
+            computed_fields.append(
+                (
+                    name,
+                    computed_func,
+                    serializer_field_class(read_only=True),
+                    field_value.get('batch', False),
+                )
+            )
+        return computed_fields
+
+    @classmethod
+    def for_class(cls, serializer_class):
+        """获取序列化类的输出计划，admin 模块重新注册后重新计算"""
+        plan = serializer_class.__dict__.get('_basebone_representation_plan')
+        if plan is None or plan.version != BSMAdminModule.version:
+            plan = cls(serializer_class)
+            serializer_class._basebone_representation_plan = plan
+        return plan
+
+
 class BaseModelSerializerMixin:
     """通用的序列化类的抽象"""
 
@@ -71,19 +190,10 @@ class BaseModelSerializerMixin:
         Object instance -> Dict of primitive datatypes.
         """
         ret = OrderedDict()
+        # 可读字段由 DRF 在序列化实例上缓存，many=True 时整页数据共用一个实例
         fields = self._readable_fields
-
-        # 获取反向字段 related_name 和 name 的映射
-        model, reverse_field_map = self.Meta.model, {}
-        reverse_fields = meta.get_reverse_fields(model)
-
-        if reverse_fields:
-            for item in reverse_fields:
-                related_name = meta.get_relation_field_related_name(
-                    item.related_model, item.remote_field.name
-                )
-                if related_name:
-                    reverse_field_map[related_name[0]] = item.name
+        plan = RepresentationPlan.for_class(self.__class__)
+        reverse_field_map = plan.reverse_field_map
 
         for field in fields:
             try:
@@ -100,51 +210,95 @@ class BaseModelSerializerMixin:
                 data = attribute.all()
 
                 # 检测字段是否是反向字段的 related_name, 如果是，转换为反向字段的名称
-                field_name = (
-                    reverse_field_map[field.field_name]
-                    if field.field_name in reverse_field_map
-                    else field.field_name
-                )
+                field_name = reverse_field_map.get(field.field_name, field.field_name)
                 ret[field_name] = field.to_representation(data)
             else:
                 ret[field.field_name] = field.to_representation(attribute)
 
         # 这了处理 admin 中计算属性字段的业务
-        if self.basebone_end_slug == MANAGE_END_SLUG:
-            admin_computed_fields = getattr(
-                self.basebone_model, BSM_ADMIN_COMPUTED_FIELDS_MAP, {}
-            )
-            if not admin_computed_fields:
-                return ret
-            admin_class = meta.get_bsm_model_admin(self.basebone_model)
-            if not admin_class:
-                return ret
-
-            admin_instance = admin_class()
-            for name, field_value in admin_computed_fields.items():
-                field_type = field_value['field_type']
-                computed_func = getattr(admin_instance, name, None)
-                if not computed_func:
-                    continue
+        batch_values = getattr(self, '_basebone_batch_values', None) or {}
+        for name, computed_func, serializer_field, batch in plan.computed_fields:
+            if not batch:
                 value = computed_func(instance)
-                serializer_class = ComputedFieldTypeSerializerMap[field_type]
-                # 如果是导出，则使用导出的字段序列化类
-                if (
-                    self.action == EXPORT_FILE_ACTION
-                    and field_type in ExportFieldTypeSerializerMap
-                ):
-                    serializer_class = ExportFieldTypeSerializerMap[field_type]
-                ret[name] = serializer_class(read_only=True).to_representation(value)
+            elif name in batch_values:
+                value = batch_values[name].get(instance.pk)
+            else:
+                # 单条数据输出时，批量计算属性以只有一条数据的列表调用
+                value = computed_func([instance]).get(instance.pk)
+            ret[name] = serializer_field.to_representation(value)
         return ret
 
+    def set_batch_values(self, instances):
+        """批量计算一页数据的计算属性字段"""
+        plan = RepresentationPlan.for_class(self.__class__)
+        self._basebone_batch_values = {
+            name: computed_func(instances) or {}
+            for name, computed_func, _, _ in plan.batch_fields
+        }
+
+
+class BaseListSerializer(serializers.ListSerializer):
+    """列表序列化类
+
+    输出前先对整页数据调用一次批量的计算属性字段
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        instances = list(iterable)
+        if hasattr(self.child, 'set_batch_values'):
+            self.child.set_batch_values(instances)
+        return [self.child.to_representation(item) for item in instances]
+
+
+# 由于BigInteger类型的数据到了前端，JS丢失了精度，所以在接口返回的时候就直接转成字符串
+serializers.ModelSerializer.serializer_field_mapping[models.BigIntegerField] = CharIntegerField
+serializers.ModelSerializer.serializer_field_mapping[models.BigAutoField] = CharIntegerField
+
+
+def create_field_mapping(overrides):
+    """构建序列化类的字段映射
+
+    覆盖的映射是只读的，其他的字段类型读取 DRF 的字段映射，自定义字段注册的映射
+    同样可以读取到，实例化序列化类时不再修改映射
+
+    Params:
+        overrides dict 覆盖的字段映射
+    """
+    return ChainMap(
+        MappingProxyType(overrides), serializers.ModelSerializer.serializer_field_mapping
+    )
+
 
 class CustomModelSerializer(serializers.ModelSerializer):
-    """由于BigInteger类型的数据到了前端，JS丢失了精度，所以在接口返回的时候就直接转成字符串
+    """普通接口使用的模型序列化类"""
+
+    serializer_field_mapping = create_field_mapping(
+        {
+            JSONField: drf_field.JSONField,
+            OriginJSONField: DrfJSONField,
+            models.BooleanField: fields.BooleanField,
+            models.DateTimeField: fields.DateTimeField,
+        }
+    )
+    serializer_choice_field = fields.ChoiceField
+
+
+class ExportModelSerializer(serializers.ModelSerializer):
+    """导出文件使用的模型序列化类
+
+    类似 BooleanField 字段，显示为中文会比较友好
     """
 
-    serializer_field_mapping = serializers.ModelSerializer.serializer_field_mapping
-    serializer_field_mapping[models.BigIntegerField] = CharIntegerField
-    serializer_field_mapping[models.BigAutoField] = CharIntegerField
+    serializer_field_mapping = create_field_mapping(
+        {
+            JSONField: drf_field.JSONField,
+            OriginJSONField: DrfJSONField,
+            models.BooleanField: drf_field.ExportBooleanField,
+            models.DateTimeField: drf_field.ExportDateTimeField,
+        }
+    )
+    serializer_choice_field = drf_field.ExportChoiceField
 
 
 def create_meta_class(
@@ -156,24 +310,17 @@ def create_meta_class(
         exclude_fields list 排除的字段
     """
 
-    attrs = {'model': model}
+    attrs = {'model': model, 'list_serializer_class': BaseListSerializer}
 
     exclude_field_list = get_model_exclude_fields(model, exclude_fields)
+    model_index = meta.get_model_index(model)
     if action in ['list', 'set']:
-        flat_fields = [
-            f.name
-            for f in model._meta.get_fields()
-            if f.concrete
-            and not (
-                f.is_relation
-                and (not isinstance(f, ForeignKey) or isinstance(f, OneToOneField))
-            )
-        ]
+        flat_fields = list(model_index.flat_fields)
     else:
         flat_fields = [
             f.name
-            for f in model._meta.get_fields()
-            if f.concrete and (not isinstance(f, OneToOneField) or allow_one_to_one)
+            for f in model_index.concrete_fields
+            if not isinstance(f, OneToOneField) or allow_one_to_one
         ]
 
     if display_fields is not None and '*' not in display_fields:
@@ -201,33 +348,60 @@ def create_serializer_class(
 ):
     """构建序列化类
 
+    没有传入 attrs 时，构建的序列化类会缓存到注册表中
+
     Params:
         tree_structure 元组 admin 中做对应配置
     """
-    if attrs is None:
-        attrs = {}
+    if attrs is not None:
+        return _create_serializer_class(
+            model,
+            exclude_fields=exclude_fields,
+            tree_structure=tree_structure,
+            action=action,
+            end_slug=end_slug,
+            attrs=attrs,
+            display_fields=display_fields,
+            allow_one_to_one=allow_one_to_one,
+        )
 
-    def __init__(self, *args, **kwargs):
-        """
-        重置导出的字段映射，因为类似 BooleanField 字段，显示为中文会比较友好
-        """
-        self.serializer_field_mapping[JSONField] = drf_field.JSONField
-        self.serializer_field_mapping[OriginJSONField] = DrfJSONField
-        if self.action == 'export_file':
-            self.serializer_field_mapping[
-                models.BooleanField
-            ] = drf_field.ExportBooleanField
-            self.serializer_field_mapping[
-                models.DateTimeField
-            ] = drf_field.ExportDateTimeField
-            self.serializer_choice_field = drf_field.ExportChoiceField
-        else:
-            # 恢复为原来的字段类型映射，因为上面改了类的变量属性值
-            self.serializer_field_mapping[models.BooleanField] = fields.BooleanField
-            self.serializer_field_mapping[models.DateTimeField] = fields.DateTimeField
-            self.serializer_choice_field = fields.ChoiceField
+    key = (
+        'single',
+        model,
+        action,
+        end_slug,
+        freeze_cache_key(tree_structure),
+        freeze_display_fields(display_fields),
+        freeze_cache_key(exclude_fields),
+        allow_one_to_one,
+    )
+    return cached_serializer_class(
+        key,
+        lambda: _create_serializer_class(
+            model,
+            exclude_fields=exclude_fields,
+            tree_structure=tree_structure,
+            action=action,
+            end_slug=end_slug,
+            display_fields=display_fields,
+            allow_one_to_one=allow_one_to_one,
+        ),
+    )
 
-        super(CustomModelSerializer, self).__init__(*args, **kwargs)
+
+def _create_serializer_class(
+    model,
+    exclude_fields=None,
+    tree_structure=None,
+    action=None,
+    end_slug=None,
+    attrs=None,
+    display_fields=None,
+    allow_one_to_one=False,
+):
+    """构建序列化类，不经过注册表"""
+    if attrs is None:
+        attrs = {}
 
     extra_fields = list(attrs.keys())
     new_attr = {}
@@ -262,10 +436,16 @@ def create_serializer_class(
         for name, field in annotated_fields.items():
             new_attr[name] = ComputedFieldTypeSerializerMap[field['type']](read_only=True)
 
+    # 导出和普通接口使用不同的字段映射，在构建序列化类时确定
+    if action == EXPORT_FILE_ACTION:
+        base_serializer_class = ExportModelSerializer
+    else:
+        base_serializer_class = CustomModelSerializer
+
     class_name = f'{model.__name__}ModelSerializer'
     return type(
         class_name,
-        (BaseModelSerializerMixin, CustomModelSerializer),
+        (BaseModelSerializerMixin, base_serializer_class),
         {
             'Meta': create_meta_class(
                 model,
@@ -278,7 +458,6 @@ def create_serializer_class(
             'action': action,
             'basebone_model': model,
             'basebone_end_slug': end_slug,
-            '__init__': __init__,
             **new_attr,
             **attrs,
         },
@@ -295,21 +474,8 @@ def get_field(model, field_name):
     Returns:
         field 指定 model 的字段
     """
-    valid_fields = {item.name: item for item in model._meta.get_fields()}
-    if field_name in valid_fields:
-        return valid_fields[field_name]
-
     # 如果没有找到指定的字段，则通过反向字段的 related_name 进行查找
-    related_field_map = {}
-    for field in meta.get_reverse_fields(model):
-        related_name = meta.get_relation_field_related_name(
-            field.related_model, field.remote_field.name
-        )
-        if related_name:
-            related_field_map[related_name[0]] = field
-
-    if field_name in related_field_map:
-        return related_field_map[field_name]
+    return meta.get_model_index(model).get_field(field_name)
 
 
 def dict_merge(dct, merge_dct):
@@ -369,16 +535,7 @@ def nested_display_fields(model, super_display_fields, key):
     if not super_display_fields:
         return None
 
-    reverse_fields = meta.get_reverse_fields(model)
-
-    reverse_field_map = {}
-    if reverse_fields:
-        for item in reverse_fields:
-            related_name = meta.get_relation_field_related_name(
-                item.related_model, item.remote_field.name
-            )
-            if related_name:
-                reverse_field_map[related_name[0]] = item.name
+    reverse_field_map = meta.get_model_index(model).reverse_field_map
     if key in reverse_field_map:
         key = reverse_field_map[key]
     return ['.'.join(d.split('.')[1:]) for d in super_display_fields if d.startswith(key+'.')]
@@ -427,6 +584,13 @@ def create_nested_serializer_class(
     )
 
 
+def freeze_display_fields(display_fields):
+    """显示字段只影响字段的集合，和顺序无关，所以排序后作为缓存的键"""
+    if display_fields is None:
+        return None
+    return tuple(sorted(set(display_fields)))
+
+
 def display_fields_to_expand_fields(display_fields):
     return [d.rsplit('.', 1)[0] for d in display_fields if '.' in d]
 
@@ -440,15 +604,52 @@ def multiple_create_serializer_class(
     end_slug=None,
     display_fields=None,
 ):
-    """多重创建序列化类"""
-    attrs = {}
+    """多重创建序列化类
 
+    构建的序列化类会以展开字段的树形结构等作为键缓存到注册表中
+    """
     if expand_fields is None:
         if display_fields is not None:
             expand_fields = display_fields_to_expand_fields(display_fields)
         else:
             expand_fields = []
     expand_dict = sort_expand_fields(expand_fields)
+
+    key = (
+        'multiple',
+        model,
+        action,
+        end_slug,
+        freeze_cache_key(expand_dict),
+        freeze_display_fields(display_fields),
+        freeze_cache_key(exclude_fields),
+        freeze_cache_key(tree_structure),
+    )
+    return cached_serializer_class(
+        key,
+        lambda: _multiple_create_serializer_class(
+            model,
+            expand_dict,
+            tree_structure=tree_structure,
+            exclude_fields=exclude_fields,
+            action=action,
+            end_slug=end_slug,
+            display_fields=display_fields,
+        ),
+    )
+
+
+def _multiple_create_serializer_class(
+    model,
+    expand_dict,
+    tree_structure=None,
+    exclude_fields=None,
+    action=None,
+    end_slug=None,
+    display_fields=None,
+):
+    """根据树形结构的展开字段构建序列化类，不经过注册表"""
+    attrs = {}
     for key, value in expand_dict.items():
         field = get_field(model, key)
         # 如果是反向字段，则使用另外一种方式
@@ -510,3 +711,372 @@ def get_export_serializer_class(
 
     reset_serialzier_class = custom_export_mixin.get_serializer_class(serialier_class)
     return type(class_name, (reset_serialzier_class,), {})
+
+
+class RowEncoderUnsupported(Exception):
+    """序列化类中存在行编码器无法处理的字段"""
+
+
+class RelatedRows:
+    """行编码器中关系字段的数据
+
+    关联的数据通过一次 IN 查询批量获取，再按照来源的键分组
+
+    Params:
+        name str 序列化字段的名称
+        field field 模型的关系字段，可以是反向字段
+        encoder RowEncoder 关联模型的行编码器
+    """
+
+    # 关联数据中标识来源数据的注解名称
+    SOURCE = '_basebone_source'
+
+    def __init__(self, name, field, encoder):
+        self.name = name
+        self.encoder = encoder
+        self.related_model = field.related_model
+        self.many = field.many_to_many or field.one_to_many
+        # 单值的正向关系，可以通过 JOIN 和来源数据一起查询
+        self.forward = field.concrete and not self.many
+        if field.concrete and not field.many_to_many:
+            # 正向的外键和一对一
+            self.parent_key = field.attname
+            self.lookup = field.target_field.attname
+        elif field.concrete:
+            # 正向的多对多
+            self.parent_key = field.model._meta.pk.attname
+            self.lookup = field.related_query_name()
+        elif field.many_to_many:
+            # 反向的多对多
+            self.parent_key = field.model._meta.pk.attname
+            self.lookup = field.field.name
+        else:
+            # 反向的外键和一对一
+            self.parent_key = field.field.target_field.attname
+            self.lookup = field.field.attname
+
+    def get_queryset(self, queryset):
+        """从结果集的 prefetch 配置中找到关系字段使用的结果集"""
+        for lookup in queryset._prefetch_related_lookups:
+            if (
+                isinstance(lookup, models.Prefetch)
+                and lookup.prefetch_to == self.name
+                and lookup.queryset is not None
+            ):
+                return lookup.queryset
+
+        # 单值的正向关系通过 select_related 加载时，按照 JOIN 的路径构建结果集
+        from api_basebone.utils.queryset import get_select_related_paths
+
+        if not self.is_joined(queryset):
+            return None
+        prefix = f'{self.name}__'
+        related_queryset = self.related_model.objects.all()
+        paths = [
+            path[len(prefix):]
+            for path in get_select_related_paths(queryset)
+            if path.startswith(prefix)
+        ]
+        if paths:
+            related_queryset = related_queryset.select_related(*paths)
+        return related_queryset.prefetch_related(
+            *[
+                self.reroot_lookup(lookup, prefix)
+                for lookup in queryset._prefetch_related_lookups
+                if isinstance(lookup, models.Prefetch) and lookup.prefetch_to.startswith(prefix)
+            ]
+        )
+
+    def is_joined(self, queryset):
+        """关系字段是否在结果集的 select_related 中，此时关联的数据在来源数据的查询中 JOIN 获取"""
+        from api_basebone.utils.queryset import get_select_related_paths
+
+        return self.forward and self.name in get_select_related_paths(queryset)
+
+    def get_value_names(self, queryset):
+        """JOIN 获取关联的数据时，来源数据的 values 中需要的字段"""
+        related_queryset = self.get_queryset(queryset)
+        return [
+            f'{self.name}__{name}'
+            for name in self.encoder.get_value_names(related_queryset)
+        ]
+
+    def reroot_lookup(self, lookup, prefix):
+        """去掉 Prefetch 路径中关系字段的前缀"""
+        path = lookup.prefetch_through[len(prefix):]
+        return models.Prefetch(path, queryset=lookup.queryset)
+
+    def supports(self, queryset):
+        related_queryset = self.get_queryset(queryset)
+        return related_queryset is not None and self.encoder.supports(related_queryset)
+
+    def fetch(self, rows, queryset):
+        """批量获取关联的数据
+
+        Returns:
+            dict 键为来源数据的键，一对多时值为列表
+        """
+        if self.is_joined(queryset):
+            return self.fetch_joined(rows, queryset)
+
+        keys = {row[self.parent_key] for row in rows} - {None}
+        result = {}
+        if not keys:
+            return result
+
+        related_queryset = (
+            self.get_queryset(queryset)
+            .filter(**{f'{self.lookup}__in': keys})
+            .annotate(**{self.SOURCE: models.F(self.lookup)})
+        )
+        related_rows = list(
+            self.encoder.values_queryset(related_queryset, self.SOURCE)
+        )
+        data = self.encoder.encode(related_rows, related_queryset)
+        for row, item in zip(related_rows, data):
+            if self.many:
+                result.setdefault(row[self.SOURCE], []).append(item)
+            else:
+                result.setdefault(row[self.SOURCE], item)
+        return result
+
+    def fetch_joined(self, rows, queryset):
+        """从来源数据中拆分出 JOIN 获取的关联数据"""
+        related_queryset = self.get_queryset(queryset)
+        prefix = f'{self.name}__'
+        names = self.encoder.get_value_names(related_queryset)
+        related_rows = {}
+        for row in rows:
+            key = row[self.parent_key]
+            if key is not None and key not in related_rows:
+                related_rows[key] = {name: row[prefix + name] for name in names}
+        data = self.encoder.encode(list(related_rows.values()), related_queryset)
+        return dict(zip(related_rows, data))
+
+    def get_value(self, row, fetched):
+        key = row[self.parent_key]
+        if self.many:
+            return fetched.get(key, [])
+        return fetched.get(key)
+
+
+class RelatedPks(RelatedRows):
+    """行编码器中只输出主键列表的多对多字段"""
+
+    def __init__(self, name, field, converter):
+        super().__init__(name, field, None)
+        self.converter = converter
+        self.related_model = field.related_model
+
+    def supports(self, queryset):
+        return True
+
+    def is_joined(self, queryset):
+        return False
+
+    def fetch(self, rows, queryset):
+        keys = {row[self.parent_key] for row in rows} - {None}
+        result = {}
+        if not keys:
+            return result
+
+        related_rows = (
+            self.related_model._default_manager.filter(
+                **{f'{self.lookup}__in': keys}
+            )
+            .annotate(**{self.SOURCE: models.F(self.lookup)})
+            .values_list(self.SOURCE, 'pk')
+        )
+        for source, pk in related_rows:
+            result.setdefault(source, []).append(self.converter(pk))
+        return result
+
+
+class RowEncoder:
+    """基于 values() 的行编码器
+
+    只读的接口中，不构建模型实例，也不经过序列化字段的 get_attribute，直接从
+    values() 的结果中取值，再使用序列化字段的 to_representation 转换，展开的关系
+    字段通过批量查询获取。输出的数据和序列化类的输出完全一致
+
+    序列化类中存在计算属性、树形结构、自定义输出等字段时，不能使用行编码器，
+    此时 compile 返回 None
+
+    Params:
+        serializer serializer 绑定了字段的序列化实例
+    """
+
+    def __init__(self, serializer):
+        serializer_class = serializer.__class__
+        if (
+            serializer_class.to_representation
+            is not BaseModelSerializerMixin.to_representation
+        ):
+            raise RowEncoderUnsupported(serializer_class.__name__)
+
+        plan = RepresentationPlan.for_class(serializer_class)
+        if plan.computed_fields:
+            raise RowEncoderUnsupported(serializer_class.__name__)
+
+        model = serializer_class.Meta.model
+        self.model = model
+        # 元素为 (输出的名称, values 中的名称, 转换函数) 或者 (输出的名称, 关系字段)
+        self.columns = []
+        self.value_names = [model._meta.pk.attname]
+        self.annotation_names = set()
+        annotated_fields = get_attr_in_gmeta_class(model, gmeta.GMETA_ANNOTATED_FIELDS, {})
+
+        for field in serializer._readable_fields:
+            name = field.field_name
+            if field.source != name:
+                raise RowEncoderUnsupported(name)
+            model_field = get_field(model, name)
+
+            if isinstance(field, serializers.BaseSerializer):
+                self.add_nested_column(name, field, model_field, plan)
+            elif isinstance(field, PrimaryKeyRelatedField):
+                if not (model_field and model_field.concrete and model_field.is_relation):
+                    raise RowEncoderUnsupported(name)
+                self.add_value_column(
+                    name, model_field.attname, self.get_pk_converter(field)
+                )
+            elif isinstance(field, ManyRelatedField):
+                if not (
+                    model_field
+                    and model_field.many_to_many
+                    and isinstance(field.child_relation, PrimaryKeyRelatedField)
+                ):
+                    raise RowEncoderUnsupported(name)
+                relation = RelatedPks(
+                    name, model_field, self.get_pk_converter(field.child_relation)
+                )
+                self.add_relation_column(
+                    plan.reverse_field_map.get(name, name), relation
+                )
+            elif isinstance(
+                field,
+                (
+                    RelatedField,
+                    fields.SerializerMethodField,
+                    fields.FileField,
+                    fields.ModelField,
+                ),
+            ):
+                raise RowEncoderUnsupported(name)
+            elif model_field is None:
+                # 不是模型的字段时，只能是结果集中的注解字段，GMeta 中的计算属性需要模型实例
+                if name not in annotated_fields:
+                    raise RowEncoderUnsupported(name)
+                self.annotation_names.add(name)
+                self.add_value_column(name, name, field.to_representation)
+            elif model_field.concrete and not model_field.is_relation:
+                self.add_value_column(name, model_field.attname, field.to_representation)
+            else:
+                raise RowEncoderUnsupported(name)
+
+    def add_value_column(self, name, value_name, converter):
+        self.columns.append((name, value_name, converter))
+        if value_name not in self.value_names:
+            self.value_names.append(value_name)
+
+    def add_relation_column(self, name, relation):
+        self.columns.append((name, relation))
+        if relation.parent_key not in self.value_names:
+            self.value_names.append(relation.parent_key)
+
+    def add_nested_column(self, name, field, model_field, plan):
+        many = isinstance(field, serializers.ListSerializer)
+        child = field.child if many else field
+        if (
+            isinstance(child, RecursiveSerializer)
+            or not isinstance(child, BaseModelSerializerMixin)
+            or not (model_field and model_field.is_relation)
+            or many != bool(model_field.many_to_many or model_field.one_to_many)
+        ):
+            raise RowEncoderUnsupported(name)
+
+        relation = RelatedRows(name, model_field, RowEncoder(child))
+        # 一对多的关系，输出时使用反向字段的名称
+        self.add_relation_column(
+            plan.reverse_field_map.get(name, name) if many else name, relation
+        )
+
+    def get_pk_converter(self, field):
+        if field.pk_field is not None:
+            return field.pk_field.to_representation
+        return lambda value: value
+
+    @classmethod
+    def compile(cls, serializer):
+        """编译行编码器，序列化类不支持时返回 None
+
+        Params:
+            serializer serializer 序列化实例，可以是 many=True 的列表序列化实例
+        """
+        if isinstance(serializer, serializers.ListSerializer):
+            serializer = serializer.child
+        try:
+            return cls(serializer)
+        except RowEncoderUnsupported:
+            return None
+
+    def supports(self, queryset):
+        """检测结果集是否满足行编码器的要求
+
+        展开的关系字段需要有对应的 Prefetch。注解字段不在结果集中时不输出，和序列化类一致
+        """
+        return all(
+            column[1].supports(queryset) for column in self.columns if len(column) == 2
+        )
+
+    def get_value_names(self, queryset):
+        """values 中需要的字段，包括 JOIN 获取的关联数据的字段"""
+        names = [
+            name
+            for name in self.value_names
+            if name not in self.annotation_names or name in queryset.query.annotations
+        ]
+        for column in self.columns:
+            if len(column) == 2 and column[1].is_joined(queryset):
+                names += column[1].get_value_names(queryset)
+        return names
+
+    def values_queryset(self, queryset, *extra_names):
+        """获取行编码器使用的 values 结果集"""
+        return queryset.prefetch_related(None).values(
+            *self.get_value_names(queryset), *extra_names
+        )
+
+    def encode(self, rows, queryset):
+        """把 values 的结果编码为输出的数据
+
+        Params:
+            rows list values 结果集的数据
+            queryset queryset 原始的结果集，从中获取关系字段的 Prefetch 配置
+        """
+        rows = list(rows)
+        fetched = {
+            column[0]: column[1].fetch(rows, queryset)
+            for column in self.columns
+            if len(column) == 2
+        }
+
+        columns = self.columns
+        missing = self.annotation_names.difference(rows[0]) if rows else None
+        if missing:
+            columns = [
+                column for column in columns if len(column) == 2 or column[1] not in missing
+            ]
+
+        result = []
+        for row in rows:
+            ret = OrderedDict()
+            for column in columns:
+                if len(column) == 2:
+                    ret[column[0]] = column[1].get_value(row, fetched[column[0]])
+                    continue
+                name, value_name, converter = column
+                value = row[value_name]
+                ret[name] = None if value is None else converter(value)
+            result.append(ret)
+        return result
@@ -1,11 +1,30 @@
 from rest_framework import viewsets
 from rest_framework.decorators import action
 
-from api_basebone.core import const
+from api_basebone.core import admin, const
+from api_basebone.drf import pagination
 from api_basebone.services import rest_services
 
 
 class BSMModelViewSet(viewsets.ModelViewSet):
+    @property
+    def paginator(self):
+        """分页器，分页的方式由请求参数或者 admin 的配置指定"""
+        if not hasattr(self, '_paginator'):
+            pagination_class = self.get_pagination_class()
+            self._paginator = pagination_class() if pagination_class else None
+        return self._paginator
+
+    def get_pagination_class(self):
+        """获取分页类，请求参数的优先级高于 admin 的配置"""
+        if self.pagination_class is None:
+            return None
+        mode = self.request.query_params.get(pagination.PAGINATION_QUERY_PARAM)
+        if not mode and hasattr(self, 'get_bsm_model_admin'):
+            admin_class = self.get_bsm_model_admin()
+            mode = getattr(admin_class, admin.BSM_PAGINATION, None)
+        return pagination.get_pagination_class(mode, self.pagination_class)
+
     def perform_create(self, serializer):
         return serializer.save()
 
@@ -8,8 +8,16 @@ from django.utils import timezone
 from django.db.models import F, Value, Count, Sum, Avg, Max, Min, StdDev, Variance
 from django.db.models.functions import Concat
 
+from api_basebone.settings import settings as basebone_settings
+from api_basebone.utils.cache import LRUCache
+
 log = logging.getLogger(__name__)
 
+# 编译后的表达式的缓存，键为表达式的字符串
+expression_cache = LRUCache(
+    maxsize=basebone_settings.EXPRESSION_CACHE_SIZE, name='expression'
+)
+
 
 def reduce_wrap(func):
     return lambda *args: reduce(func, args)
@@ -87,7 +95,11 @@ def split_expression(expression, symbol):
         yield buffer
 
 
-def resolve_expression(expression, variables=None):
+def interpret_expression(expression, variables=None):
+    """逐次解析并求值表达式，不缓存解析的结果
+
+    和 resolve_expression 的语义一致，用于对比编译的效果
+    """
     expression = expression.strip()
 
     try:
@@ -100,7 +112,7 @@ def resolve_expression(expression, variables=None):
         func, arg_str = matched.groups()
         if func == '__variables__':
             return variables
-        args = [resolve_expression(buffer, variables=variables) for buffer in split_expression(arg_str, ',')]
+        args = [interpret_expression(buffer, variables=variables) for buffer in split_expression(arg_str, ',')]
         log.debug(f'returning calling Fun: {FUNCS[func]} with args: {args}')
         return FUNCS[func](*args)
 
@@ -109,4 +121,81 @@ def resolve_expression(expression, variables=None):
     for path_item in expression.split('.'):
         exp = f'__getattr__({exp}, "{path_item}")'
     log.debug(f'exp: {exp}')
-    return resolve_expression(exp, variables=variables)
+    return interpret_expression(exp, variables=variables)
+
+
+class Constant:
+    """常量，JSON 的列表和对象每次求值时重新解析，避免共享可变的值"""
+
+    def __init__(self, source, value):
+        self.source = source
+        self.value = value
+        self.mutable = isinstance(value, (list, dict))
+
+    def __call__(self, variables):
+        if self.mutable:
+            return json.loads(self.source)
+        return self.value
+
+
+class Variables:
+    """__variables__() 返回求值时的变量"""
+
+    def __call__(self, variables):
+        return variables
+
+
+class Call:
+    """函数调用，先对参数求值，再从 FUNCS 中获取函数"""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+    def __call__(self, variables):
+        args = [arg(variables) for arg in self.args]
+        return FUNCS[self.func](*args)
+
+
+def compile_expression(expression):
+    """把表达式编译为可以多次求值的对象，编译的规则和 interpret_expression 一致
+
+    Returns:
+        callable 参数为变量，返回表达式的值
+    """
+    expression = expression.strip()
+
+    try:
+        return Constant(expression, json.loads(expression))
+    except json.JSONDecodeError:
+        pass
+    matched = re.match(r'^(\w+)\((.*)\)$', expression)
+    if matched:
+        func, arg_str = matched.groups()
+        if func == '__variables__':
+            return Variables()
+        return Call(
+            func, [compile_expression(buffer) for buffer in split_expression(arg_str, ',')]
+        )
+
+    # 点操作符，getattr的语法糖
+    exp = '__variables__()'
+    for path_item in expression.split('.'):
+        exp = f'__getattr__({exp}, "{path_item}")'
+    return compile_expression(exp)
+
+
+def get_compiled_expression(expression):
+    """获取编译后的表达式，相同的表达式只编译一次"""
+    compiled = expression_cache.get(expression)
+    if compiled is None:
+        log.debug(f'compiling expression: {expression}')
+        compiled = compile_expression(expression)
+        expression_cache.set(expression, compiled)
+    return compiled
+
+
+def resolve_expression(expression, variables=None):
+    if not isinstance(expression, str):
+        return interpret_expression(expression, variables=variables)
+    return get_compiled_expression(expression)(variables)
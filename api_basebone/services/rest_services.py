@@ -3,6 +3,7 @@ import logging
 from copy import copy
 
 from django.db import transaction
+from django.db.models import QuerySet
 from django.http import HttpResponse
 
 from rest_framework.exceptions import PermissionDenied
@@ -10,11 +11,19 @@ from rest_framework.exceptions import PermissionDenied
 from api_basebone.core import exceptions
 from api_basebone.settings import settings
 from api_basebone.signals import post_bsm_create, post_bsm_delete
+from api_basebone.models import append_bulk_log
 from api_basebone.restful.funcs import find_func
 from api_basebone.restful.relations import forward_relation_hand, reverse_relation_hand
+from api_basebone.restful.serializers import RepresentationPlan, RowEncoder
+from api_basebone.utils import queryset as queryset_utils
+from api_basebone.utils.cache import bump_model_version
+from api_basebone.utils.tree import TreeLoader
 from api_basebone.drf.response import success_response
 
 from api_basebone.restful.client import user_pip as client_user_pip
+from api_basebone.restful.manage import user_pip as manage_user_pip
+from api_basebone.services import upsert
+from api_basebone.services.rollup import refresh_instances
 
 log = logging.getLogger(__name__)
 
@@ -96,20 +105,79 @@ def filter_sub_display_fields(display_fields_set, record, prefix=''):
     return display_record
 
 
+def get_row_encoder(genericAPIView, queryset):
+    """获取只读接口使用的行编码器，不支持时返回 None"""
+    if not settings.ROW_ENCODER_ENABLE or not isinstance(queryset, QuerySet):
+        return None
+    encoder = RowEncoder.compile(genericAPIView.get_serializer(many=True))
+    if encoder is None or not encoder.supports(queryset):
+        return None
+    return encoder
+
+
+def load_tree(genericAPIView, nodes, queryset):
+    """树形数据一次性加载所有的子孙节点
+
+    Params:
+        nodes list 根节点
+        queryset queryset 根节点的结果集，子孙节点使用同样的 prefetch 配置
+    """
+    tree_data = genericAPIView.tree_data
+    tree_loader = TreeLoader(
+        queryset.model,
+        tree_data[0],
+        max_depth=getattr(genericAPIView, 'tree_max_depth', None),
+    )
+    tree_loader.load(
+        nodes,
+        prefetch_lookups=[
+            *queryset_utils.get_select_related_paths(queryset),
+            *getattr(queryset, '_prefetch_related_lookups', ()),
+        ],
+        child_count=getattr(genericAPIView, 'tree_child_count', False),
+    )
+    return tree_loader
+
+
 def display(genericAPIView, display_fields):
     """查询操作，取名display，避免跟列表list冲突"""
     queryset = genericAPIView.filter_queryset(genericAPIView.get_queryset())
 
-    page = genericAPIView.paginate_queryset(queryset)
+    encoder = get_row_encoder(genericAPIView, queryset)
+    if encoder is not None:
+        # 使用行编码器时，分页的也是 values 结果集
+        source = encoder.values_queryset(queryset)
+    else:
+        source = queryset
+
+    def serialize(data):
+        if encoder is not None:
+            return encoder.encode(data, queryset)
+        if not getattr(genericAPIView, 'tree_data', None):
+            return genericAPIView.get_serializer(data, many=True).data
+
+        # 树形数据在序列化之前已经组装好
+        data = list(data)
+        tree_loader = load_tree(genericAPIView, data, queryset)
+        result = genericAPIView.get_serializer(data, many=True).data
+        if getattr(genericAPIView, 'tree_child_count', False):
+            # 子节点的键和序列化输出时一致，反向字段使用字段名称
+            related_name = genericAPIView.tree_data[1]
+            plan = RepresentationPlan.for_class(genericAPIView.get_serializer_class())
+            children_key = plan.reverse_field_map.get(related_name, related_name)
+            tree_loader.fill_child_counts(
+                result, data, children_key, f'{children_key}_count'
+            )
+        return result
+
+    page = genericAPIView.paginate_queryset(source)
     if page is not None:
         """分页查询"""
-        serializer = genericAPIView.get_serializer(page, many=True)
-        result = filter_display_fields(serializer.data, display_fields)
+        result = filter_display_fields(serialize(page), display_fields)
         response = genericAPIView.get_paginated_response(result)
         result = response.data
     else:
-        serializer = genericAPIView.get_serializer(queryset, many=True)
-        result = filter_display_fields(serializer.data, display_fields)
+        result = filter_display_fields(serialize(source), display_fields)
     return success_response(result)
 
 
@@ -228,6 +296,23 @@ def client_create(genericAPIView, request, set_data):
         return success_response(serializer.data)
 
 
+def after_bulk_write(genericAPIView, items, old_instances=()):
+    """批量写入不发送保存的信号，在这里完成保存信号的处理
+
+    - 模型的数据缓存失效
+    - 刷新写入的数据所在的汇总行，修改的数据原来所在的汇总行也需要刷新
+    - 记录动作日志
+
+    Params:
+        items list 元素为 (写入的数据, 是否新建)
+        old_instances list 修改的数据修改前的数据
+    """
+    model = genericAPIView.model
+    bump_model_version(model)
+    refresh_instances(model, list(old_instances) + [instance for instance, _ in items])
+    append_bulk_log(model, items, genericAPIView.request)
+
+
 def manage_create(genericAPIView, request, set_data):
     """
         这里校验表单和序列化类分开创建
@@ -245,7 +330,8 @@ def manage_create(genericAPIView, request, set_data):
         instance = genericAPIView.perform_create(serializer)
 
         if many:
-            # 如果是批量插入，则直接返回
+            # 如果是批量插入，则直接返回，批量插入不发送保存的信号
+            after_bulk_write(genericAPIView, [(item, True) for item in instance])
             return success_response()
 
         # 如果有联合查询，单个对象创建后并没有联合查询
@@ -269,6 +355,42 @@ def manage_create(genericAPIView, request, set_data):
     return success_response(serializer.data)
 
 
+def manage_upsert(genericAPIView, request, data):
+    """按冲突字段批量新增或者更新数据
+
+    Returns:
+        新增、更新和没有变化的数据量
+    """
+    form = upsert.UpsertForm(data=data)
+    form.is_valid(raise_exception=True)
+    model = genericAPIView.model
+
+    prepare = None
+    if not request.user.is_anonymous:
+        def prepare(row, action):
+            manage_user_pip.insert_user_info(row, model, request.user.id, action)
+
+    with transaction.atomic():
+        rows = form.validated_data['data']
+        forward_relation_hand(model, rows)
+        writer = upsert.Upsert(
+            model,
+            form.validated_data['conflict_fields'],
+            genericAPIView.get_create_form(),
+            genericAPIView.get_update_form(),
+            context=genericAPIView.get_serializer_context(),
+            prepare=prepare,
+            queryset=genericAPIView.get_queryset(),
+        )
+        result = writer.run(rows)
+        after_bulk_write(
+            genericAPIView,
+            [(instance, old_instance is None) for old_instance, instance in writer.written],
+            [old_instance for old_instance, _ in writer.written],
+        )
+    return success_response(result)
+
+
 def client_update(genericAPIView, request, partial, set_data):
     """全量更新数据"""
     with transaction.atomic():
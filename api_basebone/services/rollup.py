@@ -0,0 +1,395 @@
+"""
+预聚合的汇总表
+
+模型的 GMeta 中声明汇总的维度和指标，原始数据按维度汇总到 RollupBucket 中。BSM 接口
+写入数据后按维度刷新受影响的汇总行，bsm_rollup 命令全量重建，用于定期校正接口以外的
+写入。分组统计的维度和指标可以由汇总数据得到时，直接读取汇总表，不再对原始表做分组
+
+GMeta 中的声明如下，维度只支持模型自身的字段，指标只支持可以再次汇总的方法：
+
+rollups = {
+    'daily': {
+        'group': {
+            'day': {'field': 'created_at', 'method': 'TruncDay'},
+            'status': {'field': 'status'},
+        },
+        'metrics': {
+            'amount': {'field': 'amount', 'method': 'sum'},
+            'orders': {'field': 'id', 'method': 'count'},
+        },
+    },
+}
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+
+import pytz
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q, Sum
+from django.db.models.functions import TruncDay, TruncHour, TruncMonth
+from django.db.models.functions.datetime import TruncBase
+
+from api_basebone.utils.cache import LRUCache
+from api_basebone.utils.gmeta import get_gmeta_pure_config
+
+log = logging.getLogger(__name__)
+
+# GMeta 中声明汇总的配置项
+GMETA_ROLLUPS = 'rollups'
+
+# 维度支持的时间粒度
+TRUNC_FUNCTIONS = {'TruncDay': TruncDay, 'TruncMonth': TruncMonth, 'TruncHour': TruncHour}
+TRUNC_KINDS = {function.kind: function for function in TRUNC_FUNCTIONS.values()}
+
+# 指标的方法，汇总行再次汇总时使用的方法
+METRIC_METHODS = {
+    'sum': (Sum, sum),
+    'Sum': (Sum, sum),
+    'count': (Count, sum),
+    'Count': (Count, sum),
+    'Max': (Max, max),
+    'Min': (Min, min),
+}
+
+# 汇总时维度和指标的别名的前缀，避免和模型的字段重名
+ALIAS_PREFIX = '_rollup_'
+
+# 模型的汇总声明的缓存，键为模型的 label
+rollup_cache = LRUCache(maxsize=1024, name='rollup')
+
+
+class RollupEncoder(DjangoJSONEncoder):
+    """时间保留完整的精度，DjangoJSONEncoder 只保留到毫秒"""
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def dumps(value):
+    return json.loads(json.dumps(value, cls=RollupEncoder))
+
+
+def get_field_by_path(model, path):
+    """根据 a__b 形式的路径获取最终的字段"""
+    *relations, name = path.split('__')
+    for item in relations:
+        model = model._meta.get_field(item).related_model
+    return model._meta.get_field(name)
+
+
+def truncate(value, kind):
+    """和数据库中按 UTC 截断时间的结果保持一致"""
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(pytz.UTC)
+        value = value.replace(minute=0, second=0, microsecond=0)
+        if kind == 'hour':
+            return value
+        value = value.replace(hour=0)
+    if kind == 'month':
+        value = value.replace(day=1)
+    return value
+
+
+def truncate_end(value, kind):
+    """截断后的时间所在区间的结束时间"""
+    if kind == 'hour':
+        return value + datetime.timedelta(hours=1)
+    if kind == 'day':
+        return value + datetime.timedelta(days=1)
+    if value.month == 12:
+        return value.replace(year=value.year + 1, month=1)
+    return value.replace(month=value.month + 1)
+
+
+class Rollup:
+    """模型的一个汇总声明
+
+    Params:
+        model class 模型
+        name str 汇总的名称
+        group dict 维度，格式和分组统计的 group 相同
+        metrics dict 指标，格式和分组统计的 fields 相同
+    """
+
+    def __init__(self, model, name, group, metrics):
+        self.model = model
+        self.label = f'{model._meta.label}:{name}'
+        self.signature = hashlib.md5(
+            json.dumps([group, metrics], sort_keys=True).encode()
+        ).hexdigest()
+
+        # 维度，键为维度的名称，值为 (字段, 时间粒度)
+        self.dimensions = {}
+        for key, value in group.items():
+            field = model._meta.get_field(value['field'])
+            method = value.get('method')
+            if not field.concrete or field.many_to_many or (
+                method and method not in TRUNC_FUNCTIONS
+            ):
+                raise ImproperlyConfigured(f'汇总 {self.label} 的维度 {key} 不合法')
+            kind = TRUNC_FUNCTIONS[method].kind if method else None
+            self.dimensions[key] = (field, kind)
+
+        # 指标，键为指标的名称，值为 (字段的路径, 方法)
+        self.metrics = {}
+        for key, value in metrics.items():
+            if value.get('method') not in METRIC_METHODS or value.get('distinct'):
+                raise ImproperlyConfigured(f'汇总 {self.label} 的指标 {key} 不合法')
+            self.metrics[key] = (value['field'].replace('.', '__'), value['method'])
+
+    def get_group_kwargs(self):
+        return {
+            ALIAS_PREFIX + key: TRUNC_KINDS[kind](field.name, tzinfo=pytz.UTC)
+            if kind
+            else F(field.name)
+            for key, (field, kind) in self.dimensions.items()
+        }
+
+    def aggregate(self, queryset):
+        """在原始数据上按维度汇总"""
+        group_kwargs = self.get_group_kwargs()
+        return (
+            queryset.order_by()
+            .annotate(**group_kwargs)
+            .values(*group_kwargs)
+            .annotate(
+                **{
+                    ALIAS_PREFIX + key: METRIC_METHODS[method][0](path)
+                    for key, (path, method) in self.metrics.items()
+                }
+            )
+        )
+
+    def get_key(self, dimensions):
+        """汇总行的标识"""
+        return hashlib.md5(json.dumps(dumps(dimensions), sort_keys=True).encode()).hexdigest()
+
+    def get_bucket(self, row):
+        """从汇总结果中拆分出维度和指标"""
+        dimensions = dumps({key: row[ALIAS_PREFIX + key] for key in self.dimensions})
+        metrics = dumps({key: row[ALIAS_PREFIX + key] for key in self.metrics})
+        return self.get_key(dimensions), dimensions, metrics
+
+    def get_instance_dimensions(self, instance):
+        """数据所在的汇总行的维度"""
+        return {
+            key: truncate(getattr(instance, field.attname), kind)
+            if kind
+            else getattr(instance, field.attname)
+            for key, (field, kind) in self.dimensions.items()
+        }
+
+    def get_dimensions_filter(self, dimensions):
+        """汇总行对应的原始数据的筛选条件，时间维度使用区间，可以利用索引"""
+        condition = Q()
+        for key, (field, kind) in self.dimensions.items():
+            value = dimensions[key]
+            if value is None:
+                condition &= Q(**{f'{field.name}__isnull': True})
+            elif kind:
+                condition &= Q(
+                    **{
+                        f'{field.name}__gte': value,
+                        f'{field.name}__lt': truncate_end(value, kind),
+                    }
+                )
+            else:
+                condition &= Q(**{field.attname: value})
+        return condition
+
+    def is_built(self):
+        """汇总表是否已经按当前的声明重建过"""
+        from api_basebone.models import RollupState
+
+        return RollupState.objects.filter(
+            name=self.label, signature=self.signature
+        ).exists()
+
+    def rebuild(self):
+        """全量重建汇总表，返回汇总行的数量"""
+        from api_basebone.models import RollupBucket, RollupState
+
+        buckets = [
+            RollupBucket(rollup=self.label, key=key, dimensions=dimensions, metrics=metrics)
+            for key, dimensions, metrics in map(
+                self.get_bucket, self.aggregate(self.model._base_manager.all())
+            )
+        ]
+        with transaction.atomic():
+            RollupBucket.objects.filter(rollup=self.label).delete()
+            RollupBucket.objects.bulk_create(buckets, batch_size=1000)
+            RollupState.objects.update_or_create(
+                name=self.label, defaults={'signature': self.signature}
+            )
+        return len(buckets)
+
+    def refresh(self, instances):
+        """刷新数据所在的汇总行
+
+        Params:
+            instances list 数据，更新时包含修改前和修改后的数据
+        """
+        from api_basebone.models import RollupBucket
+
+        refreshed = set()
+        for instance in instances:
+            dimensions = self.get_instance_dimensions(instance)
+            key = self.get_key(dimensions)
+            if key in refreshed:
+                continue
+            refreshed.add(key)
+
+            # 不能使用 first()，按主键排序会加入分组
+            rows = list(
+                self.aggregate(
+                    self.model._base_manager.filter(
+                        self.get_dimensions_filter(dimensions)
+                    )
+                )
+            )
+            if not rows:
+                RollupBucket.objects.filter(rollup=self.label, key=key).delete()
+                continue
+            key, dimensions, metrics = self.get_bucket(rows[0])
+            RollupBucket.objects.update_or_create(
+                rollup=self.label,
+                key=key,
+                defaults={'dimensions': dimensions, 'metrics': metrics},
+            )
+
+    def match(self, group_kwargs, fields):
+        """分组统计的维度和指标是否可以由汇总数据得到
+
+        Returns:
+            (维度的映射, 指标的映射)，键为分组统计中的名称，值为汇总中的名称，
+            不能使用汇总数据时返回 None
+        """
+        dimensions = {
+            (field.name, kind): key for key, (field, kind) in self.dimensions.items()
+        }
+        group_map = {}
+        for key, expression in group_kwargs.items():
+            name = dimensions.get(get_expression_dimension(expression))
+            if name is None:
+                return None
+            group_map[key] = name
+
+        # sum 和 Sum 等写法相同的方法使用聚合函数比较
+        metrics = {
+            (path, METRIC_METHODS[method][0]): key
+            for key, (path, method) in self.metrics.items()
+        }
+        metric_map = {}
+        for key, value in fields.items():
+            method = METRIC_METHODS.get(value.get('method'))
+            if method is None or value.get('distinct'):
+                return None
+            name = metrics.get((value['field'].replace('.', '__'), method[0]))
+            if name is None:
+                return None
+            metric_map[key] = name
+        return group_map, metric_map
+
+    def read(self, group_map, metric_map):
+        """从汇总表读取分组统计的数据，维度比汇总少时再次汇总"""
+        from api_basebone.models import RollupBucket
+
+        rows = {}
+        for dimensions, metrics in RollupBucket.objects.filter(
+            rollup=self.label
+        ).values_list('dimensions', 'metrics'):
+            group = tuple(dimensions[name] for name in group_map.values())
+            rows.setdefault(group, []).append(metrics)
+
+        result = []
+        for group, items in rows.items():
+            row = {
+                key: self.to_python(self.dimensions[name][0], value)
+                for (key, name), value in zip(group_map.items(), group)
+            }
+            for key, name in metric_map.items():
+                path, method = self.metrics[name]
+                values = [item[name] for item in items if item[name] is not None]
+                if METRIC_METHODS[method][0] is Count:
+                    row[key] = sum(values)
+                    continue
+                field = get_field_by_path(self.model, path)
+                values = [self.to_python(field, item) for item in values]
+                row[key] = METRIC_METHODS[method][1](values) if values else None
+            result.append(row)
+        return result
+
+    def to_python(self, field, value):
+        return None if value is None else field.to_python(value)
+
+
+def get_expression_dimension(expression):
+    """分组统计的维度表达式对应的 (字段, 时间粒度)，其他表达式返回 None"""
+    if isinstance(expression, F):
+        return expression.name, None
+    if isinstance(expression, TruncBase) and expression.tzinfo in (None, pytz.UTC):
+        source = expression.get_source_expressions()[0]
+        if isinstance(source, F):
+            return source.name, expression.kind
+    return None
+
+
+def get_rollups(model):
+    """获取模型的汇总声明"""
+
+    def build():
+        config = get_gmeta_pure_config(model, GMETA_ROLLUPS) or {}
+        return [
+            Rollup(model, name, value.get('group', {}), value.get('metrics', {}))
+            for name, value in config.items()
+        ]
+
+    return rollup_cache.get_or_set(model._meta.label, build)
+
+
+def refresh_instances(model, instances):
+    """数据写入后刷新所在的汇总行，汇总表还没有重建时跳过"""
+    for rollup in get_rollups(model):
+        if rollup.is_built():
+            rollup.refresh([item for item in instances if item is not None])
+
+
+def read_group_statistics(queryset, fields, group_kwargs, **kwargs):
+    """分组统计可以由汇总数据得到时，从汇总表读取
+
+    结果集有过滤条件，或者需要对汇总后的数据做过滤时，汇总数据无法使用
+
+    Returns:
+        数据的列表，不能使用汇总数据时返回 None
+    """
+    query = queryset.query
+    if query.where.children or query.distinct or kwargs.get('filters'):
+        return None
+
+    for rollup in get_rollups(queryset.model):
+        matched = rollup.match(group_kwargs, fields)
+        if matched is None or not rollup.is_built():
+            continue
+        log.debug(f'group statistics read from rollup: {rollup.label}')
+        rows = rollup.read(*matched)
+
+        # 和原始查询的排序保持一致，指定了排序字段时按排序字段，否则按维度排序
+        for key in reversed(kwargs.get('sort_keys') or list(group_kwargs)):
+            name = key.lstrip('-')
+            rows.sort(
+                key=lambda row: (row[name] is not None, row[name]),
+                reverse=key.startswith('-'),
+            )
+        top_max = kwargs.get('top_max')
+        return rows[:top_max] if top_max else rows
+    return None
@@ -0,0 +1,415 @@
+"""
+按唯一字段批量写入数据
+
+上游系统同步数据时，按冲突字段（唯一的自然键）判断数据是新增还是更新。每批数据只查询一次
+已有的数据，新增的数据使用创建表单校验，已有的数据使用更新表单部分校验，校验后和数据库中的
+值相同的数据不写入
+
+数据库支持时（PostgreSQL、SQLite 3.24+、MySQL），新增和更新的数据合并为一条
+INSERT ... ON CONFLICT / ON DUPLICATE KEY UPDATE 语句写入，查询后其他请求插入的同键
+数据也会被更新而不是报错；其他数据库使用 bulk_create 和 bulk_update 写入
+
+已有的数据需要在接口可以操作的结果集中，和单条更新一样受数据权限的限制；限制了结果集时，
+新增的数据使用普通的插入语句，查询后其他请求插入的同键数据不会被更新，而是返回这一行的错误
+
+包含多对多、嵌套数据的行，以及表单、模型不支持批量写入时，逐行使用表单保存
+"""
+
+from copy import copy
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import DatabaseError, connections, router, transaction
+from django.db.models import AutoField, Q, UniqueConstraint
+from django.db.models.sql import InsertQuery
+from rest_framework import serializers
+from rest_framework.settings import api_settings
+from rest_framework.validators import UniqueTogetherValidator, UniqueValidator
+
+from api_basebone.core import exceptions
+from api_basebone.restful.forms import has_nested_writes, support_bulk_write
+from api_basebone.settings import settings as basebone_settings
+
+
+def get_unique_field_sets(model):
+    """模型中所有唯一约束的字段集合"""
+    opts = model._meta
+    field_sets = [{field.name} for field in opts.concrete_fields if field.unique]
+    field_sets += [set(fields) for fields in opts.unique_together]
+    field_sets += [
+        set(constraint.fields)
+        for constraint in opts.constraints
+        if isinstance(constraint, UniqueConstraint) and constraint.condition is None
+    ]
+    return field_sets
+
+
+def supports_upsert(connection):
+    """数据库是否支持插入冲突时更新"""
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 24)
+    return connection.vendor == 'mysql'
+
+
+def get_conflict_suffix(connection, model, conflict_fields, update_fields):
+    """插入语句冲突时更新的子句"""
+    qn = connection.ops.quote_name
+    opts = model._meta
+    update_columns = [qn(opts.get_field(name).column) for name in update_fields]
+
+    if connection.vendor == 'mysql':
+        if not update_columns:
+            update_columns = [qn(opts.pk.column)]
+        return 'ON DUPLICATE KEY UPDATE ' + ', '.join(
+            f'{column} = VALUES({column})' for column in update_columns
+        )
+
+    conflict_columns = ', '.join(qn(opts.get_field(name).column) for name in conflict_fields)
+    if not update_columns:
+        return f'ON CONFLICT ({conflict_columns}) DO NOTHING'
+    # SQLite 中 INSERT ... SELECT 需要 WHERE 子句才能解析 ON CONFLICT
+    where = 'WHERE true ' if connection.vendor == 'sqlite' else ''
+    return f'{where}ON CONFLICT ({conflict_columns}) DO UPDATE SET ' + ', '.join(
+        f'{column} = EXCLUDED.{column}' for column in update_columns
+    )
+
+
+def insert_on_conflict(model, objs, conflict_fields, update_fields, using):
+    """插入数据，冲突字段的值已经存在时更新 update_fields 中的字段"""
+    connection = connections[using]
+    opts = model._meta
+    # 主键由数据库生成且不是冲突字段时不插入主键，已有的数据通过冲突字段匹配
+    skip_pk = any(obj.pk is None for obj in objs) or (
+        isinstance(opts.pk, AutoField) and opts.pk.name not in conflict_fields
+    )
+    fields = [field for field in opts.concrete_fields if not (field.primary_key and skip_pk)]
+    suffix = get_conflict_suffix(connection, model, conflict_fields, update_fields)
+    batch_size = max(connection.ops.bulk_batch_size(fields, objs), 1)
+
+    with connection.cursor() as cursor:
+        for start in range(0, len(objs), batch_size):
+            query = InsertQuery(model)
+            query.insert_values(fields, objs[start:start + batch_size])
+            for sql, params in query.get_compiler(using=using).as_sql():
+                cursor.execute(f'{sql} {suffix}', params)
+
+
+class UpsertForm(serializers.Serializer):
+    """批量新增或者更新的验证表单"""
+
+    conflict_fields = serializers.ListField(child=serializers.CharField(), min_length=1)
+    data = serializers.ListField(child=serializers.DictField(), min_length=1)
+
+
+class Upsert:
+    """按冲突字段批量新增或者更新数据
+
+    Params:
+        model class 模型类
+        conflict_fields list 冲突字段，需要是模型中的一个唯一约束
+        create_form class 新增数据的表单类
+        update_form class 更新数据的表单类
+        context dict 表单的上下文
+        prepare function 校验前处理每行数据，参数为 (数据, 'create' | 'update')
+        queryset 可以更新的数据的结果集，例如接口按用户、权限过滤后的结果集，冲突字段的值
+            对应的已有数据不在其中时，返回这一行的错误，不更新这条数据
+    """
+
+    def __init__(
+        self,
+        model,
+        conflict_fields,
+        create_form,
+        update_form,
+        context=None,
+        prepare=None,
+        queryset=None,
+    ):
+        self.model = model
+        self.conflict_fields = list(conflict_fields)
+        self.using = router.db_for_write(model)
+        self.prepare = prepare
+        self.scope = queryset
+        # 写入的数据，元素为 (修改前的数据, 写入后的数据)，新增的数据修改前的数据为 None
+        self.written = []
+        self.check_conflict_fields()
+
+        self.fields = [model._meta.get_field(name) for name in self.conflict_fields]
+        self.many_to_many = {field.name for field in model._meta.many_to_many}
+        self.bulk = support_bulk_write(model, create_form) and support_bulk_write(
+            model, update_form, 'update'
+        )
+        self.upsert = supports_upsert(connections[self.using])
+
+        # 表单实例在所有行之间共享，冲突字段的唯一性由查询和数据库的约束保证，不再逐行查询校验
+        self.create_form = self.get_form(create_form, context)
+        self.update_form = self.get_form(update_form, context, partial=True)
+
+    def check_conflict_fields(self):
+        opts = self.model._meta
+        names = set(self.conflict_fields)
+        for name in names:
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                field = None
+            if not (field and field.concrete and not field.many_to_many):
+                raise exceptions.BusinessException(
+                    error_code=exceptions.PARAMETER_FORMAT_ERROR,
+                    error_data=f'conflict_fields: {name} 不是模型的字段',
+                )
+        if names != {opts.pk.name} and names not in get_unique_field_sets(self.model):
+            raise exceptions.BusinessException(
+                error_code=exceptions.PARAMETER_FORMAT_ERROR,
+                error_data=f'conflict_fields: {self.conflict_fields} 不是模型的唯一约束',
+            )
+
+    def get_form(self, form_class, context, partial=False):
+        form = form_class(context=context, partial=partial)
+        names = set(self.conflict_fields)
+        for name in names:
+            if name in form.fields:
+                field = form.fields[name]
+                field.validators = [
+                    item for item in field.validators if not isinstance(item, UniqueValidator)
+                ]
+        form.validators = [
+            item
+            for item in form.validators
+            if not (isinstance(item, UniqueTogetherValidator) and set(item.fields) == names)
+        ]
+        return form
+
+    def get_key(self, row):
+        """行数据中冲突字段的值"""
+        try:
+            return tuple(field.to_python(row[field.name]) for field in self.fields)
+        except (KeyError, TypeError, ValueError, ValidationError):
+            return None
+
+    def get_instance_key(self, instance):
+        return tuple(getattr(instance, field.attname) for field in self.fields)
+
+    def get_queryset(self, keys, rows):
+        queryset = self.model._default_manager.using(self.using).order_by()
+        if len(self.fields) == 1:
+            queryset = queryset.filter(
+                **{f'{self.fields[0].attname}__in': [key[0] for key in keys]}
+            )
+        else:
+            condition = Q()
+            for key in keys:
+                condition |= Q(
+                    **{field.attname: value for field, value in zip(self.fields, key)}
+                )
+            queryset = queryset.filter(condition)
+
+        many_to_many = [name for name in self.many_to_many if any(name in row for row in rows)]
+        if many_to_many:
+            queryset = queryset.prefetch_related(*many_to_many)
+        return queryset
+
+    def get_allowed_pks(self, instances):
+        """已有的数据中可以更新的数据的主键，没有限制时返回 None"""
+        if self.scope is None:
+            return None
+        pks = [item.pk for item in instances]
+        if not pks:
+            return set()
+        return set(
+            self.scope.using(self.using)
+            .filter(pk__in=pks)
+            .order_by()
+            .values_list('pk', flat=True)
+        )
+
+    def is_changed(self, instance, attrs):
+        """校验后的数据和数据库中的值是否不同"""
+        opts = self.model._meta
+        for name, value in attrs.items():
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                return True
+            if field.many_to_many:
+                current = {item.pk for item in getattr(instance, name).all()}
+                if current != {getattr(item, 'pk', item) for item in value}:
+                    return True
+            elif field.is_relation:
+                value = getattr(value, field.target_field.attname, value)
+                if getattr(instance, field.attname) != value:
+                    return True
+            elif getattr(instance, field.attname) != value:
+                return True
+        return False
+
+    def run(self, rows):
+        """写入数据
+
+        Returns:
+            dict 新增、更新和没有变化的数据量
+        """
+        result = {'created': 0, 'updated': 0, 'unchanged': 0}
+        errors = [{} for _ in rows]
+        batch_size = basebone_settings.BULK_CREATE_BATCH_SIZE
+        with transaction.atomic(using=self.using):
+            for start in range(0, len(rows), batch_size):
+                self.run_batch(rows[start:start + batch_size], start, errors, result)
+            if any(errors):
+                raise serializers.ValidationError(errors)
+        return result
+
+    def run_batch(self, rows, offset, errors, result):
+        keys, seen = [], {}
+        for index, row in enumerate(rows, offset):
+            key = self.get_key(row) if isinstance(row, dict) else None
+            if key is None or None in key:
+                errors[index] = {
+                    api_settings.NON_FIELD_ERRORS_KEY: [f'缺少冲突字段 {self.conflict_fields} 的值']
+                }
+            elif key in seen:
+                errors[index] = {
+                    api_settings.NON_FIELD_ERRORS_KEY: [f'冲突字段的值和索引为 {seen[key]} 的行重复']
+                }
+            else:
+                seen[key] = index
+            keys.append(key)
+
+        existing = {}
+        if seen:
+            queryset = self.get_queryset(list(seen), [row for row in rows if isinstance(row, dict)])
+            existing = {self.get_instance_key(item): item for item in queryset}
+        allowed = self.get_allowed_pks(existing.values())
+
+        writes, saves = [], []
+        for index, row in enumerate(rows, offset):
+            if errors[index]:
+                continue
+            instance = existing.get(keys[index - offset])
+            if instance is not None and allowed is not None and instance.pk not in allowed:
+                errors[index] = {
+                    api_settings.NON_FIELD_ERRORS_KEY: ['冲突字段的值对应的数据不在可以更新的范围内']
+                }
+                continue
+            action = 'create' if instance is None else 'update'
+            if self.prepare:
+                self.prepare(row, action)
+
+            form = self.create_form if instance is None else self.update_form
+            form.instance = instance
+            try:
+                attrs = form.run_validation(row)
+            except serializers.ValidationError as e:
+                errors[index] = serializers.as_serializer_error(e)
+                continue
+
+            if instance is not None and not self.is_changed(instance, attrs):
+                result['unchanged'] += 1
+                continue
+            result['created' if instance is None else 'updated'] += 1
+            old_instance = copy(instance) if instance is not None else None
+
+            if not self.bulk or has_nested_writes(attrs) or self.many_to_many.intersection(attrs):
+                saves.append((index, form, instance, attrs, old_instance))
+                continue
+            if instance is None:
+                instance = self.model(**attrs)
+            else:
+                for name, value in attrs.items():
+                    setattr(instance, name, value)
+            writes.append((index, instance, attrs))
+            self.written.append((old_instance, instance))
+
+        if any(errors):
+            return
+
+        for index, form, instance, attrs, old_instance in saves:
+            obj = self.save_row(errors, index, form, instance, attrs)
+            self.written.append((old_instance, obj))
+        if writes:
+            self.write(writes, errors)
+
+    def save_row(self, errors, index, form, instance, attrs):
+        """逐行使用表单保存"""
+        try:
+            with transaction.atomic(using=self.using):
+                if instance is None:
+                    return form.create(attrs)
+                return form.update(instance, attrs)
+        except DatabaseError as e:
+            errors[index] = {api_settings.NON_FIELD_ERRORS_KEY: [str(e)]}
+
+    def get_update_fields(self, writes):
+        """需要更新的字段，包括传入的字段和自动更新时间的字段"""
+        opts = self.model._meta
+        names = set()
+        for _, _, attrs in writes:
+            names.update(attrs)
+        names.update(
+            field.name for field in opts.concrete_fields if getattr(field, 'auto_now', False)
+        )
+        return [
+            field.name
+            for field in opts.concrete_fields
+            if field.name in names
+            and not field.primary_key
+            and field.name not in self.conflict_fields
+        ]
+
+    def write(self, writes, errors):
+        """在一个保存点中写入一批数据，失败时逐行写入以找出出错的行"""
+        update_fields = self.get_update_fields(writes)
+        states = [(instance.pk, instance._state.adding) for _, instance, _ in writes]
+        try:
+            with transaction.atomic(using=self.using):
+                self.write_objs([instance for _, instance, _ in writes], update_fields)
+        except DatabaseError:
+            # 保存点回滚后，恢复批量插入时设置的主键和状态
+            for (_, instance, _), (pk, adding) in zip(writes, states):
+                instance.pk, instance._state.adding = pk, adding
+            for index, instance, _ in writes:
+                try:
+                    with transaction.atomic(using=self.using):
+                        self.write_objs([instance], update_fields)
+                except DatabaseError as e:
+                    errors[index] = {api_settings.NON_FIELD_ERRORS_KEY: [str(e)]}
+
+    def write_objs(self, objs, update_fields):
+        manager = self.model._default_manager.db_manager(self.using)
+        if self.upsert and self.scope is not None:
+            # 限制了结果集时，新增的数据不能通过冲突更新结果集以外的数据
+            created = [obj for obj in objs if obj._state.adding]
+            objs = [obj for obj in objs if not obj._state.adding]
+            if created:
+                manager.bulk_create(created)
+            if not objs:
+                return
+
+        if self.upsert:
+            groups = [objs]
+            pk = self.model._meta.pk
+            if not isinstance(pk, AutoField) or pk.name in self.conflict_fields:
+                # 需要插入主键时，同一条插入语句中的数据需要都有或者都没有主键
+                groups = [
+                    [obj for obj in objs if obj.pk is None],
+                    [obj for obj in objs if obj.pk is not None],
+                ]
+            for group in groups:
+                if group:
+                    insert_on_conflict(
+                        self.model, group, self.conflict_fields, update_fields, self.using
+                    )
+            return
+
+        created = [obj for obj in objs if obj._state.adding]
+        updated = [obj for obj in objs if not obj._state.adding]
+        if created:
+            manager.bulk_create(created)
+        if updated:
+            for obj in updated:
+                for field in self.model._meta.concrete_fields:
+                    if getattr(field, 'auto_now', False):
+                        field.pre_save(obj, add=False)
+            if update_fields:
+                manager.bulk_update(updated, update_fields)
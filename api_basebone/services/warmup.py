@@ -0,0 +1,29 @@
+"""
+预先构建模型相关的注册表
+
+使用 gunicorn --preload 等在加载应用后 fork 的方式部署时，在 fork 之前构建好字段索引和
+序列化类，fork 之后的第一个请求不需要再构建
+"""
+
+import logging
+
+from django.apps import apps
+
+from api_basebone.restful.const import MANAGE_END_SLUG
+from api_basebone.restful.serializers import multiple_create_serializer_class
+from api_basebone.utils.meta import get_export_apps, get_model_index
+
+log = logging.getLogger(__name__)
+
+
+def warmup():
+    """构建导出的应用中所有模型的字段索引和管理端列表的序列化类"""
+    count = 0
+    for app_label in get_export_apps():
+        for model in apps.get_app_config(app_label).get_models():
+            get_model_index(model)
+            multiple_create_serializer_class(
+                model, [], action='list', end_slug=MANAGE_END_SLUG
+            )
+            count += 1
+    log.debug(f'warmup {count} models')
@@ -8,6 +8,37 @@ DEFAULTS = {
     'MANAGE_GUARDIAN_DATA_PERMISSION_CHECK': False,
     # 管理端使用 guardian 检测的应用模型，元素数据格式为 {app_name}__{model_name}
     'MANAGE_GUARDIAN_DATA_APP_MODELS': [],
+    # 动态构建的序列化类的缓存数量
+    'SERIALIZER_CLASS_CACHE_SIZE': 1024,
+    # 模型接口上下文的缓存数量，每个 (应用, 模型, 端) 一条
+    'ENDPOINT_CONTEXT_CACHE_SIZE': 1024,
+    # 编译后的过滤条件的缓存数量
+    'FILTER_CONDITION_CACHE_SIZE': 1024,
+    # 过滤条件中结果集类型的表达式的求值方式，subquery 作为子查询，once 每个请求只查询一次
+    'FILTER_QUERYSET_EVALUATE': 'subquery',
+    # 过滤条件中多值关系（反向外键、多对多）上的条件是否编译为子查询，子查询不会导致
+    # 数据重复，结果集无需去重；关闭时使用连接查询并对结果集去重
+    'FILTER_TO_MANY_SUBQUERY': True,
+    # 编译后的表达式的缓存数量
+    'EXPRESSION_CACHE_SIZE': 1024,
+    # 导出文件、流式输出时每批查询和序列化的数据量
+    'EXPORT_CHUNK_SIZE': 500,
+    # 批量创建、批量新增或更新时每批写入的数据量
+    'BULK_CREATE_BATCH_SIZE': 500,
+    # 只读接口（列表、导出）是否使用基于 values() 的行编码器
+    'ROW_ENCODER_ENABLE': False,
+    # 分页时缓存总数的时间，单位为秒
+    'PAGINATION_COUNT_CACHE_TIMEOUT': 60,
+    # 估算的总数小于此值时，使用准确的总数
+    'PAGINATION_ESTIMATE_THRESHOLD': 100000,
+    # 统计接口缓存结果的时间，单位为秒，0 表示不缓存，数据新增、修改、删除时缓存失效
+    'STATISTICS_CACHE_TIMEOUT': 0,
+    # 图表数据的缓存时间，单位为秒，0 表示不缓存，图表的 cache_timeout 优先
+    'CHART_CACHE_TIMEOUT': 0,
+    # 图表数据过期后仍可返回的时间，单位为秒，期间由一个请求重新计算
+    'CHART_CACHE_STALE_TIMEOUT': 300,
+    # 应用启动时是否预先构建模型的字段索引和序列化类
+    'WARMUP_ON_READY': False,
 }
 
 
@@ -0,0 +1,125 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+
+from api_basebone.core.admin import BSMAdminModule
+from api_basebone.restful.serializers import (
+    cached_serializer_class,
+    clear_serializer_class_cache,
+    create_serializer_class,
+    freeze_cache_key,
+    serializer_class_cache,
+)
+from api_basebone.utils.cache import LRUCache, get_or_refresh
+
+User = get_user_model()
+
+
+class LRUCacheTestCase(SimpleTestCase):
+    def test_eviction(self):
+        """超过容量时淘汰最久未使用的条目，读取会更新使用的顺序"""
+        lru = LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertIn('a', lru)
+        self.assertNotIn('b', lru)
+        self.assertEqual(len(lru), 2)
+
+        lru.get_or_set('d', lambda: 4)
+        self.assertEqual(list(lru._data), ['c', 'd'])
+
+    def test_counters(self):
+        lru = LRUCache(maxsize=2, name='test')
+        lru.get('a')
+        lru.set('a', 1)
+        lru.get('a')
+        self.assertEqual(lru.get_or_set('a', lambda: 2), 1)
+        self.assertEqual(lru.get_or_set('b', lambda: 2), 2)
+        lru.clear()
+        self.assertEqual(
+            lru.info(), {'name': 'test', 'hits': 2, 'misses': 2, 'size': 0, 'maxsize': 2}
+        )
+
+
+class SerializerClassCacheTestCase(SimpleTestCase):
+    """动态构建的序列化类的注册表"""
+
+    def setUp(self):
+        super().setUp()
+        clear_serializer_class_cache()
+
+    def test_freeze_cache_key(self):
+        """字典和集合的顺序不影响键，列表的顺序影响键"""
+        self.assertEqual(
+            freeze_cache_key({'b': [1, {'y': 2, 'x': 1}], 'a': {3, 1}}),
+            freeze_cache_key({'a': {1, 3}, 'b': [1, {'x': 1, 'y': 2}]}),
+        )
+        self.assertNotEqual(freeze_cache_key([1, 2]), freeze_cache_key([2, 1]))
+        hash(freeze_cache_key({'a': [{'b': {1}}]}))
+
+    def test_display_fields_order(self):
+        first = create_serializer_class(User, action='list', display_fields=['id', 'username'])
+        second = create_serializer_class(User, action='list', display_fields=['username', 'id'])
+        self.assertIs(first, second)
+        self.assertIsNot(first, create_serializer_class(User, action='list'))
+
+    def test_unhashable_key(self):
+        factory = mock.Mock(side_effect=object)
+        cached_serializer_class(('key', []), factory)
+        cached_serializer_class(('key', []), factory)
+        self.assertEqual(factory.call_count, 2)
+        self.assertEqual(len(serializer_class_cache), 0)
+
+    def test_admin_version(self):
+        """admin 模块重新注册后，注册表整体失效"""
+        hits, misses = serializer_class_cache.hits, serializer_class_cache.misses
+        serializer_class = create_serializer_class(User, action='list')
+        self.assertIs(create_serializer_class(User, action='list'), serializer_class)
+        self.assertEqual(serializer_class_cache.hits, hits + 1)
+        self.assertEqual(serializer_class_cache.misses, misses + 1)
+
+        with mock.patch.object(BSMAdminModule, 'version', BSMAdminModule.version + 1):
+            self.assertIsNot(create_serializer_class(User, action='list'), serializer_class)
+        self.assertEqual(serializer_class_cache.misses, misses + 2)
+
+
+class GetOrRefreshTestCase(TestCase):
+    """过期的结果直接返回，只有获得锁的请求重新计算"""
+
+    key = 'basebone_test:refresh'
+
+    def setUp(self):
+        super().setUp()
+        cache.delete_many([self.key, f'{self.key}:lock'])
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return self.calls
+
+    def test_fresh(self):
+        self.assertEqual(get_or_refresh(self.key, self.compute, 60), 1)
+        self.assertEqual(get_or_refresh(self.key, self.compute, 60), 1)
+        self.assertEqual(self.calls, 1)
+
+    def test_stale(self):
+        get_or_refresh(self.key, self.compute, 0, 60)
+        # 其他请求正在重新计算，返回过期的结果
+        cache.add(f'{self.key}:lock', 1)
+        self.assertEqual(get_or_refresh(self.key, self.compute, 0, 60), 1)
+        self.assertEqual(self.calls, 1)
+
+        cache.delete(f'{self.key}:lock')
+        self.assertEqual(get_or_refresh(self.key, self.compute, 0, 60), 2)
+
+    def test_wait(self):
+        """没有结果时等待计算的请求，计算的请求失败后自己计算"""
+        cache.add(f'{self.key}:lock', 1, 1)
+        self.assertEqual(
+            get_or_refresh(self.key, self.compute, 60, lock_timeout=1, interval=0.01),
+            1,
+        )
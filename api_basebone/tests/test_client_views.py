@@ -0,0 +1,90 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path
+
+from api_basebone.restful.client.views import exposed_apis
+from api_basebone.settings import settings as basebone_settings
+
+# 只包含通用客户端的路由，和 api_basebone.urls 中的一致
+urlpatterns = [
+    path(
+        'basebone/client/<str:app>__<str:model>/',
+        include(
+            ('api_basebone.restful.client.urls', 'basebone_common'),
+            namespace='client.common.basebone',
+        ),
+    ),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class ClientFilterTestCase(TestCase):
+    """客户端列表接口中多值关系上的过滤条件，结果集不会重复"""
+
+    def setUp(self):
+        super().setUp()
+        self.permissions = list(Permission.objects.order_by('pk')[:3])
+        self.first = Group.objects.create(name='first')
+        self.first.permissions.set(self.permissions[:2])
+        self.second = Group.objects.create(name='second')
+        self.second.permissions.set(self.permissions[1:])
+
+        user = get_user_model().objects.create_superuser('client', 'client@test.com', 'test')
+        self.client.force_login(user)
+        patcher = mock.patch.dict(exposed_apis, {'auth__group': {'actions': ['list']}})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def item(self, field, value, operator='='):
+        return {'field': field, 'operator': operator, 'value': value}
+
+    def list(self, filters, subquery):
+        with mock.patch.object(
+            basebone_settings, 'FILTER_TO_MANY_SUBQUERY', subquery, create=True
+        ):
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post(
+                    '/basebone/client/auth__group/list/',
+                    data={'filters': filters},
+                    content_type='application/json',
+                )
+        self.assertEqual(response.status_code, 200)
+        sql = [query['sql'] for query in context if 'auth_group' in query['sql']]
+        return [item['id'] for item in response.json()['result']], sql[-1]
+
+    def test_subquery(self):
+        codenames = [item.codename for item in self.permissions]
+        filters = [self.item('permissions.codename', codenames, 'in')]
+        expected = [self.first.pk, self.second.pk]
+
+        # 使用子查询时无需去重
+        pks, sql = self.list(filters, True)
+        self.assertEqual(pks, expected)
+        self.assertNotIn('DISTINCT', sql)
+
+        pks, sql = self.list(filters, False)
+        self.assertEqual(pks, expected)
+        self.assertIn('DISTINCT', sql)
+
+    def test_join_fallback(self):
+        """同一个多值关系的条件分布在且分组和或分组中时使用连接查询，仍然去重"""
+        codenames = [item.codename for item in self.permissions]
+        filters = [
+            self.item('permissions.codename', codenames, 'in'),
+            {
+                'operator': 'OR',
+                'children': [
+                    self.item('permissions.id', self.permissions[1].pk),
+                    self.item('name', 'first'),
+                ],
+            },
+        ]
+        for subquery in (True, False):
+            pks, sql = self.list(filters, subquery)
+            self.assertEqual(pks, [self.first.pk, self.second.pk])
+            self.assertIn('DISTINCT', sql)
@@ -0,0 +1,27 @@
+from django.contrib.auth.models import Permission
+from django.test import SimpleTestCase
+
+from api_basebone.core import exceptions
+from api_basebone.core.admin import BSMAdminModule
+from api_basebone.restful.const import CLIENT_END_SLUG, MANAGE_END_SLUG
+from api_basebone.restful.context import get_endpoint_context
+
+
+class EndpointContextTestCase(SimpleTestCase):
+    """模型接口的上下文按 (应用, 模型, 端) 缓存，admin 重新注册后失效"""
+
+    def test_cached(self):
+        context = get_endpoint_context('auth', 'permission', MANAGE_END_SLUG)
+        self.assertIs(context.model, Permission)
+        self.assertIs(get_endpoint_context('auth', 'permission', MANAGE_END_SLUG), context)
+        self.assertIsNot(get_endpoint_context('auth', 'permission', CLIENT_END_SLUG), context)
+
+        with self.assertRaises(AttributeError):
+            context.model = None
+
+        BSMAdminModule.version += 1
+        self.assertIsNot(get_endpoint_context('auth', 'permission', MANAGE_END_SLUG), context)
+
+    def test_invalid_model(self):
+        with self.assertRaises(exceptions.BusinessException):
+            get_endpoint_context('auth', 'not_exists', MANAGE_END_SLUG)
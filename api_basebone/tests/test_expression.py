@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+from api_basebone.services.expresstion import (
+    expression_cache,
+    interpret_expression,
+    resolve_expression,
+)
+
+EXPRESSIONS = [
+    'user.id',
+    ' user.username ',
+    '"text"',
+    '[1, 2]',
+    'add(user.id, mul(2, 3))',
+    'if(gt(user.id, 0), user.username, "anonymous")',
+    'contains(user.roles, "admin", "staff")',
+    'getitem(user.roles, 1)',
+    'slice(user.username, 0, 2)',
+    'Concat(F("name"), Value("-"))',
+    '__variables__()',
+]
+
+
+class ResolveExpressionTestCase(SimpleTestCase):
+    """编译后求值的结果和逐次解析的结果一致"""
+
+    def setUp(self):
+        super().setUp()
+        expression_cache.clear()
+        self.variables = SimpleNamespace(
+            user=SimpleNamespace(id=1, username='admin', roles=['admin', 'staff'])
+        )
+
+    def test_same_result(self):
+        for expression in EXPRESSIONS:
+            expected = interpret_expression(expression, self.variables)
+            for _ in range(2):
+                value = resolve_expression(expression, self.variables)
+                self.assertEqual(repr(expected), repr(value), expression)
+
+    def test_errors(self):
+        for expression in ['unknown(1)', 'user.missing']:
+            with self.assertRaises(Exception) as expected:
+                interpret_expression(expression, self.variables)
+            with self.assertRaises(type(expected.exception)):
+                resolve_expression(expression, self.variables)
+
+    def test_cache(self):
+        misses = expression_cache.misses
+        resolve_expression('user.id', self.variables)
+        resolve_expression('user.id', self.variables)
+        self.assertEqual(misses + 1, expression_cache.misses)
+
+    def test_mutable_constant(self):
+        value = resolve_expression('[1, 2]')
+        value.append(3)
+        self.assertEqual([1, 2], resolve_expression('[1, 2]'))
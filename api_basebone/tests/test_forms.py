@@ -0,0 +1,57 @@
+from unittest import mock
+
+from django.contrib.auth.models import Group, Permission
+from django.test import TestCase
+from rest_framework.exceptions import ValidationError
+
+from api_basebone.restful.forms import create_form_class
+from api_basebone.settings import settings as basebone_settings
+
+
+class BulkCreateTestCase(TestCase):
+    """列表数据批量创建"""
+
+    def get_serializer(self, data):
+        serializer = create_form_class(Group)(data=data, many=True)
+        serializer.is_valid(raise_exception=True)
+        return serializer
+
+    def test_batches(self):
+        data = [{'name': f'group-{index}'} for index in range(25)]
+        with mock.patch.object(basebone_settings, 'BULK_CREATE_BATCH_SIZE', 10, create=True):
+            serializer = self.get_serializer(data)
+            # 外层事务的保存点，3 批数据各有一个保存点
+            with self.assertNumQueries(2 + 3 * 3):
+                serializer.save()
+        self.assertEqual(
+            list(Group.objects.order_by('pk').values_list('name', flat=True)),
+            [item['name'] for item in data],
+        )
+
+    def test_many_to_many(self):
+        permissions = list(Permission.objects.values_list('pk', flat=True)[:3])
+        self.get_serializer(
+            [
+                {'name': 'a', 'permissions': permissions},
+                {'name': 'b', 'permissions': permissions[:1]},
+                {'name': 'c'},
+            ]
+        ).save()
+        groups = {group.name: group for group in Group.objects.all()}
+        self.assertEqual(
+            sorted(groups['a'].permissions.values_list('pk', flat=True)), sorted(permissions)
+        )
+        self.assertEqual(list(groups['b'].permissions.values_list('pk', flat=True)), permissions[:1])
+        self.assertFalse(groups['c'].permissions.exists())
+
+    def test_row_errors(self):
+        """表单校验无法发现的唯一约束冲突，按行号返回错误"""
+        serializer = self.get_serializer([{'name': 'a'}, {'name': 'b'}, {'name': 'a'}])
+        with self.assertRaises(ValidationError) as context:
+            serializer.save()
+        errors = context.exception.detail
+        self.assertEqual(len(errors), 3)
+        self.assertFalse(errors[0])
+        self.assertFalse(errors[1])
+        self.assertTrue(errors[2])
+        self.assertFalse(Group.objects.exists())
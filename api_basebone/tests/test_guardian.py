@@ -0,0 +1,37 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.test import TestCase
+from guardian.shortcuts import assign_perm
+
+from api_basebone.utils.guardian import filter_granted_objects, permission_cache
+
+User = get_user_model()
+
+
+class GrantedObjectsTestCase(TestCase):
+    """对象权限通过子查询筛选"""
+
+    def setUp(self):
+        super().setUp()
+        permission_cache.clear()
+        self.user = User.objects.create_user('guardian')
+        self.team = Group.objects.create(name='team')
+        self.user.groups.add(self.team)
+        self.groups = [Group.objects.create(name=f'object{index}') for index in range(4)]
+
+    def filter(self):
+        return list(filter_granted_objects(Group.objects.order_by('pk'), self.user))
+
+    def test_no_grants(self):
+        """没有任何授权数据时不做筛选，和原来的行为一致"""
+        self.assertEqual(len(self.filter()), Group.objects.count())
+
+    def test_user_and_group_grants(self):
+        assign_perm('auth.view_group', self.user, self.groups[0])
+        assign_perm('auth.view_group', self.team, self.groups[2])
+        assign_perm('auth.view_group', Group.objects.create(name='other'), self.groups[3])
+        self.assertEqual(self.filter(), [self.groups[0], self.groups[2]])
+
+        # 权限的主键已经缓存，检查授权数据是否存在，加上数据的查询
+        with self.assertNumQueries(2):
+            self.filter()
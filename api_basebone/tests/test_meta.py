@@ -0,0 +1,53 @@
+from unittest import mock
+
+from django.apps import apps
+from django.contrib.auth.models import Group, Permission
+from django.db.models.signals import class_prepared
+from django.test import SimpleTestCase
+
+from api_basebone.utils import meta
+from bsm_config.models import FieldPermission, Menu
+
+
+class ModelIndexTestCase(SimpleTestCase):
+    """模型字段的索引"""
+
+    def setUp(self):
+        super().setUp()
+        meta.clear_model_index()
+
+    def test_contents(self):
+        index = meta.get_model_index(Group)
+        self.assertEqual(index.fields, tuple(Group._meta.get_fields()))
+        self.assertEqual(index.flat_fields, ('id', 'name'))
+        self.assertIn(Group._meta.get_field('permissions'), index.relation_fields)
+        self.assertEqual(index.related_model_fields[Permission].name, 'permissions')
+
+        # 反向字段的 related_name 和字段名称
+        reverse_field = Group._meta.get_field('fieldpermission')
+        self.assertIn(reverse_field, index.reverse_fields)
+        self.assertEqual(index.reverse_field_map['fieldpermission_set'], 'fieldpermission')
+        self.assertEqual(index.accessor_names['fieldpermission'], 'fieldpermission_set')
+        self.assertIs(index.get_field('fieldpermission_set'), reverse_field)
+        self.assertIs(index.get_field('menus'), Group._meta.get_field('menus'))
+        self.assertIsNone(index.get_field('missing'))
+
+        self.assertEqual(meta.get_reverse_fields(FieldPermission), [])
+        self.assertEqual(meta.get_related_model_field(Menu, Menu).name, 'parent')
+
+    def test_cached(self):
+        self.assertIs(meta.get_model_index(Group), meta.get_model_index(Group))
+
+    def test_class_prepared(self):
+        """有新的模型加入时，已有的索引失效"""
+        index = meta.get_model_index(Group)
+        class_prepared.send(sender=Permission)
+        self.assertIsNot(meta.get_model_index(Group), index)
+
+    def test_models_ready(self):
+        """模型没有全部加载完成时不做缓存"""
+        with mock.patch.object(apps, 'models_ready', False):
+            index = meta.get_model_index(Group)
+            self.assertIsNot(meta.get_model_index(Group), index)
+        self.assertIsNot(meta.get_model_index(Group), index)
+        self.assertIs(meta.get_model_index(Group), meta.get_model_index(Group))
@@ -0,0 +1,34 @@
+import sys
+import types
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from api_basebone.utils import module
+
+
+class OptionalModuleTestCase(SimpleTestCase):
+    """不存在的模块只查找一次，注入到 sys.modules 的模块优先"""
+
+    name = 'api_basebone.bsm.not_exists'
+
+    def tearDown(self):
+        module._missing_modules.discard(self.name)
+        sys.modules.pop(self.name, None)
+        super().tearDown()
+
+    def test_missing(self):
+        with mock.patch('importlib.util.find_spec', return_value=None) as find_spec:
+            self.assertIsNone(module.import_optional_module(self.name))
+            self.assertIsNone(module.import_optional_module(self.name))
+        self.assertEqual(find_spec.call_count, 1)
+
+    def test_injected(self):
+        module.import_optional_module(self.name)
+        injected = sys.modules[self.name] = types.ModuleType(self.name)
+        self.assertIs(module.import_optional_module(self.name), injected)
+
+        # 重新加载后不存在的模块会重新查找
+        sys.modules.pop(self.name)
+        module.reload_modules([self.name])
+        self.assertNotIn(self.name, module._missing_modules)
@@ -0,0 +1,101 @@
+from django.contrib.auth.models import Permission
+from django.db.models.functions import Lower
+from django.test import TestCase
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from api_basebone.drf.pagination import CursorPagination, PageNumberPagination
+from api_basebone.utils.cache import bump_model_version
+
+factory = APIRequestFactory()
+
+
+class CursorPaginationTestCase(TestCase):
+    """游标分页，按页前后翻动的结果和完整的排序一致"""
+
+    def paginate(self, queryset, cursor=None, size=7):
+        params = {'size': size}
+        if cursor:
+            params['cursor'] = cursor
+        paginator = CursorPagination()
+        rows = paginator.paginate_queryset(queryset, Request(factory.get('/', params)))
+        return paginator, rows
+
+    def walk(self, queryset, key):
+        paginator, rows = self.paginate(queryset)
+        self.assertIsNone(paginator.previous_cursor)
+        forward = [key(row) for row in rows]
+        while paginator.next_cursor:
+            paginator, rows = self.paginate(queryset, paginator.next_cursor)
+            forward += [key(row) for row in rows]
+
+        backward = []
+        while paginator.previous_cursor:
+            paginator, rows = self.paginate(queryset, paginator.previous_cursor)
+            backward = [key(row) for row in rows] + backward
+        return forward, backward
+
+    def test_walk(self):
+        queryset = Permission.objects.order_by('content_type__model', '-codename')
+        expected = list(queryset.values_list('pk', flat=True))
+        forward, backward = self.walk(queryset, lambda row: row.pk)
+        self.assertEqual(forward, expected)
+        self.assertEqual(backward, expected[: len(backward)])
+        # 从最后一页向前翻到第一页
+        self.assertGreaterEqual(len(backward) + 7, len(expected))
+
+    def test_values(self):
+        queryset = Permission.objects.order_by('-content_type').values('id', 'name')
+        expected = [row['id'] for row in queryset.order_by('-content_type', '-pk')]
+        forward, _ = self.walk(queryset, lambda row: row['id'])
+        self.assertEqual(forward, expected)
+
+    def test_constant_queries(self):
+        queryset = Permission.objects.order_by('codename')
+        paginator, _ = self.paginate(queryset)
+        with self.assertNumQueries(1):
+            self.paginate(queryset, paginator.next_cursor)
+
+    def test_fallback(self):
+        """表达式排序无法作为游标的位置，使用页码分页"""
+        paginator, rows = self.paginate(Permission.objects.order_by(Lower('name')))
+        self.assertIsNotNone(paginator.fallback)
+        self.assertEqual(len(rows), 7)
+        self.assertIn('count', paginator.get_paginated_response([]).data)
+
+
+class CountModeTestCase(TestCase):
+    """页码分页时不计算总数或者使用缓存的总数"""
+
+    def paginate(self, mode, page=1):
+        request = Request(factory.get('/', {'size': 10, 'page': page, 'count': mode}))
+        paginator = PageNumberPagination()
+        rows = paginator.paginate_queryset(Permission.objects.order_by('pk'), request)
+        return paginator, rows, paginator.get_paginated_response(rows).data
+
+    def test_none(self):
+        total = Permission.objects.count()
+        last = (total - 1) // 10 + 1
+        with self.assertNumQueries(1):
+            _, rows, data = self.paginate('none')
+        self.assertEqual(len(rows), 10)
+        self.assertIsNone(data['count'])
+        self.assertEqual(data['count_type'], 'none')
+        self.assertIsNotNone(data['next'])
+
+        _, rows, data = self.paginate('none', last)
+        self.assertEqual(len(rows), total - (last - 1) * 10)
+        self.assertIsNone(data['next'])
+
+    def test_cached(self):
+        bump_model_version(Permission)
+        _, _, data = self.paginate('cached')
+        self.assertEqual(data['count_type'], 'exact')
+        with self.assertNumQueries(1):
+            _, _, data = self.paginate('cached')
+        self.assertEqual(data['count_type'], 'cached')
+        self.assertEqual(data['count'], Permission.objects.count())
+
+        bump_model_version(Permission)
+        _, _, data = self.paginate('cached')
+        self.assertEqual(data['count_type'], 'exact')
@@ -0,0 +1,328 @@
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Q
+from django.test import TestCase
+
+from api_basebone.core import register_annotated_field
+from api_basebone.export.specs import FieldType
+from api_basebone.restful.serializers import sort_expand_fields
+from api_basebone.utils.operators import (
+    build_filter_conditions2,
+    compile_filter_conditions,
+    template_cache,
+)
+from api_basebone.utils.queryset import (
+    BSMQuerySet,
+    annotate_queryset,
+    get_used_annotated_fields,
+    plan_expand,
+    queryset_prefetch,
+)
+from bsm_config.models import Admin, FieldAdmin, FieldPermission
+
+
+class ExpandPlanTestCase(TestCase):
+    """展开字段的查询计划，单值的正向关系使用 JOIN，多值的关系使用 Prefetch"""
+
+    def setUp(self):
+        super().setUp()
+        content_type = ContentType.objects.get_for_model(Group)
+        self.group = Group.objects.create(name='planner')
+        self.group.permissions.set(Permission.objects.filter(content_type=content_type))
+
+    def test_plan(self):
+        plan = plan_expand(
+            Group, sort_expand_fields(['permissions', 'permissions.content_type'])
+        )
+        self.assertEqual(plan.select_related, [])
+        self.assertEqual([item.prefetch_to for item in plan.prefetches], ['permissions'])
+
+        plan = plan_expand(Permission, sort_expand_fields(['content_type']))
+        self.assertEqual(plan.select_related, ['content_type'])
+        self.assertEqual(plan.prefetches, [])
+
+    def test_select_related(self):
+        queryset = queryset_prefetch(
+            Permission.objects.all(), sort_expand_fields(['content_type'])
+        )
+        with self.assertNumQueries(1):
+            names = [item.content_type.model for item in queryset]
+        self.assertTrue(names)
+
+    def test_prefetch_with_select_related(self):
+        """多对多使用 Prefetch，Prefetch 中的外键使用 JOIN"""
+        queryset = queryset_prefetch(
+            Group.objects.filter(pk=self.group.pk),
+            sort_expand_fields(['permissions', 'permissions.content_type']),
+        )
+        with self.assertNumQueries(2):
+            group = queryset.get()
+            models = {item.content_type.model for item in group.permissions.all()}
+        self.assertEqual(models, {'group'})
+
+    def test_display_fields(self):
+        """only 同样作用在 JOIN 的关联模型上"""
+        queryset = queryset_prefetch(
+            Permission.objects.all(), display_fields=['name', 'content_type.model']
+        )
+        with self.assertNumQueries(1):
+            permission = queryset.first()
+            self.assertEqual(
+                permission.get_deferred_fields(), {'codename'}
+            )
+            self.assertEqual(
+                permission.content_type.get_deferred_fields(), {'app_label'}
+            )
+
+
+class RenderIterTestCase(TestCase):
+    """流式输出分批查询，每批执行一次 prefetch"""
+
+    def setUp(self):
+        super().setUp()
+        permissions = list(Permission.objects.all()[:2])
+        for index in range(5):
+            group = Group.objects.create(name=f'render{index}')
+            group.permissions.set(permissions)
+
+    def test_render_iter(self):
+        queryset = BSMQuerySet(model=Group).order_by('pk')
+        display_fields = ['name', 'permissions.name']
+        # 一次主查询，三批数据各一次 prefetch
+        with self.assertNumQueries(4):
+            rows = list(queryset.render_iter(display_fields, chunk_size=2))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(len(rows[0]['permissions']), 2)
+        self.assertEqual(rows, queryset.render(display_fields))
+
+
+class UsedAnnotationTestCase(TestCase):
+    """只有用到的注解字段才会出现在 SQL 中"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # 在 GMeta 的子类中注册，不修改应用中已有的 GMeta
+        cls.gmeta_class = Group.__dict__.get('GMeta')
+        Group.GMeta = type('GMeta', (cls.gmeta_class or object,), {'annotated_fields': {}})
+        register_annotated_field(
+            Group, 'permission_count', FieldType.INTEGER, Count('permissions')
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.gmeta_class is None:
+            del Group.GMeta
+        else:
+            Group.GMeta = cls.gmeta_class
+        super().tearDownClass()
+
+    def get_sql(self, **kwargs):
+        fields = get_used_annotated_fields(Group, **kwargs)
+        return str(annotate_queryset(Group.objects.all(), fields=fields).query)
+
+    def test_display_fields(self):
+        self.assertIn('permission_count', self.get_sql())
+        self.assertIn('permission_count', self.get_sql(display_fields=['*']))
+        self.assertIn(
+            'permission_count', self.get_sql(display_fields=['name', 'permission_count'])
+        )
+        sql = self.get_sql(display_fields=['name'])
+        self.assertNotIn('permission_count', sql)
+        self.assertNotIn('COUNT', sql)
+
+    def test_conditions_and_order_by(self):
+        conditions = [
+            {'children': [{'field': 'permission_count', 'operator': '>', 'value': 0}]}
+        ]
+        self.assertIn(
+            'permission_count', self.get_sql(display_fields=['name'], conditions=conditions)
+        )
+        self.assertIn(
+            'permission_count',
+            self.get_sql(display_fields=['name'], order_by=['-permission_count']),
+        )
+        self.assertIn(
+            'permission_count', self.get_sql(display_fields=[], fields=['permission_count'])
+        )
+
+    def test_reverse_back_reference(self):
+        """反向关系中指回当前模型的注解字段，使用的是当前的实例"""
+        self.assertIn(
+            'permission_count',
+            self.get_sql(display_fields=['name', 'permissions.group.permission_count']),
+        )
+
+    def test_nested_prefetch(self):
+        queryset = queryset_prefetch(
+            Permission.objects.all(),
+            sort_expand_fields(['group']),
+            display_fields=['name', 'group.name'],
+        )
+        prefetch = queryset._prefetch_related_lookups[0]
+        self.assertNotIn('permission_count', str(prefetch.queryset.query))
+
+
+class QuerysetExpressionTestCase(TestCase):
+    """结果集类型的表达式，模板只编译一次，可以作为子查询或者每个请求只查询一次"""
+
+    def setUp(self):
+        super().setUp()
+        self.group = Group.objects.create(name='expression')
+        self.context = {'group_name': 'expression'}
+
+    def get_filters(self, evaluate=None):
+        item = {
+            'field': 'id',
+            'operator': 'in',
+            'expression': 'name={{ group_name }}',
+            'expression_type': 'queryset',
+            'model': 'auth.Group',
+        }
+        if evaluate:
+            item['evaluate'] = evaluate
+        return [item]
+
+    def test_subquery(self):
+        template_cache.clear()
+        hits, misses = template_cache.hits, template_cache.misses
+        condition = build_filter_conditions2(self.get_filters(), self.context)
+        condition = build_filter_conditions2(self.get_filters(), self.context)
+        self.assertEqual(template_cache.misses, misses + 1)
+        self.assertEqual(template_cache.hits, hits + 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Group.objects.filter(condition)), [self.group])
+
+    def test_evaluate_once(self):
+        with self.assertNumQueries(1):
+            for _ in range(3):
+                condition = build_filter_conditions2(
+                    self.get_filters('once'), self.context
+                )
+        self.assertEqual(condition, Q(id__in=[self.group.pk]))
+
+
+class SemiJoinTestCase(TestCase):
+    """多值关系上的条件编译为子查询，结果集不会重复，无需去重"""
+
+    def setUp(self):
+        super().setUp()
+        self.permissions = list(Permission.objects.order_by('pk')[:3])
+        self.first = Group.objects.create(name='first')
+        self.first.permissions.set(self.permissions[:2])
+        self.second = Group.objects.create(name='second')
+        self.second.permissions.set(self.permissions[1:])
+
+    def filter(self, filters, model=Group):
+        condition = build_filter_conditions2(filters, model=model)
+        return list(model.objects.filter(condition).order_by('pk'))
+
+    def item(self, field, value, operator='='):
+        return {'field': field, 'operator': operator, 'value': value}
+
+    def test_no_duplicates(self):
+        codenames = [item.codename for item in self.permissions]
+        groups = self.filter([self.item('permissions.codename', codenames, 'in')])
+        self.assertEqual(groups, [self.first, self.second])
+
+        compiled, _ = compile_filter_conditions(
+            [self.item('permissions.codename', codenames, 'in')], Group
+        )
+        self.assertEqual(compiled.join_fields, [])
+
+    def test_same_relation(self):
+        """同一个且分组中的条件，需要同一条关联数据满足"""
+        first, last = self.permissions[0], self.permissions[2]
+        groups = self.filter(
+            [self.item('permissions.id', first.pk), self.item('permissions.id', last.pk)]
+        )
+        self.assertEqual(groups, [])
+        groups = self.filter(
+            [
+                {
+                    'operator': 'OR',
+                    'children': [
+                        self.item('permissions.id', first.pk),
+                        self.item('permissions.id', last.pk),
+                    ],
+                }
+            ]
+        )
+        self.assertEqual(groups, [self.first, self.second])
+
+    def test_nested_groups(self):
+        """嵌套的且分组中的条件，仍然需要同一条关联数据满足"""
+        first, second = self.permissions[0], self.permissions[1]
+        filters = [
+            self.item('permissions.id', first.pk),
+            {
+                'operator': 'AND',
+                'children': [
+                    self.item('name', 'first'),
+                    {'operator': 'AND', 'children': [self.item('permissions.id', second.pk)]},
+                ],
+            },
+        ]
+        self.assertEqual(self.filter(filters), [])
+        compiled, _ = compile_filter_conditions(filters, Group)
+        self.assertEqual(compiled.join_fields, [])
+
+        # 分布在且分组和其中的或分组中时，使用连接查询
+        filters = [
+            self.item('permissions.id', first.pk),
+            {
+                'operator': 'OR',
+                'children': [
+                    self.item('permissions.id', second.pk),
+                    self.item('name', 'second'),
+                ],
+            },
+        ]
+        self.assertEqual(self.filter(filters), [])
+        compiled, _ = compile_filter_conditions(filters, Group)
+        self.assertEqual(compiled.join_fields, ['permissions__id', 'permissions__id'])
+
+        filters[1]['children'][1] = self.item('name', 'first')
+        self.assertEqual(self.filter(filters), [self.first])
+
+    def test_none_value(self):
+        """和空值比较时和连接查询的结果一致，匹配没有关联数据的行"""
+        third = Group.objects.create(name='third')
+        admin = Admin.objects.create(model='demo__item')
+        field_admin = FieldAdmin.objects.create(admin=admin, field='name')
+        FieldPermission.objects.create(field_admin=field_admin, group=self.first)
+
+        fields = ('permissions', 'permissions.codename', 'fieldpermission', 'fieldpermission.id')
+        for field in fields:
+            for operator in ('=', '!='):
+                filters = [self.item(field, None, operator)]
+                compiled, items = compile_filter_conditions(filters, Group)
+                join_fields = []
+                condition = compiled.bind(items, join_fields=join_fields)
+                self.assertEqual(join_fields, [field.replace('.', '__')])
+
+                lookup = Q(**{field.replace('.', '__'): None})
+                expected = Group.objects.filter(~lookup if operator == '!=' else lookup)
+                self.assertEqual(
+                    list(Group.objects.filter(condition).distinct().order_by('pk')),
+                    list(expected.distinct().order_by('pk')),
+                )
+        self.assertEqual(self.filter([self.item('permissions', None)]), [third])
+        self.assertEqual(
+            self.filter([self.item('fieldpermission', None)]), [self.second, third]
+        )
+
+    def test_negate_and_reverse(self):
+        groups = self.filter([self.item('permissions.id', self.permissions[0].pk, '!=')])
+        self.assertNotIn(self.first, groups)
+        self.assertIn(self.second, groups)
+
+        permissions = self.filter([self.item('group.name', 'second')], Permission)
+        self.assertEqual(permissions, self.permissions[1:])
+
+    def test_isnull(self):
+        """判断是否为空的条件仍然使用连接查询"""
+        compiled, _ = compile_filter_conditions(
+            [self.item('permissions', False, 'isnull')], Group
+        )
+        self.assertEqual(compiled.join_fields, ['permissions'])
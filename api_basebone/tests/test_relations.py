@@ -0,0 +1,64 @@
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+from rest_framework.exceptions import ValidationError
+
+from api_basebone.restful.relation import reverse_many_to_many
+from api_basebone.restful.relations import reverse_one_to_many
+
+
+class ReverseRelationTestCase(TestCase):
+    """反向关系的嵌套数据批量写入"""
+
+    def setUp(self):
+        self.content_type = ContentType.objects.create(app_label='demo', model='item')
+        self.field = ContentType._meta.get_field('permission')
+        self.existing = [
+            Permission.objects.create(
+                content_type=self.content_type, codename=f'old_{index}', name=f'Old {index}'
+            )
+            for index in range(3)
+        ]
+
+    def get_rows(self, count, keep=1):
+        """修改第一条已有的数据，保留其后 keep 条，删除其余的已有数据，再加上新增的数据"""
+        rows = [{'id': self.existing[0].pk, 'name': 'renamed'}]
+        rows += [item.pk for item in self.existing[1:keep + 1]]
+        rows += [{'codename': f'new_{index}', 'name': f'New {index}'} for index in range(count)]
+        return rows
+
+    def test_reverse_one_to_many(self):
+        reverse_one_to_many(self.field, self.get_rows(5), self.content_type)
+        names = dict(self.content_type.permission_set.values_list('codename', 'name'))
+        self.assertEqual(
+            names,
+            {'old_0': 'renamed', 'old_1': 'Old 1', **{f'new_{i}': f'New {i}' for i in range(5)}},
+        )
+
+    def test_queries(self):
+        """除了表单逐行校验唯一约束，查询的数量和数据量无关"""
+        for count in (10, 30):
+            Permission.objects.filter(codename__startswith='new_').delete()
+            rows = self.get_rows(count, keep=2)
+            with self.assertNumQueries(10 + count):
+                reverse_one_to_many(self.field, rows, self.content_type)
+
+    def test_errors(self):
+        """批量写入违反约束时，和逐条保存一样返回表单的错误"""
+        rows = self.get_rows(2)
+        rows.append(dict(rows[-1]))
+        with self.assertRaises(ValidationError) as context:
+            reverse_one_to_many(self.field, rows, self.content_type)
+        self.assertIn('non_field_errors', context.exception.detail)
+        self.assertEqual(Permission.objects.filter(codename='new_1').count(), 1)
+
+    def test_reverse_many_to_many(self):
+        group = Group.objects.create(name='old')
+        field = Permission._meta.get_field('group')
+        permission = self.existing[0]
+        reverse_many_to_many(
+            permission, field, [{'id': group.pk, 'name': 'renamed'}, {'name': 'a'}, {'name': 'b'}]
+        )
+        self.assertEqual(
+            sorted(permission.group_set.values_list('name', flat=True)), ['a', 'b', 'renamed']
+        )
@@ -0,0 +1,135 @@
+import datetime
+from copy import copy
+from types import SimpleNamespace
+
+import pytz
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, Max
+from django.db.models.functions import TruncDay
+from django.test import TestCase
+from django.utils import timezone
+
+from api_basebone.models import AdminLog
+from api_basebone.services.rest_services import after_bulk_write
+from api_basebone.services.rollup import (
+    read_group_statistics,
+    refresh_instances,
+    get_rollups,
+    rollup_cache,
+)
+
+User = get_user_model()
+
+
+class RollupTestCase(TestCase):
+    """分组统计从汇总表读取，结果和原始数据上的分组一致"""
+
+    fields = {
+        'users': {'field': 'id', 'method': 'Count'},
+        'latest': {'field': 'date_joined', 'method': 'Max'},
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.gmeta = User.__dict__.get('GMeta')
+
+        class GMeta:
+            rollups = {
+                'daily': {
+                    'group': {
+                        'day': {'field': 'date_joined', 'method': 'TruncDay'},
+                        'staff': {'field': 'is_staff'},
+                    },
+                    'metrics': {
+                        'count': {'field': 'id', 'method': 'count'},
+                        'latest': {'field': 'date_joined', 'method': 'Max'},
+                    },
+                }
+            }
+
+        User.GMeta = GMeta
+        rollup_cache.clear()
+        now = timezone.now()
+        for index in range(6):
+            User.objects.create_user(
+                f'rollup{index}',
+                date_joined=now - datetime.timedelta(days=index % 3, hours=index),
+                is_staff=index % 2 == 0,
+            )
+
+    def tearDown(self):
+        if self.gmeta is None:
+            del User.GMeta
+        else:
+            User.GMeta = self.gmeta
+        rollup_cache.clear()
+        super().tearDown()
+
+    def group_kwargs(self):
+        return {'day': TruncDay('date_joined', tzinfo=pytz.UTC)}
+
+    def raw(self):
+        return list(
+            User.objects.annotate(**self.group_kwargs())
+            .values('day')
+            .annotate(users=Count('id'), latest=Max('date_joined'))
+            .order_by('day')
+        )
+
+    def read(self, queryset=None, **kwargs):
+        return read_group_statistics(
+            queryset or User.objects.all(), self.fields, self.group_kwargs(), **kwargs
+        )
+
+    def test_read(self):
+        # 重建之前不使用汇总表
+        self.assertIsNone(self.read())
+        get_rollups(User)[0].rebuild()
+        with self.assertNumQueries(2):
+            rows = self.read()
+        self.assertEqual(rows, self.raw())
+
+        rows = self.read(sort_keys=['-users'], top_max=1)
+        self.assertEqual(rows, sorted(self.raw(), key=lambda row: -row['users'])[:1])
+
+    def test_refresh(self):
+        get_rollups(User)[0].rebuild()
+        user = User.objects.create_user('rollup', is_staff=True)
+        refresh_instances(User, [None, user])
+        self.assertEqual(self.read(), self.raw())
+
+        old = User.objects.get(pk=user.pk)
+        user.date_joined -= datetime.timedelta(days=10)
+        user.save()
+        refresh_instances(User, [old, user])
+        self.assertEqual(self.read(), self.raw())
+
+    def test_bulk_write(self):
+        """批量写入不发送保存的信号，写入后刷新汇总行并记录动作日志"""
+        get_rollups(User)[0].rebuild()
+        created = [
+            User(username=f'bulk{index}', date_joined=timezone.now() - datetime.timedelta(days=5))
+            for index in range(3)
+        ]
+        User.objects.bulk_create(created)
+        old = User.objects.get(username='rollup0')
+        changed = copy(old)
+        changed.date_joined -= datetime.timedelta(days=20)
+        changed.save()
+
+        view = SimpleNamespace(model=User, request=SimpleNamespace(user=old))
+        after_bulk_write(view, [(item, True) for item in created] + [(changed, False)], [old])
+        self.assertEqual(self.read(), self.raw())
+        self.assertEqual(
+            sorted(AdminLog.objects.values_list('action', flat=True)), ['add'] * 3 + ['update']
+        )
+
+    def test_not_eligible(self):
+        get_rollups(User)[0].rebuild()
+        self.assertIsNone(self.read(User.objects.filter(is_staff=True)))
+        self.assertIsNone(self.read(filters=[{'field': 'users', 'operator': '>', 'value': 1}]))
+        self.assertIsNone(
+            read_group_statistics(
+                User.objects.all(), self.fields, {'name': F('username')}
+            )
+        )
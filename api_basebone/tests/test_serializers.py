@@ -0,0 +1,339 @@
+import json
+import threading
+from datetime import datetime
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.db import connection
+from django.db.models import Count
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import fields, serializers
+
+from api_basebone.core import drf_field, register_annotated_field
+from api_basebone.core.admin import BSMAdmin, BSMAdminModule
+from api_basebone.core.decorators import (
+    BSM_ADMIN_COMPUTED_FIELDS_MAP,
+    basebone_admin_property,
+)
+from api_basebone.export.specs import FieldType
+from api_basebone.restful.const import MANAGE_END_SLUG
+from api_basebone.restful.renderers import csv_render, iter_serialized_rows
+from api_basebone.restful.serializers import (
+    EXPORT_FILE_ACTION,
+    ComputedFieldTypeSerializerMap,
+    RowEncoder,
+    clear_serializer_class_cache,
+    create_serializer_class,
+    multiple_create_serializer_class,
+    sort_expand_fields,
+)
+from api_basebone.settings import settings as basebone_settings
+from api_basebone.utils import meta
+from api_basebone.utils.queryset import queryset_prefetch, translate_expand_fields
+from bsm_config.models import Admin, FieldAdmin, FieldPermission
+
+User = get_user_model()
+DISPLAY_FIELDS = ['id', 'username', 'is_active', 'date_joined']
+
+
+class FieldMappingTestCase(SimpleTestCase):
+    """普通接口和导出使用不同的字段映射，互不影响"""
+
+    def setUp(self):
+        super().setUp()
+        clear_serializer_class_cache()
+        self.user = User(
+            id=1,
+            username='mapping',
+            is_active=True,
+            date_joined=timezone.make_aware(datetime(2020, 1, 2, 3, 4, 5)),
+        )
+
+    def serialize(self, action):
+        serializer_class = create_serializer_class(
+            User, action=action, display_fields=DISPLAY_FIELDS
+        )
+        return serializer_class(self.user).data
+
+    def test_field_classes(self):
+        list_fields = create_serializer_class(
+            User, action='list', display_fields=DISPLAY_FIELDS
+        )().fields
+        export_fields = create_serializer_class(
+            User, action=EXPORT_FILE_ACTION, display_fields=DISPLAY_FIELDS
+        )().fields
+
+        self.assertIs(type(list_fields['is_active']), fields.BooleanField)
+        self.assertIs(type(export_fields['is_active']), drf_field.ExportBooleanField)
+        self.assertIs(type(export_fields['date_joined']), drf_field.ExportDateTimeField)
+
+    def test_global_mapping_untouched(self):
+        mapping = dict(serializers.ModelSerializer.serializer_field_mapping)
+        self.serialize('list')
+        self.serialize(EXPORT_FILE_ACTION)
+        self.assertEqual(mapping, serializers.ModelSerializer.serializer_field_mapping)
+
+    def test_concurrent_list_and_export(self):
+        """并发执行列表和导出，导出的字段类型不会泄漏到列表中"""
+        errors = []
+
+        def run(action, expected):
+            try:
+                for _ in range(200):
+                    clear_serializer_class_cache()
+                    value = self.serialize(action)['is_active']
+                    if value != expected:
+                        errors.append((action, value))
+            except Exception as e:
+                errors.append((action, e))
+
+        threads = [
+            threading.Thread(target=run, args=('list', True)) for _ in range(4)
+        ] + [
+            threading.Thread(target=run, args=(EXPORT_FILE_ACTION, '是'))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class RowEncoderTestCase(TestCase):
+    """行编码器的输出和查询数量与序列化类一致"""
+
+    def setUp(self):
+        clear_serializer_class_cache()
+        admin = Admin.objects.create(model='demo__item')
+        self.groups = [Group.objects.create(name=f'group_{index}') for index in range(3)]
+        self.groups[0].permissions.set(Permission.objects.order_by('pk')[:3])
+        for index in range(3):
+            field_admin = FieldAdmin.objects.create(admin=admin, field=f'field_{index}')
+            for group in self.groups[:index + 1]:
+                FieldPermission.objects.create(field_admin=field_admin, group=group)
+
+    def get_queryset(self, model, expand_fields, queryset=None):
+        expand_fields = translate_expand_fields(model, expand_fields)
+        if queryset is None:
+            queryset = model.objects.order_by('pk')
+        return expand_fields, queryset_prefetch(queryset, sort_expand_fields(expand_fields))
+
+    def serialize(self, model, expand_fields, action='list', queryset=None):
+        """分别使用序列化类和行编码器输出，返回 (输出的数据, 查询数量) 的列表"""
+        expand_fields, queryset = self.get_queryset(model, expand_fields, queryset)
+        serializer_class = multiple_create_serializer_class(model, expand_fields, action=action)
+        encoder = RowEncoder.compile(serializer_class(many=True))
+        self.assertIsNotNone(encoder)
+        self.assertTrue(encoder.supports(queryset))
+
+        result = []
+        with CaptureQueriesContext(connection) as context:
+            data = serializer_class(queryset.all(), many=True).data
+        result.append((json.dumps(data), len(context)))
+        with CaptureQueriesContext(connection) as context:
+            data = encoder.encode(encoder.values_queryset(queryset), queryset)
+        result.append((json.dumps(data), len(context)))
+        return result
+
+    def test_list(self):
+        for expand_fields in ([], ['group'], ['field_admin.admin', 'group']):
+            serialized, encoded = self.serialize(FieldPermission, expand_fields)
+            self.assertEqual(serialized, encoded)
+
+    def test_export(self):
+        serialized, encoded = self.serialize(
+            FieldPermission, ['field_admin.admin'], action=EXPORT_FILE_ACTION
+        )
+        self.assertEqual(serialized, encoded)
+
+    def test_select_related(self):
+        """正向关系使用 select_related 时和序列化类一样通过 JOIN 获取"""
+        serialized, encoded = self.serialize(FieldPermission, ['field_admin.admin', 'group'])
+        self.assertEqual(serialized, encoded)
+        self.assertEqual(encoded[1], 1)
+
+    def test_related_rows_and_pks(self):
+        """导出时多对多不展开输出主键，反向关系展开时输出关联的数据"""
+        serialized, encoded = self.serialize(Group, [], action=EXPORT_FILE_ACTION)
+        self.assertEqual(serialized[0], encoded[0])
+        self.assertEqual(len(json.loads(encoded[0])[0]['permissions']), 3)
+        # 序列化类逐行查询多对多的主键，行编码器一次查询
+        self.assertEqual(encoded[1], 2)
+
+        serialized, encoded = self.serialize(
+            Group, ['fieldpermission', 'fieldpermission.field_admin']
+        )
+        self.assertEqual(serialized, encoded)
+
+    def test_missing_annotation(self):
+        """注解字段不在结果集中时不输出"""
+        gmeta_class = type('GMeta', (Group.GMeta,), {'annotated_fields': {}})
+        with mock.patch.object(Group, 'GMeta', gmeta_class):
+            register_annotated_field(
+                Group, 'permission_count', FieldType.INTEGER, Count('permissions')
+            )
+            clear_serializer_class_cache()
+            annotated = Group.objects.annotate(permission_count=Count('permissions'))
+            for queryset in (Group.objects.all(), annotated):
+                serialized, encoded = self.serialize(Group, [], queryset=queryset.order_by('pk'))
+                self.assertEqual(serialized, encoded)
+            self.assertEqual(json.loads(encoded[0])[0]['permission_count'], 3)
+        clear_serializer_class_cache()
+
+    def test_computed_fields(self):
+        """GMeta 中的计算属性需要模型实例，不支持"""
+        serializer_class = create_serializer_class(Permission, action='list')
+        self.assertIsNone(RowEncoder.compile(serializer_class(many=True)))
+
+    def test_switch(self):
+        _, queryset = self.get_queryset(FieldPermission, ['group'])
+        serializer_class = multiple_create_serializer_class(
+            FieldPermission, ['group'], action=EXPORT_FILE_ACTION
+        )
+        result = {}
+        for enable in (False, True):
+            with mock.patch.object(basebone_settings, 'ROW_ENCODER_ENABLE', enable, create=True):
+                rows = list(iter_serialized_rows(queryset, serializer_class, chunk_size=2))
+            result[enable] = rows
+        self.assertTrue(all(instance is not None for instance, _ in result[False]))
+        self.assertTrue(all(instance is None for instance, _ in result[True]))
+        self.assertEqual(
+            json.dumps([data for _, data in result[False]]),
+            json.dumps([data for _, data in result[True]]),
+        )
+
+
+class GroupAdminMixin:
+    """注册角色的 admin，包含普通的和批量的计算属性"""
+
+    def setUp(self):
+        super().setUp()
+        self.calls = calls = []
+        patchers = [
+            mock.patch.object(Group, BSM_ADMIN_COMPUTED_FIELDS_MAP, {}, create=True),
+            mock.patch.dict(BSMAdminModule.modules),
+            mock.patch.object(BSMAdminModule, 'version', BSMAdminModule.version + 1),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        class GroupAdmin(BSMAdmin):
+            @basebone_admin_property(Group, '权限数', batch=True)
+            def permission_total(self, instances):
+                calls.append([item.pk for item in instances])
+                return {item.pk: f'total_{item.pk}' for item in instances}
+
+            @basebone_admin_property(Group, '名称')
+            def upper_name(self, instance):
+                return instance.name.upper()
+
+            class Meta:
+                model = Group
+
+        BSMAdminModule.modules['auth__group'] = GroupAdmin
+        self.groups = [Group.objects.create(name=f'group_{index}') for index in range(5)]
+        self.pks = [group.pk for group in self.groups]
+        self.queryset = Group.objects.order_by('pk')
+
+
+class BatchPropertyTestCase(GroupAdminMixin, TestCase):
+    """批量的计算属性每页、导出时每批只调用一次"""
+
+    def get_serializer_class(self, action='list'):
+        return create_serializer_class(Group, action=action, end_slug=MANAGE_END_SLUG)
+
+    def test_list(self):
+        data = self.get_serializer_class()(self.queryset, many=True).data
+        self.assertEqual(self.calls, [self.pks])
+        self.assertEqual(
+            [item['permission_total'] for item in data], [f'total_{pk}' for pk in self.pks]
+        )
+
+        data = self.get_serializer_class()(self.groups[0]).data
+        self.assertEqual(self.calls[1:], [self.pks[:1]])
+        self.assertEqual(data['permission_total'], f'total_{self.pks[0]}')
+
+    def test_export(self):
+        serializer_class = self.get_serializer_class(EXPORT_FILE_ACTION)
+        rows = list(iter_serialized_rows(self.queryset, serializer_class, chunk_size=2))
+        self.assertEqual(self.calls, [self.pks[:2], self.pks[2:4], self.pks[4:]])
+        self.assertEqual(
+            [data['permission_total'] for _, data in rows], [f'total_{pk}' for pk in self.pks]
+        )
+
+        del self.calls[:]
+        with mock.patch.object(basebone_settings, 'EXPORT_CHUNK_SIZE', 3, create=True):
+            csv_render(Group, self.queryset, serializer_class)
+        self.assertEqual(self.calls, [self.pks[:3], self.pks[3:]])
+
+
+def stock_representation(serializer, instance):
+    """DRF 原本的输出，再逐行加上反向字段名称的转换和 admin 中的计算属性"""
+    ret = serializers.ModelSerializer.to_representation(serializer, instance)
+    model = serializer.Meta.model
+    for item in meta.get_reverse_fields(model):
+        related_name = meta.get_relation_field_related_name(
+            item.related_model, item.remote_field.name
+        )
+        if related_name and related_name[0] in ret:
+            ret[item.name] = ret.pop(related_name[0])
+
+    admin_instance = meta.get_bsm_model_admin(model)()
+    for name, field_value in getattr(model, BSM_ADMIN_COMPUTED_FIELDS_MAP).items():
+        computed_func = getattr(admin_instance, name)
+        if field_value['batch']:
+            value = computed_func([instance]).get(instance.pk)
+        else:
+            value = computed_func(instance)
+        ret[name] = ComputedFieldTypeSerializerMap[field_value['field_type']](
+            read_only=True
+        ).to_representation(value)
+    return ret
+
+
+class RepresentationPlanTestCase(GroupAdminMixin, TestCase):
+    """使用输出计划的输出和逐行计算的输出一致"""
+
+    def setUp(self):
+        super().setUp()
+        clear_serializer_class_cache()
+        self.groups[0].permissions.set(Permission.objects.order_by('pk')[:2])
+
+    def assertStockEqual(self, serializer_class, queryset):
+        data = serializer_class(queryset, many=True).data
+        serializer = serializer_class()
+        self.assertEqual(
+            json.dumps(data),
+            json.dumps([stock_representation(serializer, item) for item in queryset]),
+        )
+        return data
+
+    def test_admin_properties(self):
+        for action in ('list', 'retrieve', EXPORT_FILE_ACTION):
+            serializer_class = multiple_create_serializer_class(
+                Group,
+                translate_expand_fields(Group, ['permissions', 'fieldpermission']),
+                action=action,
+                end_slug=MANAGE_END_SLUG,
+            )
+            data = self.assertStockEqual(serializer_class, self.queryset)
+            self.assertEqual(data[0]['upper_name'], 'GROUP_0')
+            # 反向字段使用字段的名称输出
+            self.assertIn('fieldpermission', data[0])
+
+    def test_exclude_fields(self):
+        serializer_class = multiple_create_serializer_class(
+            Group,
+            ['permissions'],
+            exclude_fields={'auth__group': ['name'], 'auth__permission': ['codename']},
+            action='retrieve',
+            end_slug=MANAGE_END_SLUG,
+        )
+        data = self.assertStockEqual(serializer_class, self.queryset)
+        self.assertNotIn('name', data[0])
+        self.assertNotIn('codename', data[0]['permissions'][0])
@@ -0,0 +1,60 @@
+from django.contrib.auth.models import Group, Permission
+from django.db.models import Count, Sum, Value
+from django.db.models.functions import Coalesce
+from django.test import TestCase
+
+from api_basebone.restful.mixins import StatisticsMixin
+
+
+class AggregateStatisticsTestCase(TestCase):
+    """关系字段和非关系字段的统计合并到一条 SQL 中"""
+
+    def aggregates(self):
+        return (
+            {'total': Coalesce(Sum('id'), Value(0))},
+            {'groups': Coalesce(Count('group', distinct=True), Value(0))},
+        )
+
+    def aggregate(self, queryset):
+        aggregates, relation_aggregates = self.aggregates()
+        return StatisticsMixin().basebone_aggregate_statistics(
+            queryset, queryset.all(), aggregates, relation_aggregates
+        )
+
+    def test_single_query(self):
+        queryset = Permission.objects.filter(codename__startswith='view_')
+        aggregates, relation_aggregates = self.aggregates()
+        expected = queryset.aggregate(**aggregates)
+        expected.update(queryset.aggregate(**relation_aggregates))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.aggregate(queryset), expected)
+
+    def test_empty(self):
+        result = self.aggregate(Permission.objects.filter(pk=-1))
+        self.assertEqual(result, {'total': 0, 'groups': 0})
+
+    def test_distinct(self):
+        """去重的结果集分两条 SQL 统计"""
+        permissions = list(Permission.objects.order_by('pk')[:3])
+        first = Group.objects.create(name='first')
+        first.permissions.set(permissions)
+        Group.objects.create(name='second').permissions.set(permissions[:1])
+        Group.objects.create(name='third')
+
+        codename = permissions[0].codename
+        origin_queryset = Group.objects.filter(permissions__codename__startswith=codename)
+        queryset = origin_queryset.distinct()
+        with self.assertNumQueries(2):
+            result = StatisticsMixin().basebone_aggregate_statistics(
+                queryset,
+                origin_queryset,
+                {'total': Coalesce(Sum('id'), Value(0))},
+                {'permissions': Coalesce(Count('permissions', distinct=True), Value(0))},
+            )
+        self.assertEqual(
+            result,
+            {
+                'total': sum(Group.objects.exclude(name='third').values_list('pk', flat=True)),
+                'permissions': 1,
+            },
+        )
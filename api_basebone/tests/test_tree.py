@@ -0,0 +1,144 @@
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
+from django.apps import apps
+from django.test import TestCase
+
+from api_basebone.services.rest_services import load_tree
+from api_basebone.utils.tree import CHILD_COUNT_ATTR, TreeLoader
+from bsm_config.models import Menu
+
+# 节点的 id 和上级节点的 id
+NODES = [(1, None), (2, 1), (3, 1), (4, 2), (5, 4), (6, None), (7, 6)]
+
+
+def get_tree(nodes):
+    """从 prefetch 缓存中读取树形结构，元素为 (id, 子节点数量, 子节点)"""
+    return [
+        (node.pk, getattr(node, CHILD_COUNT_ATTR, None), get_tree(node.children.all()))
+        for node in nodes
+    ]
+
+
+class TreeLoaderTestCase(TestCase):
+    """一次性加载子孙节点，序列化时不再逐个节点查询"""
+
+    def setUp(self):
+        # 菜单的信号依赖完整的权限配置，这里直接批量写入
+        Menu.objects.bulk_create(
+            [Menu(id=pk, name=f'menu_{pk}', parent_id=parent) for pk, parent in NODES]
+        )
+
+    def get_roots(self):
+        return list(Menu.objects.filter(parent=None).order_by('pk'))
+
+    def load(self, queries, **kwargs):
+        child_count = kwargs.pop('child_count', False)
+        roots = self.get_roots()
+        with self.assertNumQueries(queries):
+            TreeLoader(Menu, 'parent', **kwargs).load(roots, child_count=child_count)
+        with self.assertNumQueries(0):
+            return get_tree(roots)
+
+    def test_cte(self):
+        self.assertEqual(
+            self.load(1),
+            [
+                (1, None, [(2, None, [(4, None, [(5, None, [])])]), (3, None, [])]),
+                (6, None, [(7, None, [])]),
+            ],
+        )
+
+    def test_by_level(self):
+        """不支持递归 CTE 时按层查询，查询数量是子孙节点的层数加一"""
+        with mock.patch.object(TreeLoader, 'supports_cte', return_value=False):
+            by_level = self.load(4)
+        self.assertEqual(by_level, self.load(1))
+
+    def test_max_depth(self):
+        expected = [(1, 2, [(2, 1, []), (3, 0, [])]), (6, 1, [(7, 0, [])])]
+        # 达到最大深度的节点，子节点数量通过一次分组查询获取
+        self.assertEqual(self.load(2, max_depth=1, child_count=True), expected)
+        with mock.patch.object(TreeLoader, 'supports_cte', return_value=False):
+            self.assertEqual(self.load(2, max_depth=1, child_count=True), expected)
+
+        self.assertEqual(
+            self.load(1, max_depth=0, child_count=True), [(1, 2, []), (6, 1, [])]
+        )
+
+    def test_child_count(self):
+        self.assertEqual(
+            self.load(1, child_count=True),
+            [(1, 2, [(2, 1, [(4, 1, [(5, 0, [])])]), (3, 0, [])]), (6, 1, [(7, 0, [])])],
+        )
+
+    def test_load_tree(self):
+        """接口的树形配置，子节点数量写入到序列化后的数据中"""
+        view = SimpleNamespace(
+            tree_data=('parent', 'children'), tree_max_depth=2, tree_child_count=True
+        )
+        queryset = Menu.objects.filter(parent=None).order_by('pk')
+        roots = list(queryset)
+        with self.assertNumQueries(2):
+            loader = load_tree(view, roots, queryset)
+
+        def serialize(nodes):
+            return [
+                {'id': node.pk, 'children': serialize(node.children.all())} for node in nodes
+            ]
+
+        data = serialize(roots)
+        loader.fill_child_counts(data, roots, 'children', 'children_count')
+        self.assertEqual(
+            data,
+            [
+                {
+                    'id': 1,
+                    'children_count': 2,
+                    'children': [
+                        {
+                            'id': 2,
+                            'children_count': 1,
+                            'children': [{'id': 4, 'children_count': 1, 'children': []}],
+                        },
+                        {'id': 3, 'children_count': 0, 'children': []},
+                    ],
+                },
+                {
+                    'id': 6,
+                    'children_count': 1,
+                    'children': [{'id': 7, 'children_count': 0, 'children': []}],
+                },
+            ],
+        )
+
+
+@skipUnless(apps.is_installed('puzzle'), 'puzzle 应用没有安装')
+class MPTTTreeLoaderTestCase(TestCase):
+    """MPTT 模型使用 tree_id, lft, rght 字段一次查询"""
+
+    def setUp(self):
+        from puzzle.models import Block
+
+        self.model = Block
+        root = Block.objects.create(id='root')
+        child = Block.objects.create(id='child', parent=root)
+        Block.objects.create(id='leaf', parent=child)
+        Block.objects.create(id='other', parent=root)
+
+    def load(self, queries, **kwargs):
+        roots = list(self.model.objects.filter(parent=None))
+        with self.assertNumQueries(queries):
+            TreeLoader(self.model, 'parent', **kwargs).load(roots, child_count=True)
+        with self.assertNumQueries(0):
+            return get_tree(roots)
+
+    def test_mptt(self):
+        self.assertEqual(
+            self.load(1),
+            [('root', 2, [('child', 1, [('leaf', 0, [])]), ('other', 0, [])])],
+        )
+        self.assertEqual(
+            self.load(2, max_depth=1),
+            [('root', 2, [('child', 1, []), ('other', 0, [])])],
+        )
@@ -0,0 +1,96 @@
+from unittest import mock
+
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+from rest_framework.exceptions import ValidationError
+
+from api_basebone.core.exceptions import BusinessException
+from api_basebone.restful.forms import create_form_class
+from api_basebone.services import upsert
+
+
+class UpsertTestCase(TestCase):
+    """按冲突字段批量新增或者更新"""
+
+    def setUp(self):
+        self.content_type = ContentType.objects.get_for_model(Permission)
+
+    def run_upsert(self, rows, conflict_fields=('content_type', 'codename'), queryset=None):
+        form = create_form_class(Permission)
+        return upsert.Upsert(
+            Permission, conflict_fields, form, form, queryset=queryset
+        ).run(rows)
+
+    def get_rows(self, count):
+        """已有的数据各一行没有变化、一行修改，其余为新增的数据"""
+        unchanged = Permission.objects.get(content_type=self.content_type, codename='add_permission')
+        rows = [
+            {'content_type': self.content_type.pk, 'codename': unchanged.codename, 'name': unchanged.name},
+            {'content_type': self.content_type.pk, 'codename': 'change_permission', 'name': 'renamed'},
+        ]
+        rows += [
+            {'content_type': self.content_type.pk, 'codename': f'sync_{index}', 'name': f'Sync {index}'}
+            for index in range(count - 2)
+        ]
+        return rows
+
+    def check(self, rows):
+        result = self.run_upsert(rows)
+        self.assertEqual(result, {'created': len(rows) - 2, 'updated': 1, 'unchanged': 1})
+        names = dict(
+            Permission.objects.filter(content_type=self.content_type).values_list('codename', 'name')
+        )
+        for row in rows:
+            self.assertEqual(names[row['codename']], row['name'])
+
+    def test_upsert(self):
+        self.check(self.get_rows(5))
+        # 再次写入时都没有变化
+        self.assertEqual(
+            self.run_upsert(self.get_rows(5)), {'created': 0, 'updated': 0, 'unchanged': 5}
+        )
+
+    def test_fallback(self):
+        with mock.patch.object(upsert, 'supports_upsert', return_value=False):
+            self.check(self.get_rows(5))
+
+    def test_queries(self):
+        """除了表单逐行校验关联的数据，查询的数量和数据量无关"""
+        for count in (10, 30):
+            rows = self.get_rows(count)
+            with self.assertNumQueries(6 + count):
+                self.run_upsert(rows)
+
+    def test_errors(self):
+        rows = self.get_rows(4)
+        rows.append(dict(rows[-1]))
+        rows.append({'codename': 'missing_content_type'})
+        with self.assertRaises(ValidationError) as context:
+            self.run_upsert(rows)
+        errors = context.exception.detail
+        self.assertEqual([bool(item) for item in errors], [False] * 4 + [True, True])
+        self.assertFalse(Permission.objects.filter(codename__startswith='sync_').exists())
+
+        with self.assertRaises(BusinessException):
+            self.run_upsert(rows, ['codename'])
+
+    def test_scope(self):
+        """冲突字段对应的已有数据不在可以更新的结果集中时，返回错误，不更新"""
+        scope = Permission.objects.exclude(codename='change_permission')
+        rows = self.get_rows(4)
+        with self.assertRaises(ValidationError) as context:
+            self.run_upsert(rows, queryset=scope)
+        errors = context.exception.detail
+        self.assertEqual([bool(item) for item in errors], [False, True, False, False])
+        self.assertNotEqual(
+            Permission.objects.get(content_type=self.content_type, codename='change_permission').name,
+            'renamed',
+        )
+        self.assertFalse(Permission.objects.filter(codename__startswith='sync_').exists())
+
+        del rows[1]
+        self.assertEqual(
+            self.run_upsert(rows, queryset=scope), {'created': 2, 'updated': 0, 'unchanged': 1}
+        )
+        self.assertEqual(Permission.objects.filter(codename__startswith='sync_').count(), 2)
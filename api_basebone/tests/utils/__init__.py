@@ -6,7 +6,7 @@ from django.db.models import Q
 
 from parameterized import parameterized
 from api_basebone.utils.operators import build_filter_conditions
-from api_basebone.utils.operators import build_filter_conditions2
+from api_basebone.utils.operators import build_filter_conditions2, compile_filter_conditions, filter_cache
 
 
 class BuildFilterConditionsTest(unittest.TestCase):
@@ -69,3 +69,29 @@ class BuildFilterConditionsTest(unittest.TestCase):
         true_result.append(Q(age=23))
         true_result = reduce(operator.and_, true_result)
         self.assertEqual(true_result, result)
+
+    def test_compiled_cache(self):
+        """相同结构的过滤条件只编译一次，只绑定新的值"""
+        def build(name, age):
+            return [
+                {'field': 'name', 'operator': '=', 'value': name},
+                {
+                    'operator': 'OR',
+                    'children': [
+                        {'field': 'age', 'operator': '>', 'value': age},
+                        {'field': 'group.name', 'operator': '!=', 'value': name},
+                    ],
+                },
+            ]
+
+        filter_cache.clear()
+        misses = filter_cache.misses
+        result = build_filter_conditions2(build('a', 1))
+        self.assertEqual(Q(name__exact='a') & (Q(age__gt=1) | ~Q(group__name='a')), result)
+
+        compiled, items = compile_filter_conditions(build('b', 2))
+        self.assertEqual(misses + 1, filter_cache.misses)
+        self.assertEqual(['name', 'age', 'group.name'], compiled.fields)
+        self.assertEqual(
+            Q(name__exact='b') & (Q(age__gt=2) | ~Q(group__name='b')), compiled.bind(items)
+        )
@@ -0,0 +1,166 @@
+"""
+缓存相关的工具
+
+LRUCache 只存在于当前进程中，主要用于缓存那些构建代价比较大，但是在进程
+生命周期内基本不会变化的对象，例如动态构建的序列化类
+
+模型数据的版本号保存在 Django 的缓存中，依赖模型数据的缓存（例如分页的总数、
+统计的结果）在键中带上版本号，模型的数据变更时更新版本号，这些缓存随之失效
+
+get_or_refresh 用于计算代价较大的结果，例如图表的数据，过期后一段时间内仍然返回旧的
+结果，同一个键同时只有一个请求重新计算
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+MODEL_VERSION_CACHE_KEY = 'basebone_model_version:{label}'
+
+
+class LRUCache:
+    """线程安全的有界 LRU 缓存，并记录命中和未命中的次数
+
+    Params:
+        maxsize int 缓存的最大条目数，超过时淘汰最久未使用的条目
+        name str 缓存名称，只用于输出统计信息
+    """
+
+    def __init__(self, maxsize=128, name=None):
+        self.maxsize = maxsize
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """获取缓存的值，命中时把条目移动到最近使用的位置"""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """设置缓存的值，超过容量时淘汰最久未使用的条目"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while self.maxsize and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key, factory):
+        """获取缓存的值，如果不存在，则调用 factory 构建并缓存
+
+        构建的过程不持有锁，并发时可能重复构建，但是最终只会保留一份
+        """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+
+        value = factory()
+        with self._lock:
+            if key in self._data:
+                return self._data[key]
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        """清空缓存，统计数据保留"""
+        with self._lock:
+            self._data.clear()
+
+    def info(self):
+        """输出缓存的统计信息"""
+        return {
+            'name': self.name,
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+def get_model_version(model):
+    """获取模型数据的版本号"""
+    return cache.get(MODEL_VERSION_CACHE_KEY.format(label=model._meta.label), '0')
+
+
+def bump_model_version(model):
+    """模型的数据变更时更新版本号，使依赖模型数据的缓存失效"""
+    cache.set(
+        MODEL_VERSION_CACHE_KEY.format(label=model._meta.label), uuid.uuid4().hex, None
+    )
+
+
+def get_model_cache_key(prefix, model, *parts):
+    """依赖模型数据的缓存的键，包含模型数据的版本号
+
+    Params:
+        prefix str 键的前缀
+        model class 模型
+        parts 其他标识缓存的数据，例如查询的 SQL 和参数
+    """
+    digest = hashlib.md5(repr(parts).encode()).hexdigest()
+    return f'{prefix}:{model._meta.label}:{get_model_version(model)}:{digest}'
+
+
+def get_or_refresh(key, func, timeout, stale_timeout=0, lock_timeout=30, interval=0.05):
+    """获取缓存的结果，过期后仍可使用，同一个键只有一个请求重新计算
+
+    结果在 timeout 内是新鲜的，之后的 stale_timeout 内是过期的。过期的结果直接返回，
+    同时由获得锁的请求重新计算；没有结果时，获得锁的请求计算，其他请求等待计算的结果
+
+    Params:
+        key str 缓存的键
+        func callable 计算结果的函数
+        timeout int 结果新鲜的时间，单位为秒
+        stale_timeout int 结果过期后仍可使用的时间，单位为秒
+        lock_timeout int 锁的超时时间，也是等待计算结果的最长时间，单位为秒
+        interval float 等待计算结果时检查的间隔，单位为秒
+    """
+    lock_key = f'{key}:lock'
+    entry = cache.get(key)
+    if entry is not None:
+        if entry['expires'] > time.time() or not cache.add(lock_key, 1, lock_timeout):
+            return entry['value']
+    elif not cache.add(lock_key, 1, lock_timeout):
+        deadline = time.time() + lock_timeout
+        while time.time() < deadline:
+            time.sleep(interval)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry['value']
+            # 计算的请求失败释放了锁，不再等待
+            if cache.get(lock_key) is None:
+                break
+        return func()
+
+    try:
+        value = func()
+        cache.set(
+            key,
+            {'value': value, 'expires': time.time() + timeout},
+            timeout + stale_timeout,
+        )
+    finally:
+        cache.delete(lock_key)
+    return value
@@ -0,0 +1,99 @@
+"""
+基于 guardian 的对象权限的数据筛选
+
+用户和用户所在的组被授予查看权限的数据，通过 UNION 子查询在数据库中筛选，不再把
+所有授权数据的主键加载到内存中
+"""
+
+from django.contrib.auth.models import Permission
+from django.db.models import (
+    AutoField,
+    BigAutoField,
+    BigIntegerField,
+    CharField,
+    F,
+    IntegerField,
+    TextField,
+)
+from django.db.models.functions import Cast
+
+from api_basebone.utils.cache import LRUCache
+
+# 模型的查看权限的主键的缓存，键为模型的 label
+permission_cache = LRUCache(maxsize=1024, name='guardian_permission')
+
+
+def get_view_permission_id(model):
+    """获取模型的查看权限的主键，权限不存在时返回 None"""
+    from guardian.ctypes import get_content_type
+
+    key = model._meta.label
+    permission_id = permission_cache.get(key)
+    if permission_id is None:
+        permission_id = (
+            Permission.objects.filter(
+                codename=f'view_{model._meta.model_name}',
+                content_type=get_content_type(model),
+            )
+            .values_list('pk', flat=True)
+            .first()
+        )
+        # 权限不存在时不缓存，创建权限后可以立即生效
+        if permission_id is not None:
+            permission_cache.set(key, permission_id)
+    return permission_id
+
+
+def get_object_pk_expression(model):
+    """授权数据中的 object_pk 为字符串，转换为模型主键的类型"""
+    pk = model._meta.pk
+    while pk.is_relation:
+        pk = pk.target_field
+    if isinstance(pk, (CharField, TextField)):
+        return F('object_pk')
+    if isinstance(pk, BigAutoField):
+        output_field = BigIntegerField()
+    elif isinstance(pk, AutoField):
+        output_field = IntegerField()
+    else:
+        output_field = pk.__class__()
+    return Cast('object_pk', output_field=output_field)
+
+
+def get_granted_objects(model, user):
+    """用户和用户所在的组被授予查看权限的数据的主键，返回子查询
+
+    Returns:
+        (子查询, 是否存在授权数据)，模型没有查看权限时返回 (None, False)
+    """
+    from guardian.models import GroupObjectPermission, UserObjectPermission
+
+    permission_id = get_view_permission_id(model)
+    if permission_id is None:
+        return None, False
+
+    object_pk = get_object_pk_expression(model)
+    user_objects = UserObjectPermission.objects.filter(
+        user=user, permission_id=permission_id
+    )
+    group_objects = GroupObjectPermission.objects.filter(
+        group__user=user, permission_id=permission_id
+    )
+    exists = user_objects.exists() or group_objects.exists()
+    subquery = (
+        user_objects.annotate(granted_pk=object_pk)
+        .values('granted_pk')
+        .union(group_objects.annotate(granted_pk=object_pk).values('granted_pk'))
+    )
+    return subquery, exists
+
+
+def filter_granted_objects(queryset, user):
+    """筛选用户有查看权限的数据
+
+    和原来的行为保持一致，用户没有任何授权数据时不做筛选
+    """
+    subquery, exists = get_granted_objects(queryset.model, user)
+    if not exists:
+        return queryset
+    return queryset.filter(pk__in=subquery)
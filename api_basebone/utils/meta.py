@@ -5,23 +5,112 @@
 from django.apps import apps
 from django.conf import settings
 from django.db.models.fields import NOT_PROVIDED
+from django.db.models.fields.related import ForeignKey, OneToOneField
+from django.db.models.signals import class_prepared
+from django.dispatch import receiver
 
+from api_basebone.core import gmeta
 from api_basebone.core.admin import BSMAdminModule
 from api_basebone.utils import module
 
 
+class ModelIndex:
+    """模型字段的索引
+
+    模型的字段在进程的生命周期内基本不会变化，各种工具方法需要的字段列表、
+    名称映射等数据，每个模型只计算一次
+
+    Params:
+        model class 模型类
+    """
+
+    def __init__(self, model):
+        fields = tuple(model._meta.get_fields())
+        self.model = model
+        self.fields = fields
+        self.field_map = {item.name: item for item in fields}
+        self.reverse_fields = tuple(
+            item for item in fields if item.auto_created and not item.concrete
+        )
+        self.relation_fields = tuple(item for item in fields if item.is_relation)
+        self.concrete_fields = tuple(item for item in fields if item.concrete)
+
+        # 列表接口中输出的字段，不包含多对多和一对一
+        self.flat_fields = tuple(
+            item.name
+            for item in fields
+            if item.concrete
+            and not (
+                item.is_relation
+                and (
+                    not isinstance(item, ForeignKey) or isinstance(item, OneToOneField)
+                )
+            )
+        )
+
+        # 关联模型和指向它的第一个正向关系字段的映射，例如用户字段
+        self.related_model_fields = {}
+        for item in fields:
+            if item.is_relation and item.concrete:
+                self.related_model_fields.setdefault(item.related_model, item)
+
+        # 反向字段的 related_name 和反向字段的映射
+        self.related_name_fields = {}
+        for item in self.reverse_fields:
+            related_name = get_relation_field_related_name(
+                item.related_model, item.remote_field.name
+            )
+            if related_name:
+                self.related_name_fields[related_name[0]] = item
+        self.reverse_field_map = {
+            key: value.name for key, value in self.related_name_fields.items()
+        }
+        self.accessor_names = {
+            value.name: key for key, value in self.related_name_fields.items()
+        }
+
+        gmeta_class = getattr(model, 'GMeta', None)
+        self.exclude_fields = tuple(
+            getattr(gmeta_class, gmeta.GMETA_SERIALIZER_EXCLUDE_FIELDS, None) or ()
+        )
+
+    def get_field(self, field_name):
+        """获取字段，找不到时通过反向字段的 related_name 查找"""
+        if field_name in self.field_map:
+            return self.field_map[field_name]
+        return self.related_name_fields.get(field_name)
+
+
+_model_indexes = {}
+
+
+def get_model_index(model):
+    """获取模型字段的索引
+
+    模型还没有全部加载完成时，反向字段还不完整，此时不做缓存
+    """
+    index = _model_indexes.get(model)
+    if index is None:
+        index = ModelIndex(model)
+        if apps.models_ready:
+            _model_indexes[model] = index
+    return index
+
+
+@receiver(class_prepared, dispatch_uid='clear_model_index')
+def clear_model_index(sender=None, **kwargs):
+    """有新的模型加入应用注册表时，已有模型的反向字段可能变化，清空所有的索引"""
+    _model_indexes.clear()
+
+
 def get_reverse_fields(model):
     """获取模型的反向字段"""
-    return [
-        item
-        for item in model._meta.get_fields()
-        if item.auto_created and not item.concrete
-    ]
+    return list(get_model_index(model).reverse_fields)
 
 
 def get_all_relation_fields(model):
     """获取模型中所有的关系字段"""
-    return [item for item in model._meta.get_fields() if item.is_relation]
+    return list(get_model_index(model).relation_fields)
 
 
 def check_field_is_reverse(field):
@@ -38,7 +127,7 @@ def get_field_by_reverse_field(field):
 
 
 def get_concrete_fields(model):
-    return [item for item in model._meta.get_fields() if item.concrete]
+    return list(get_model_index(model).concrete_fields)
 
 
 def get_related_model_field(model, related_model):
@@ -47,10 +136,7 @@ def get_related_model_field(model, related_model):
 
     例如，文章 Article 中的有一个字段
     """
-    for f in model._meta.get_fields():
-        if f.is_relation and f.concrete:
-            if f.related_model is related_model:
-                return f
+    return get_model_index(model).related_model_fields.get(related_model)
 
 
 def get_relation_field(model, field_name, reverse=False):
@@ -140,15 +226,48 @@ def get_bsm_model_admin(model):
     return BSMAdminModule.modules.get(key)
 
 
+# 管理后台的模块是否已经加载
+_admin_module_loaded = False
+
+
+def get_admin_module_names():
+    """导出的应用中符合约定的管理后台模块的名称"""
+    return [
+        f'{apps.get_app_config(app_label).name}.bsm.{slug}'
+        for app_label in get_export_apps()
+        for slug in module.BSM_ADMIN_MODULES
+    ]
+
+
 def load_custom_admin_module():
-    """加载符合约定的 admin 的 module"""
-    export_apps = get_export_apps()
-    if not export_apps:
+    """加载符合约定的 admin、批量操作、表单、导出的 module
+
+    应用启动时加载一次，之后再调用直接返回，开发时修改了模块使用 reload_custom_admin_module
+    """
+    global _admin_module_loaded
+    if _admin_module_loaded:
         return
 
-    for app_label in export_apps:
-        app = apps.get_app_config(app_label)
-        module.get_admin_module(app.name, module.BSM_ADMIN)
+    for module_name in get_admin_module_names():
+        module.import_optional_module(module_name)
+    _admin_module_loaded = True
+
+
+def reload_custom_admin_module():
+    """重新加载管理后台的模块和全局配置的模块"""
+    global _admin_module_loaded
+    global_module = getattr(settings, 'BSM_GLOBAL_MODULE', module.BSM_GLOBAL_MODULE)
+    module.reload_modules(
+        get_admin_module_names()
+        + [
+            f'{global_module}.{name}'
+            for name in (module.BSM_GLOBAL_MODULE_MENU, module.BSM_GLOBAL_MODULE_ROLES)
+        ]
+    )
+    _admin_module_loaded = False
+    load_custom_admin_module()
+    # 依赖 admin 配置构建的缓存全部失效
+    BSMAdminModule.version += 1
 
 
 def get_dict_expand_fields_by_level(model, level):
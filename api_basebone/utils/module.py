@@ -1,4 +1,6 @@
 import importlib
+import sys
+
 from django.conf import settings
 
 # admin 类
@@ -13,6 +15,9 @@ BSM_FORM = 'forms'
 # 管理后台导出的自定义序列化类
 BSM_EXPORT = 'exports'
 
+# 应用启动时加载的管理后台模块
+BSM_ADMIN_MODULES = (BSM_ADMIN, BSM_BATCH_ACTION, BSM_FORM, BSM_EXPORT)
+
 BSM_GLOBAL_MODULE = 'bsmconfig'
 
 # 全局统一配置的菜单模块文件名
@@ -43,15 +48,29 @@ BSM_GLOBAL_ROLE_USE_ADMIN_FILTER_BY_LOGIN_USER = 'use_admin_filter_by_login_user
 BSM_GLOBAL_ROLE_QS_DISTINCT = 'distinct'
 
 
-def get_admin_module(app_full_name, slug=BSM_ADMIN):
-    """获取管理后台指定的模块"""
+# 已经查找过但不存在的模块，避免每次请求都查找
+_missing_modules = set()
+
+
+def import_optional_module(module_name):
+    """加载可选的模块，模块不存在时返回 None
+
+    其他应用可能在 ready 中直接向 sys.modules 注入模块，所以优先使用 sys.modules
+    """
+    module = sys.modules.get(module_name)
+    if module is not None or module_name in _missing_modules:
+        return module
     try:
-        module_name = f'{app_full_name}.bsm.{slug}'
-        module = importlib.util.find_spec(module_name)
-        if module:
+        if importlib.util.find_spec(module_name):
             return importlib.import_module(module_name)
     except ModuleNotFoundError:
-        return
+        pass
+    _missing_modules.add(module_name)
+
+
+def get_admin_module(app_full_name, slug=BSM_ADMIN):
+    """获取管理后台指定的模块"""
+    return import_optional_module(f'{app_full_name}.bsm.{slug}')
 
 
 def import_class_from_string(value):
@@ -68,11 +87,17 @@ def import_class_from_string(value):
 
 def get_bsm_global_module(config_module_name):
     """获取全局配置的模块"""
-    try:
-        module_name = getattr(settings, 'BSM_GLOBAL_MODULE', BSM_GLOBAL_MODULE)
-        module_name = f'{module_name}.{config_module_name}'
-        module = importlib.util.find_spec(module_name)
-        if module:
-            return importlib.import_module(module_name)
-    except ModuleNotFoundError:
-        return
+    module_name = getattr(settings, 'BSM_GLOBAL_MODULE', BSM_GLOBAL_MODULE)
+    return import_optional_module(f'{module_name}.{config_module_name}')
+
+
+def reload_modules(module_names):
+    """重新加载模块，用于开发时修改了模块后不重启进程
+
+    不存在的模块会重新查找，已经加载的模块重新执行
+    """
+    _missing_modules.difference_update(module_names)
+    for module_name in module_names:
+        module = sys.modules.get(module_name)
+        if module is not None:
+            importlib.reload(module)
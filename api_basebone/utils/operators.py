@@ -2,9 +2,12 @@ import operator
 from functools import reduce
 
 from django.apps import apps
-from django.db.models import Manager, Q
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import ManyToManyField, ManyToManyRel, ManyToOneRel, Manager, Q
 from django.template import engines
 from api_basebone.services.expresstion import resolve_expression
+from api_basebone.settings import settings as basebone_settings
+from api_basebone.utils.cache import LRUCache
 
 django_engine = engines['django']
 
@@ -28,6 +31,24 @@ OPERATOR_MAP = {
     "isnull": "__isnull",
 }
 
+# 取反的运算符
+EXCLUDE_OPERATORS = ("!=", "!==", "<>")
+
+# 编译后的过滤条件的缓存，键为过滤条件的结构
+filter_cache = LRUCache(
+    maxsize=basebone_settings.FILTER_CONDITION_CACHE_SIZE, name='filter_conditions'
+)
+# 结果集类型的表达式中编译后的模板的缓存，键为模板字符串
+template_cache = LRUCache(
+    maxsize=basebone_settings.FILTER_CONDITION_CACHE_SIZE, name='filter_template'
+)
+
+# 结果集类型的表达式的求值方式，subquery 作为子查询，once 每个请求只查询一次
+QUERYSET_EVALUATE_SUBQUERY = 'subquery'
+QUERYSET_EVALUATE_ONCE = 'once'
+# 上下文中保存结果集查询结果的键
+QUERYSET_MEMO_KEY = '_basebone_queryset_memo'
+
 
 def get_expression_value(item, context):
     """获取表达式的值"""
@@ -68,13 +89,32 @@ def get_expression_value(item, context):
 
         split_express = expression.split("=", 1)
         field_key, template = split_express
-        filter_kwargs = {
-            field_key: django_engine.from_string(template).render(context=context)
-        }
-        return model.objects.filter(**filter_kwargs)
+        filter_kwargs = {field_key: get_template(template).render(context=context)}
+        queryset = model.objects.filter(**filter_kwargs)
+
+        evaluate = item.get('evaluate') or basebone_settings.FILTER_QUERYSET_EVALUATE
+        if evaluate != QUERYSET_EVALUATE_ONCE or not isinstance(context, dict):
+            # 作为 in 查询的子查询
+            return queryset
+
+        # 同一个请求中只查询一次，使用主键的列表
+        memo = context.setdefault(QUERYSET_MEMO_KEY, {})
+        key = (model._meta.label, field_key, filter_kwargs[field_key])
+        if key not in memo:
+            memo[key] = list(queryset.values_list('pk', flat=True))
+        return memo[key]
     return value
 
 
+def get_template(template):
+    """获取编译后的模板，相同的模板字符串只编译一次"""
+    compiled = template_cache.get(template)
+    if compiled is None:
+        compiled = django_engine.from_string(template)
+        template_cache.set(template, compiled)
+    return compiled
+
+
 def build_filter_conditions(filters, context=None):
     """构造过滤器
 
@@ -112,7 +152,7 @@ def build_filter_conditions(filters, context=None):
         else:
             item_value = item.get("value")
 
-        if item["operator"] in ["!=", "!==", "<>"]:
+        if item["operator"] in EXCLUDE_OPERATORS:
             exclude_cons.append(Q(**{item["field"]: item_value}))
         else:
             operate = OPERATOR_MAP.get(item["operator"], "")
@@ -126,7 +166,330 @@ def build_filter_conditions(filters, context=None):
     )
 
 
-def build_filter_conditions2(filters, context=None):
+class SemiJoin:
+    """多值关系（反向外键、多对多）上的条件，编译为 IN 子查询
+
+    使用连接查询时，多值关系会导致结果集的数据重复，需要去重；使用子查询时不会
+    有重复的数据。例如文章的 tags__name 的条件，编译为
+    pk__in=Tag.objects.filter(name=...).values('article')
+
+    Params:
+        key str 外层的查询键，例如 pk__in
+        model class 子查询的模型
+        value_name str 子查询输出的指回外层模型的字段
+        nullable bool 指回的字段是否可以为空
+    """
+
+    def __init__(self, key, model, value_name, nullable=False):
+        self.key = key
+        self.model = model
+        self.value_name = value_name
+        self.nullable = nullable
+
+    def build(self, condition):
+        if self.nullable:
+            # 取反时为 NOT IN，子查询中有空值时不会匹配任何数据，需要排除空值
+            condition &= Q(**{f'{self.value_name}__isnull': False})
+        queryset = self.model._base_manager.filter(condition).order_by()
+        return Q(**{self.key: queryset.values(self.value_name)})
+
+    @staticmethod
+    def relation_info(field):
+        """多值关系的子查询的模型，指回的字段，外层模型被指向的字段，指回的字段是否可以为空"""
+        # 多对多的子查询通过中间表左连接，指回的字段可能为空
+        if isinstance(field, ManyToManyField):
+            return field.related_model, field.related_query_name(), 'pk', True
+        if isinstance(field, ManyToManyRel):
+            return field.related_model, field.field.name, 'pk', True
+        if isinstance(field, ManyToOneRel) and field.one_to_many:
+            return (
+                field.related_model,
+                field.field.name,
+                field.field.target_field.attname,
+                field.field.null,
+            )
+        return None
+
+
+def split_to_many(model, key):
+    """在第一个多值关系处拆分查询键
+
+    Returns:
+        (外层的路径, 多值关系字段, 子查询中的查询键)，不经过多值关系时返回 None
+    """
+    parts = key.split('__')
+    for index, part in enumerate(parts):
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return None
+        if not field.is_relation:
+            return None
+        if field.many_to_many or field.one_to_many:
+            rest = parts[index + 1 :]
+            if rest:
+                try:
+                    field.related_model._meta.get_field(rest[0])
+                except FieldDoesNotExist:
+                    if rest[0] != 'pk':
+                        # 直接比较关联数据，使用关联数据的主键
+                        rest = ['pk'] + rest
+            else:
+                rest = ['pk']
+            return parts[:index], field, '__'.join(rest)
+        model = field.related_model
+    return None
+
+
+class CompiledFilter:
+    """编译后的过滤条件
+
+    过滤条件按照结构（字段、运算符和层级，不包含值）编译一次，之后只需要绑定新的值。
+    编译后的节点，分组为 (合并的运算, 子节点列表)，条件为 (是否取反, 查询的键,
+    多值关系的子查询, 子查询中的查询键, 字段)
+
+    指定模型时，多值关系上的条件编译为子查询，同一个且分组中同一个多值关系上的
+    条件合并为一个子查询，和连接查询时的语义一致。嵌套的且分组合并到上层的且分组中；
+    同一个多值关系的条件分布在且分组的多个或分组中时，子查询无法表达同一条关联数据
+    满足的语义，这个多值关系上的条件仍然使用连接查询
+
+    Params:
+        shape tuple 过滤条件的结构，参考 get_filter_shape
+        model class 过滤的模型
+    """
+
+    def __init__(self, shape, model=None):
+        self.model = model
+        # 条件中用到的字段
+        self.fields = []
+        # 使用连接查询的多值关系上的字段，格式为 a__b，结果集需要去重
+        self.join_fields = []
+        self._semi_joins = {}
+        # 子查询和使用它的条件的字段
+        self._semi_join_fields = {}
+        self.nodes = self.compile_children(operator.and_, shape)
+        shared = set()
+        self.find_semi_joins(operator.and_, self.nodes, shared)
+        if shared:
+            for semi_join in shared:
+                self.join_fields += self._semi_join_fields[semi_join]
+            self.nodes = self.use_joins(self.nodes, shared)
+
+    def compile_children(self, connector, shape):
+        """编译分组的子节点，和分组的运算相同的子分组合并到分组中"""
+        result = []
+        for node in shape:
+            child = self.compile_node(node)
+            if callable(child[0]) and child[0] is connector:
+                result += child[1]
+            else:
+                result.append(child)
+        return result
+
+    def compile_node(self, node):
+        if node[0] == 'group':
+            connector = operator.or_ if node[1] == 'or' else operator.and_
+            children = self.compile_children(connector, node[2])
+            # 只有一个子节点的分组等同于子节点本身
+            return children[0] if len(children) == 1 else (connector, children)
+
+        _, field, operate = node
+        self.fields.append(field)
+        field = field.replace('.', '__')
+        if operate in EXCLUDE_OPERATORS:
+            negate, key = True, field
+        else:
+            negate, key = False, f"{field}{OPERATOR_MAP.get(operate, '')}"
+        if self.model is None:
+            self.join_fields.append(field)
+            return negate, key, None, None, field
+
+        semi_join, lookup = self.compile_semi_join(key)
+        if semi_join is None and lookup:
+            self.join_fields.append(field)
+        elif semi_join is not None and not negate:
+            self._semi_join_fields.setdefault(semi_join, []).append(field)
+        return negate, key, semi_join, lookup, field
+
+    def find_semi_joins(self, connector, children, shared):
+        """查找分组中取反之外的条件使用的子查询
+
+        且分组中，直接的条件合并为一个子查询，每个或分组各自使用子查询，同一个子查询
+        被多处使用时加入到 shared 中
+
+        Returns:
+            set 分组中使用的子查询
+        """
+        members, direct = [], set()
+        for child in children:
+            if callable(child[0]):
+                members.append(self.find_semi_joins(child[0], child[1], shared))
+            elif child[2] is not None and not child[0]:
+                direct.add(child[2])
+        members.append(direct)
+
+        result = set()
+        for item in members:
+            if connector is operator.and_:
+                shared |= result & item
+            result |= item
+        return result
+
+    def use_joins(self, children, shared):
+        """多处使用的子查询上的条件改为使用连接查询，结果集需要去重"""
+        result = []
+        for child in children:
+            if callable(child[0]):
+                result.append((child[0], self.use_joins(child[1], shared)))
+                continue
+            negate, key, semi_join, lookup, field = child
+            if semi_join in shared and not negate:
+                semi_join = None
+            result.append((negate, key, semi_join, lookup, field))
+        return result
+
+    def compile_semi_join(self, key):
+        """返回 (子查询, 子查询中的查询键)
+
+        不经过多值关系时返回 (None, None)，无法使用子查询时返回 (None, 查询键)
+        """
+        split = split_to_many(self.model, key)
+        if split is None:
+            return None, None
+        path, field, lookup = split
+        info = SemiJoin.relation_info(field)
+        # 判断是否为空的条件，在子查询中无法表达
+        if info is None or lookup.split('__')[-1] == 'isnull':
+            return None, key
+
+        cache_key = (tuple(path), field.name)
+        if cache_key not in self._semi_joins:
+            model, value_name, target, nullable = info
+            self._semi_joins[cache_key] = SemiJoin(
+                '__'.join([*path, target, 'in']), model, value_name, nullable
+            )
+        return self._semi_joins[cache_key], lookup
+
+    def get_value(self, item, context):
+        if "expression" in item:
+            return get_expression_value(item, context)
+        return item.get("value")
+
+    def bind_group(self, connector, children, items, context, join_fields):
+        result, merged = [], {}
+        for child in children:
+            if callable(child[0]):
+                result.append(
+                    self.bind_group(child[0], child[1], items, context, join_fields)
+                )
+                continue
+
+            negate, key, semi_join, lookup, field = child
+            value = self.get_value(next(items), context)
+            if (
+                semi_join is not None
+                and value is None
+                and (negate or lookup.endswith('__exact'))
+            ):
+                # 和空值比较时，连接查询会匹配没有关联数据的行，子查询无法表达，使用连接查询
+                semi_join = None
+                join_fields.append(field)
+            if semi_join is None:
+                condition = Q(**{key: value})
+            elif negate or connector is not operator.and_:
+                condition = semi_join.build(Q(**{lookup: value}))
+            else:
+                # 且分组中同一个多值关系上的条件合并到一个子查询中
+                if semi_join not in merged:
+                    merged[semi_join] = []
+                    result.append(semi_join)
+                merged[semi_join].append(Q(**{lookup: value}))
+                continue
+            result.append(~condition if negate else condition)
+
+        result = [
+            item.build(reduce(operator.and_, merged[item]))
+            if isinstance(item, SemiJoin)
+            else item
+            for item in result
+        ]
+        return reduce(connector, result)
+
+    def bind(self, items, context=None, join_fields=None):
+        """绑定条件的值，返回过滤器
+
+        Params:
+            items list 过滤条件中的条件，顺序和编译时一致
+            join_fields list 绑定值后改为使用连接查询的条件的字段会加入到其中，
+                和 self.join_fields 一起判断结果集是否需要去重
+        """
+        if not self.nodes:
+            return None
+        if join_fields is None:
+            join_fields = []
+        return self.bind_group(
+            operator.and_, self.nodes, iter(items), context or {}, join_fields
+        )
+
+
+def get_item_shape(item, items):
+    """获取单个过滤条件的结构，不合法的条件返回 None"""
+    if not isinstance(item, dict):
+        return None
+
+    children = item.get('children')
+    if children:
+        shapes = []
+        for child in children:
+            shape = get_item_shape(child, items)
+            if shape is not None:
+                shapes.append(shape)
+        if not shapes:
+            return None
+        return 'group', item['operator'].lower(), tuple(shapes)
+
+    if 'field' not in item or 'operator' not in item:
+        return None
+    items.append(item)
+    return 'item', item['field'], item['operator']
+
+
+def get_filter_shape(filters):
+    """获取过滤条件的结构和其中的条件
+
+    Returns:
+        (结构, 条件列表)，结构可以作为编译缓存的键
+    """
+    items, shapes = [], []
+    for item in filters:
+        shape = get_item_shape(item, items)
+        if shape is not None:
+            shapes.append(shape)
+    return tuple(shapes), items
+
+
+def compile_filter_conditions(filters, model=None):
+    """编译过滤条件，相同结构的过滤条件只编译一次
+
+    Params:
+        filters list 过滤条件
+        model class 过滤的模型，指定时多值关系上的条件编译为子查询
+
+    Returns:
+        (编译后的过滤条件, 条件列表)
+    """
+    if not basebone_settings.FILTER_TO_MANY_SUBQUERY:
+        model = None
+    shape, items = get_filter_shape(filters)
+    cache_key = (model._meta.label if model else None, shape)
+    compiled = filter_cache.get(cache_key)
+    if compiled is None:
+        compiled = CompiledFilter(shape, model)
+        filter_cache.set(cache_key, compiled)
+    return compiled, items
+
+
+def build_filter_conditions2(filters, context=None, model=None):
     """构造过滤器
     跟build_filter_conditions不同得放的地方在于把返回的两个条件合并
 
@@ -144,15 +507,14 @@ def build_filter_conditions2(filters, context=None):
                     value: xxxx,
                 }
             ]
+
+        model class 过滤的模型，指定时多值关系上的条件编译为子查询
     """
     if not filters or not isinstance(filters, list):
         return None
 
-    trans_cons = []
-    for item in filters:
-        build_conditions_in_item(trans_cons, item, context or {})
-
-    return reduce(operator.and_, trans_cons) if trans_cons else None
+    compiled, items = compile_filter_conditions(filters, model)
+    return compiled.bind(items, context)
 
 
 def build_conditions_in_item(trans_cons, item, context=None):
@@ -185,7 +547,7 @@ def build_conditions_in_item(trans_cons, item, context=None):
         else:
             item_value = item.get("value")
 
-        if item["operator"] in ["!=", "!==", "<>"]:
+        if item["operator"] in EXCLUDE_OPERATORS:
             trans_cons.append(~Q(**{item["field"].replace('.', '__'): item_value}))
         else:
             operate = OPERATOR_MAP.get(item["operator"], "")
@@ -1,20 +1,27 @@
-from django.db.models.query import QuerySet, Prefetch
-from django.db.models import Manager
+import logging
+from itertools import islice
 
+from django.db.models.query import BaseIterable, ModelIterable, QuerySet, Prefetch
+from django.db.models import Manager, prefetch_related_objects
+
+from .meta import get_model_index
 from .operators import build_filter_conditions2
 from ..export.fields import get_attr_in_gmeta_class
 from ..core import gmeta
 from ..restful.serializers import multiple_create_serializer_class, get_field, nested_display_fields, \
     sort_expand_fields, display_fields_to_expand_fields
 from ..services.expresstion import resolve_expression
+from ..settings import settings as basebone_settings
 
 __all__ = ['filter', 'serialize', 'annotate', 'GManager']
 
+log = logging.getLogger(__name__)
+
 
 def filter_queryset(queryset, filters=None, context=None):
     if not filter:
         return queryset
-    cons = build_filter_conditions2(filters, context=context)
+    cons = build_filter_conditions2(filters, context=context, model=queryset.model)
     if cons:
         queryset = queryset.filter(cons)
 
@@ -73,11 +80,9 @@ def translate_expand_fields(_model, expand_fields):
         for index, value in enumerate(field_list):
             field = model._meta.get_field(value)
             if check_field_is_reverse(field):
-                result = get_relation_field_related_name(
-                    field.related_model, field.remote_field.name
-                )
-                if result:
-                    field_list[index] = result[0]
+                related_name = get_model_index(model).accessor_names.get(field.name)
+                if related_name:
+                    field_list[index] = related_name
             if field.is_relation:
                 model = field.related_model
         expand_fields[out_index] = '.'.join(field_list)
@@ -104,13 +109,19 @@ def serialize_queryset(data, action='list', expand_fields=None):
     return serializer.data
 
 
-def annotate_queryset(queryset, fields=None, context=None):
+def get_annotated_fields(model, fields=None):
+    """获取模型 GMeta 中声明的注解字段"""
     annotated_fields = {}
-    if 'GMeta' in queryset.model.__dict__:
+    if 'GMeta' in model.__dict__:
         # 这样可以避免从继承过来的GMeta里取，对于one to one类型的继承来说会出错
-        annotated_fields = getattr(queryset.model.__dict__['GMeta'], gmeta.GMETA_ANNOTATED_FIELDS, {})
+        annotated_fields = getattr(model.__dict__['GMeta'], gmeta.GMETA_ANNOTATED_FIELDS, {})
     if fields is not None:
         annotated_fields = {k: v for k, v in annotated_fields.items() if k in fields}
+    return annotated_fields
+
+
+def annotate_queryset(queryset, fields=None, context=None):
+    annotated_fields = get_annotated_fields(queryset.model, fields)
     if annotated_fields:
         params = {}
         for name, field in annotated_fields.items():
@@ -122,6 +133,60 @@ def annotate_queryset(queryset, fields=None, context=None):
     return queryset
 
 
+def get_condition_fields(conditions):
+    """获取过滤条件中用到的字段"""
+    fields = set()
+    for condition in conditions or []:
+        if 'children' in condition:
+            fields |= get_condition_fields(condition['children'])
+        elif condition.get('field'):
+            fields.add(condition['field'])
+    return fields
+
+
+def get_used_annotated_fields(model, display_fields=None, conditions=None, order_by=None, fields=None):
+    """获取请求中用到的注解字段
+
+    注解字段一般是子查询或者聚合，没有用到的注解字段不需要出现在 SQL 中
+
+    Params:
+        model class 模型类
+        display_fields list 显示字段，为 None 时显示所有的字段
+        conditions list 过滤条件
+        order_by list 排序字段
+        fields list 其他用到的字段，例如统计的字段
+
+    Returns:
+        list 注解字段的名称
+    """
+    annotated_fields = get_annotated_fields(model)
+    if not annotated_fields:
+        return []
+    if display_fields is None or '*' in display_fields:
+        return list(annotated_fields)
+
+    names = set(display_fields) | get_condition_fields(conditions) | set(fields or [])
+    if isinstance(order_by, (list, tuple)):
+        names |= {item.lstrip('-') for item in order_by if isinstance(item, str)}
+    # 计算属性依赖的字段也可能是注解字段
+    computed_fields = get_attr_in_gmeta_class(model, gmeta.GMETA_COMPUTED_FIELDS, [])
+    for item in computed_fields:
+        if item['name'] in names:
+            names.update(item.get('deps', []))
+
+    used = {name.replace('.', '__').split('__')[0] for name in names}
+    # 反向关系 prefetch 时，子对象指向父对象的关系使用的是当前的实例，
+    # 例如 comments.article.xxx 中的 article 就是当前的实例
+    for name in display_fields:
+        current = model
+        for item in name.split('.'):
+            if current is model and item in annotated_fields:
+                used.add(item)
+            field = get_field(current, item) if current is not None else None
+            current = field.related_model if field is not None and field.is_relation else None
+    return [name for name in annotated_fields if name in used]
+
+
 def expand_dict_to_prefetch(model, expand_dict=None, fields=None, context=None, display_fields=None):
     result = []
     if expand_dict is None:
@@ -152,19 +217,18 @@ def expand_dict_to_prefetch(model, expand_dict=None, fields=None, context=None,
 
 
 def get_exclude_fields_by_model(model):
-    if not hasattr(model, 'GMeta'):
-        return []
-    return getattr(model.GMeta, gmeta.GMETA_SERIALIZER_EXCLUDE_FIELDS, [])
+    return list(get_model_index(model).exclude_fields)
 
 
-def queryset_only(queryset, display_fields):
-    annotated_fields = get_attr_in_gmeta_class(queryset.model, gmeta.GMETA_ANNOTATED_FIELDS, {})
-    computed_fields = get_attr_in_gmeta_class(queryset.model, gmeta.GMETA_COMPUTED_FIELDS, [])
+def get_only_fields(model, display_fields):
+    """根据显示字段获取 only 的字段列表，显示字段中有 * 时返回 None"""
+    annotated_fields = get_attr_in_gmeta_class(model, gmeta.GMETA_ANNOTATED_FIELDS, {})
+    computed_fields = get_attr_in_gmeta_class(model, gmeta.GMETA_COMPUTED_FIELDS, [])
     computed_field_names = {c['name'] for c in computed_fields}
     only = [d for d in display_fields if '.' not in d and d not in annotated_fields and d not in computed_field_names]
     for d in display_fields:
         if '.' in d:
-            field = get_field(queryset.model, d.split('.')[0])
+            field = get_field(model, d.split('.')[0])
             if field:
                 if field.concrete:
                     only.append(field.name)
@@ -172,18 +236,173 @@ def queryset_only(queryset, display_fields):
     for c in computed_fields:
         only += c.get('deps', [])
     if '*' in only:
-        return queryset
+        return None
     only.append('pk')
+    return only
+
+
+def queryset_only(queryset, display_fields):
+    only = get_only_fields(queryset.model, display_fields)
+    if only is None:
+        return queryset
     return queryset.only(*only)
 
 
+class ExpandPlan:
+    """展开字段的查询计划
+
+    单值的正向关系（外键、一对一）使用 select_related 在同一个查询中 JOIN，
+    一对多、多对多以及不能 JOIN 的关系使用 Prefetch 单独查询
+    """
+
+    def __init__(self):
+        self.select_related = []
+        self.prefetches = []
+        # 通过 JOIN 加载的关联模型的 only 和 defer 字段，字段名带有关系路径
+        self.only = []
+        self.defer = []
+
+    def merge(self, plan):
+        self.select_related += plan.select_related
+        self.prefetches += plan.prefetches
+        self.only += plan.only
+        self.defer += plan.defer
+
+    def __str__(self):
+        return 'select_related={} prefetch={}'.format(
+            self.select_related, [item.prefetch_to for item in self.prefetches]
+        )
+
+
+def can_select_related(field, fields=None, only=None):
+    """检测展开的关系字段是否可以使用 select_related
+
+    Params:
+        field field 展开的关系字段
+        fields list 关联模型需要的注解字段，为 None 时是所有的注解字段
+        only list 当前模型 only 的字段，为 None 时不限制
+    """
+    if not field.concrete or not (field.many_to_one or field.one_to_one):
+        return False
+    # 外键字段本身被延迟加载时，不能 JOIN
+    if only is not None and field.name not in only:
+        return False
+    related_model = field.related_model
+    # 注解字段只能在 Prefetch 的结果集中计算
+    if get_annotated_fields(related_model, fields):
+        return False
+    # Prefetch 使用 objects 管理器，自定义了结果集的管理器可能会过滤数据，JOIN 时不会
+    manager = getattr(related_model, 'objects', None)
+    return manager is not None and type(manager).get_queryset is Manager.get_queryset
+
+
+def plan_expand(model, expand_dict, fields=None, context=None, display_fields=None, only=None, prefix=''):
+    """为展开字段生成查询计划
+
+    Params:
+        model class 模型类
+        expand_dict dict 树形结构的展开字段
+        fields list 需要的注解字段
+        display_fields list 当前模型的显示字段
+        only list 当前模型 only 的字段，为 None 时不限制
+        prefix str 通过 JOIN 到达当前模型的关系路径
+
+    Returns:
+        ExpandPlan
+    """
+    plan = ExpandPlan()
+    for key, value in expand_dict.items():
+        field = get_field(model, key)
+        next_model = field.related_model
+        next_fields = fields and [field.split('.', maxsplit=1)[-1] for field in fields if field.startswith(key+'.')]
+        nested = nested_display_fields(model, display_fields, key)
+        if nested is not None and not field.concrete:
+            nested.append(field.field.name)
+        next_only = get_only_fields(next_model, nested) if display_fields is not None and nested else None
+        if next_fields is None and next_only is not None:
+            # 关联模型只使用显示字段中用到的注解字段
+            next_fields = nested + get_used_annotated_fields(next_model, nested)
+        path = f'{prefix}{key}'
+
+        if can_select_related(field, fields=next_fields, only=only):
+            plan.select_related.append(path)
+            plan.defer += [f'{path}__{name}' for name in get_exclude_fields_by_model(next_model)]
+            # 当前模型没有限制 only 时，关联模型也不限制；当前模型有限制时，
+            # 关联模型需要明确列出加载的字段，否则 defer 不会生效
+            if only is None:
+                next_only = None
+            elif next_only is None:
+                exclude_fields = get_exclude_fields_by_model(next_model)
+                next_only = [
+                    item.name for item in get_model_index(next_model).concrete_fields
+                    if item.name not in exclude_fields
+                ]
+            if next_only is not None:
+                # 关联路径中不能使用 pk 的别名
+                pk_name = next_model._meta.pk.name
+                plan.only += [f'{path}__{pk_name if name == "pk" else name}' for name in next_only]
+            plan.merge(
+                plan_expand(
+                    next_model, value, fields=next_fields, context=context,
+                    display_fields=nested, only=next_only, prefix=f'{path}__',
+                )
+            )
+            continue
+
+        qs = build_expand_queryset(
+            next_model.objects.all(), value, fields=next_fields, context=context,
+            display_fields=nested, only=next_only,
+        )
+        # 使关联关系也能用annotated_field
+        plan.prefetches.append(
+            Prefetch(path, queryset=annotate_queryset(qs, fields=next_fields, context=context))
+        )
+    return plan
+
+
+def build_expand_queryset(queryset, expand_dict, fields=None, context=None, display_fields=None, only=None):
+    """按照查询计划处理结果集的 only, defer, select_related 和 prefetch"""
+    model = queryset.model
+    plan = plan_expand(
+        model, expand_dict or {}, fields=fields, context=context,
+        display_fields=display_fields, only=only,
+    )
+    log.debug('expand plan for %s: %s', model._meta.label, plan)
+
+    if only is not None:
+        queryset = queryset.only(*only, *plan.only)
+    if plan.select_related:
+        queryset = queryset.select_related(*plan.select_related)
+    return queryset.defer(*get_exclude_fields_by_model(model), *plan.defer).prefetch_related(
+        *plan.prefetches
+    )
+
+
+def get_select_related_paths(queryset):
+    """获取结果集中 select_related 的关系路径"""
+    def flatten(tree, prefix=''):
+        result = []
+        for key, value in tree.items():
+            result.append(f'{prefix}{key}')
+            result += flatten(value, f'{prefix}{key}__')
+        return result
+
+    select_related = queryset.query.select_related
+    return flatten(select_related) if isinstance(select_related, dict) else []
+
+
 def queryset_prefetch(queryset, expand_dict=None, context=None, display_fields=None):
+    if expand_dict is None:
+        if display_fields is not None:
+            expand_dict = sort_expand_fields(display_fields_to_expand_fields(display_fields))
+        else:
+            expand_dict = {}
+
+    only = None
     if display_fields is not None:
-        queryset = queryset_only(queryset, display_fields)
-    return queryset.defer(*get_exclude_fields_by_model(queryset.model)).prefetch_related(
-        *expand_dict_to_prefetch(
-            queryset.model, expand_dict, context=context, display_fields=display_fields,
-        )
+        only = get_only_fields(queryset.model, display_fields)
+    return build_expand_queryset(
+        queryset, expand_dict, context=context, display_fields=display_fields, only=only,
     )
 
 
@@ -194,32 +413,73 @@ annotate = annotate_queryset
 only = queryset_only
 
 
-# 尚未完全能用，prefetch有问题
-# class GMIterable(ModelIterable):
-#     def __iter__(self):
-#         serializer_class = self.queryset._serializer_class
-#         for obj in super().__iter__():
-#             return serializer_class(obj).data
+def iter_chunks(queryset, chunk_size=None):
+    """分批迭代结果集，每批单独执行 prefetch
+
+    结果集使用 iterator 迭代，不会缓存所有的实例，prefetch 的关联数据每批查询一次，
+    内存的占用只和每批的数据量相关
+
+    Params:
+        queryset queryset|list 结果集
+        chunk_size int 每批的数据量
+
+    Returns:
+        generator 元素为每批数据的列表
+    """
+    chunk_size = chunk_size or basebone_settings.EXPORT_CHUNK_SIZE
+    lookups = []
+    if isinstance(queryset, QuerySet) and queryset._result_cache is None:
+        lookups = queryset._prefetch_related_lookups
+        iterator = queryset.prefetch_related(None).iterator(chunk_size=chunk_size)
+    else:
+        iterator = iter(queryset)
+
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        if lookups:
+            prefetch_related_objects(chunk, *lookups)
+        yield chunk
+
+
+class GMIterable(BaseIterable):
+    """分批查询并序列化，迭代的元素为序列化后的数据"""
+
+    def __iter__(self):
+        queryset = self.queryset
+        source = queryset._chain()
+        source._iterable_class = ModelIterable
+        source._prefetch_related_lookups = queryset._render_lookups
+        for chunk in iter_chunks(source, self.chunk_size):
+            yield from queryset._serializer_class(chunk, many=True).data
 
 
 class BSMQuerySet(QuerySet):
     def render(self, display_fields):
-        # clone = queryset_prefetch(self, display_fields=display_fields)
-        # clone._iterable_class = GMIterable
-        # clone._serializer_class = multiple_create_serializer_class(
-        #     clone.model,
-        #     expand_fields=display_fields_to_expand_fields(display_fields),
-        #     display_fields=display_fields,
-        #     action='retrieve',
-        # )
-        # return clone
-        serializer_class = multiple_create_serializer_class(
-            self.model,
+        return list(self.render_iter(display_fields))
+
+    def render_iter(self, display_fields, chunk_size=None):
+        """流式输出序列化后的数据
+
+        Params:
+            display_fields list 显示字段
+            chunk_size int 每批的数据量
+
+        Returns:
+            generator 元素为序列化后的数据
+        """
+        qs = queryset_prefetch(self, display_fields=display_fields)
+        # prefetch 由 GMIterable 每批执行
+        clone = qs.prefetch_related(None)
+        clone._iterable_class = GMIterable
+        clone._render_lookups = qs._prefetch_related_lookups
+        clone._serializer_class = multiple_create_serializer_class(
+            clone.model,
             display_fields=display_fields,
             action='list',
         )
-        qs = queryset_prefetch(self, display_fields=display_fields)
-        return serializer_class(qs.all(), many=True).data
+        return clone.iterator(chunk_size=chunk_size or basebone_settings.EXPORT_CHUNK_SIZE)
 
     def render_get(self, display_fields, **conditions):
         serializer_class = multiple_create_serializer_class(
@@ -233,11 +493,12 @@ class BSMQuerySet(QuerySet):
     def annotate_fields(self, fields=None, context=None):
         return annotate_queryset(self, fields=fields, context=context)
 
-    # def _chain(self):
-    #     c = super()._chain()
-    #     if hasattr(self, '_serializer_class'):
-    #         c._serializer_class = self._serializer_class
-    #     return c
+    def _chain(self, **kwargs):
+        c = super()._chain(**kwargs)
+        for name in ('_render_lookups', '_serializer_class'):
+            if hasattr(self, name):
+                setattr(c, name, getattr(self, name))
+        return c
 
 
 GManager = Manager.from_queryset(BSMQuerySet)
@@ -0,0 +1,248 @@
+"""
+树形数据的加载
+
+树形结构的数据输出时，序列化类会逐个节点读取子节点，节点有多少，就会有多少次查询。
+这里在序列化之前一次性加载所有的子孙节点，在内存中组装好树形结构，并写入到节点的
+prefetch 缓存中，序列化时不再查询数据库
+
+加载子孙节点的方式，按照优先级：
+
+- 模型是 MPTTModel 时，使用 MPTT 的 tree_id, lft, rght 字段
+- 数据库支持递归 CTE 时（PostgreSQL, SQLite, MySQL 8），使用递归 CTE
+- 其他情况，按层使用 parent__in 批量查询
+"""
+
+import logging
+
+from django.db import connections
+from django.db.models import Count, Q, prefetch_related_objects
+from django.db.models.expressions import RawSQL
+
+log = logging.getLogger(__name__)
+
+# 节点上保存子节点数量的属性
+CHILD_COUNT_ATTR = '_basebone_tree_child_count'
+
+
+class RawSubquery(RawSQL):
+    """作为 IN 子查询使用的原生 SQL
+
+    IN 查询会在子查询的两侧加上括号，RawSQL 本身也会加一层括号，两层括号时
+    部分数据库（例如 SQLite）会把子查询当作标量子查询，只取第一行
+    """
+
+    def as_sql(self, compiler, connection):
+        return self.sql, self.params
+
+
+class TreeLoader:
+    """加载节点的子孙节点
+
+    Params:
+        model class 模型类
+        parent_field str 父亲字段的名称
+        max_depth int 加载的最大深度，为 None 时加载所有的层级
+    """
+
+    def __init__(self, model, parent_field, max_depth=None):
+        self.model = model
+        self.field = model._meta.get_field(parent_field)
+        self.cache_name = self.field.remote_field.get_cache_name()
+        # 子节点中指向父亲的字段，以及父亲被指向的字段
+        self.parent_attname = self.field.attname
+        self.key_attname = self.field.target_field.attname
+        self.max_depth = max_depth
+
+    def get_manager(self):
+        return self.model._default_manager
+
+    def supports_cte(self, using):
+        connection = connections[using]
+        if self.field.model is not self.model:
+            return False
+        if connection.vendor in ('postgresql', 'sqlite'):
+            return True
+        if connection.vendor == 'mysql':
+            return getattr(connection, 'mysql_version', (0,)) >= (8,)
+        return False
+
+    def load_by_mptt(self, nodes, using):
+        """使用 MPTT 的字段加载子孙节点"""
+        opts = self.model._mptt_meta
+        condition = Q()
+        for node in nodes:
+            params = {
+                opts.tree_id_attr: getattr(node, opts.tree_id_attr),
+                f'{opts.left_attr}__gt': getattr(node, opts.left_attr),
+                f'{opts.right_attr}__lt': getattr(node, opts.right_attr),
+            }
+            if self.max_depth is not None:
+                params[f'{opts.level_attr}__lte'] = (
+                    getattr(node, opts.level_attr) + self.max_depth
+                )
+            condition |= Q(**params)
+        return list(self.get_manager().using(using).filter(condition))
+
+    def load_by_cte(self, nodes, using):
+        """使用递归 CTE 加载子孙节点"""
+        quote_name = connections[using].ops.quote_name
+        table = quote_name(self.model._meta.db_table)
+        parent_column = quote_name(self.field.column)
+        key_column = quote_name(self.field.target_field.column)
+        keys = [getattr(node, self.key_attname) for node in nodes]
+
+        depth_condition, params = '', list(keys)
+        if self.max_depth is not None:
+            depth_condition = 'WHERE tree_nodes.depth < %s'
+            params.append(self.max_depth)
+
+        sql = (
+            f'WITH RECURSIVE tree_nodes (node_key, depth) AS ('
+            f'SELECT {key_column}, 1 FROM {table} '
+            f'WHERE {parent_column} IN ({", ".join(["%s"] * len(keys))}) '
+            f'UNION ALL '
+            f'SELECT child.{key_column}, tree_nodes.depth + 1 FROM {table} child '
+            f'INNER JOIN tree_nodes ON child.{parent_column} = tree_nodes.node_key '
+            f'{depth_condition}'
+            f') SELECT node_key FROM tree_nodes'
+        )
+        return list(
+            self.get_manager()
+            .using(using)
+            .filter(**{f'{self.key_attname}__in': RawSubquery(sql, params)})
+        )
+
+    def load_by_level(self, nodes, using):
+        """按层批量加载子孙节点"""
+        result, level, depth = [], nodes, 0
+        while level and (self.max_depth is None or depth < self.max_depth):
+            keys = [getattr(node, self.key_attname) for node in level]
+            level = list(
+                self.get_manager()
+                .using(using)
+                .filter(**{f'{self.parent_attname}__in': keys})
+            )
+            result += level
+            depth += 1
+        return result
+
+    def load_descendants(self, nodes, using):
+        if hasattr(self.model, '_mptt_meta'):
+            return self.load_by_mptt(nodes, using)
+        if self.supports_cte(using):
+            return self.load_by_cte(nodes, using)
+        return self.load_by_level(nodes, using)
+
+    def set_children(self, node, children):
+        """把子节点写入到节点的 prefetch 缓存中"""
+        queryset = getattr(node, self.cache_name).all()
+        queryset._result_cache = children
+        queryset._prefetch_done = True
+        if not hasattr(node, '_prefetched_objects_cache'):
+            node._prefetched_objects_cache = {}
+        node._prefetched_objects_cache[self.cache_name] = queryset
+
+    def get_depths(self, nodes, children_map):
+        """计算每个节点的深度，根节点的深度为 0"""
+        depths, level, depth = {}, nodes, 0
+        while level:
+            next_level = []
+            for node in level:
+                depths[id(node)] = depth
+                next_level += children_map.get(getattr(node, self.key_attname), [])
+            level, depth = next_level, depth + 1
+        return depths
+
+    def set_child_counts(self, nodes, children_map, depths, using):
+        """计算每个节点的子节点数量
+
+        达到最大深度的节点，子节点没有加载，通过一次分组查询获取数量
+        """
+        truncated = [
+            node
+            for node in nodes
+            if self.max_depth is not None and depths[id(node)] >= self.max_depth
+        ]
+        counts = {}
+        if truncated:
+            counts = dict(
+                self.get_manager()
+                .using(using)
+                .filter(
+                    **{
+                        f'{self.parent_attname}__in': [
+                            getattr(node, self.key_attname) for node in truncated
+                        ]
+                    }
+                )
+                .order_by()
+                .values_list(self.parent_attname)
+                .annotate(count=Count('pk'))
+            )
+        truncated_ids = {id(node) for node in truncated}
+        for node in nodes:
+            key = getattr(node, self.key_attname)
+            if id(node) in truncated_ids:
+                setattr(node, CHILD_COUNT_ATTR, counts.get(key, 0))
+            else:
+                setattr(node, CHILD_COUNT_ATTR, len(children_map.get(key, [])))
+
+    def load(self, nodes, prefetch_lookups=None, child_count=False):
+        """加载子孙节点，并组装树形结构
+
+        Params:
+            nodes list 根节点
+            prefetch_lookups list 子孙节点同样需要的 prefetch 配置，例如展开字段
+            child_count bool 是否计算每个节点的子节点数量
+        """
+        nodes = list(nodes)
+        if not nodes:
+            return nodes
+
+        using = nodes[0]._state.db or 'default'
+        descendants = []
+        if self.max_depth is None or self.max_depth > 0:
+            descendants = self.load_descendants(nodes, using)
+        log.debug(
+            'tree %s loaded %s descendants for %s nodes',
+            self.model._meta.label,
+            len(descendants),
+            len(nodes),
+        )
+        if descendants and prefetch_lookups:
+            prefetch_related_objects(descendants, *prefetch_lookups)
+
+        children_map = {}
+        for node in descendants:
+            children_map.setdefault(getattr(node, self.parent_attname), []).append(node)
+
+        depths = self.get_depths(nodes, children_map)
+        all_nodes = nodes + descendants
+        for node in all_nodes:
+            if self.max_depth is not None and depths.get(id(node), 0) >= self.max_depth:
+                children = []
+            else:
+                children = children_map.get(getattr(node, self.key_attname), [])
+            self.set_children(node, children)
+
+        if child_count:
+            self.set_child_counts(all_nodes, children_map, depths, using)
+        return nodes
+
+    def fill_child_counts(self, data, nodes, children_key, count_key):
+        """把节点的子节点数量写入到序列化后的数据中
+
+        序列化后的数据和节点的顺序一致，同步遍历即可
+
+        Params:
+            data list 序列化后的数据
+            nodes list 节点
+            children_key str 数据中子节点的键
+            count_key str 数据中子节点数量的键
+        """
+        for item, node in zip(data, nodes):
+            item[count_key] = getattr(node, CHILD_COUNT_ATTR, 0)
+            children = node._prefetched_objects_cache[self.cache_name]
+            self.fill_child_counts(
+                item.get(children_key) or [], list(children), children_key, count_key
+            )